@@ -144,6 +144,19 @@ def live_content(ip):
 def get_live():
     return jsonify([])
 
+@app.route('/notify_status', methods=['POST'])
+def notify_status():
+    #presence updates from the SSH server: a list of {"ip": ..., "online": ...} (or a single one)
+    updates = request.get_json(silent=True)
+    if isinstance(updates, dict):
+        updates = [updates]
+    if not isinstance(updates, list):
+        return jsonify(error="expected a JSON list of status updates"), 400
+    for update in updates:
+        if isinstance(update, dict) and update.get('ip'):
+            socketio.emit('status_update', {'ip': update['ip'], 'online': bool(update.get('online'))})
+    return jsonify(received=len(updates))
+
 @app.route('/connection_ips')
 def get_connection_ips():
     connection = get_db_connection()
@@ -46,6 +46,7 @@ cd ..
 echo "Setting up SSH server RSA key..."
 cd ./ssh-server/key/
 ssh-keygen -t rsa -b 2048 -f serv_rsa.key -N ""
+ssh-keygen -t ed25519 -f serv_ed25519.key -N ""
 echo "Done."
 cd ../../
 
@@ -0,0 +1,99 @@
+import logging
+import socket
+import time
+from collections import OrderedDict
+
+#Admission control, checked right after accept() and before any fork or handshake work:
+#- a token bucket per source IP (rate connections/s, bursts of up to burst connections; no
+#  rate limit when rate is 0 or less, the session limits still apply)
+#- at most max_per_ip concurrent sessions per source IP, and max_total overall.
+#The buckets are kept in GCRA form: a single timestamp per IP (when its bucket will be full
+#again), in least recently seen order. An IP whose bucket is full again is indistinguishable
+#from a new one, so it is evicted; past max_ips the oldest entries go even if not refilled yet.
+#Open session counts are only kept for the IPs that have sessions open.
+
+RATE, PER_IP, TOTAL = 'rate', 'per_ip', 'total'  #reasons a connection is refused
+
+def _key(ip):
+    #packed address: 4 or 16 bytes instead of the text form
+    try:
+        return socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+    except OSError:
+        return ip
+
+class Admission:
+    def __init__(self, rate=0.5, burst=10, max_per_ip=4, max_total=512, max_ips=100000, log_every=100):
+        self.rate = rate              #tokens added per second, 0 or less: no rate limit
+        self.burst = burst            #bucket size
+        self.max_per_ip = max_per_ip
+        self.max_total = max_total
+        self.max_ips = max_ips
+        self.log_every = log_every    #one drop in log_every is logged
+        self.active = 0
+        self._ips = OrderedDict()     #packed ip -> monotonic time its bucket is full again
+        self._sessions = {}           #packed ip -> open sessions, only for IPs with some
+        self.stats = {'admitted': 0, 'dropped': 0, RATE: 0, PER_IP: 0, TOTAL: 0, 'evicted': 0}
+
+    def admit(self, ip):
+        #returns True if the connection may proceed, in which case release(ip) must follow
+        now = time.monotonic()
+        key = _key(ip)
+        interval = 1 / self.rate if self.rate > 0 else 0  #0: the bucket is always full
+        full_at = max(self._ips.pop(key, now), now)  #when the bucket is full again
+        sessions = self._sessions.get(key, 0)
+
+        if self.active >= self.max_total:
+            reason = TOTAL
+        elif sessions >= self.max_per_ip:
+            reason = PER_IP
+        elif interval and full_at + interval - now > self.burst * interval:
+            reason = RATE  #taking a token would leave less than none
+        else:
+            reason = None
+            full_at += interval
+            self._sessions[key] = sessions + 1
+            self.active += 1
+        if full_at > now or sessions or reason is None:
+            self._ips[key] = full_at
+        self._evict(now)
+
+        if reason is None:
+            self.stats['admitted'] += 1
+            return True
+        self.stats['dropped'] += 1
+        self.stats[reason] += 1
+        if self.stats['dropped'] % self.log_every == 1 or self.log_every == 1:
+            logging.info(f"Refusing connection from {ip} ({reason} limit), {self.stats['dropped']} refused so far")
+        return False
+
+    def release(self, ip):
+        #an admitted session ended
+        key = _key(ip)
+        sessions = self._sessions.pop(key, 0)
+        if not sessions:
+            return
+        self.active -= 1
+        if sessions > 1:
+            self._sessions[key] = sessions - 1
+
+    def _evict(self, now, budget=8):
+        #checks a few of the least recently seen entries per call
+        while self._ips and budget > 0:
+            budget -= 1
+            key, full_at = next(iter(self._ips.items()))
+            if key in self._sessions:
+                self._ips.move_to_end(key)  #long session, look at it again later
+                continue
+            if full_at > now and len(self._ips) <= self.max_ips:
+                break
+            del self._ips[key]
+            self.stats['evicted'] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['active'] = self.active
+        stats['tracked_ips'] = len(self._ips)
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Admission stats: {self.get_stats()}")
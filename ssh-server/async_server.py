@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import os
+import threading
+
+#Helpers for the asyncio server mode of ssh_server.py.
+#Paramiko is thread based, so these bridge its events and channels onto the event loop:
+#one coroutine per connection instead of one forked process.
+
+class LoopEvent(threading.Event):
+    #threading.Event that also wakes up coroutines awaiting it on an asyncio loop.
+    #Paramiko only ever calls set()/is_set() on the events we hand it.
+    def __init__(self, loop):
+        super().__init__()
+        self._loop = loop
+        self._waiters = set()
+
+    def set(self):
+        super().set()
+        try:
+            self._loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            pass  #loop already closed
+
+    def _wake(self):
+        for fut in self._waiters:
+            if not fut.done():
+                fut.set_result(True)
+
+    async def wait_async(self, timeout=None):
+        if self.is_set():
+            return True
+        fut = self._loop.create_future()
+        self._waiters.add(fut)
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        finally:
+            self._waiters.discard(fut)
+
+async def wait_shell_request(transport, shell_event, timeout, check_every=1.0):
+    #waits for the client to authenticate and request a shell, giving up early
+    #if the transport dies (auth failures, client gone) instead of sitting on the timeout
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        try:
+            await shell_event.wait_async(min(check_every, remaining))
+            return True
+        except asyncio.TimeoutError:
+            if not transport.is_active():
+                return False
+
+async def write_fd(fd, data):
+    #write to a non-blocking fd, yielding to the loop while the pty buffer is full
+    while data:
+        try:
+            written = os.write(fd, data)
+        except BlockingIOError:
+            await asyncio.sleep(0.01)
+            continue
+        data = data[written:]
+
+async def send_all(chan, data, limits=None, timeout=None, on_wait=None):
+    #chan.sendall() without blocking the loop: sends what the client's SSH window has room for and
+    #yields while it is full. Returns False if the channel closed, a limit was exceeded or timeout
+    #seconds went by before everything was sent. on_wait(True/False) brackets the waits, so the
+    #caller can stop reading the other side meanwhile.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    delay = 0.005
+    waiting = False
+    try:
+        while data:
+            if chan.closed:
+                return False
+            if chan.send_ready():
+                try:
+                    data = data[chan.send(data):]  #window open: returns without blocking
+                except OSError:
+                    return False  #closed in between
+                delay = 0.005
+                continue
+            if (limits is not None and limits.exceeded() is not None) or (deadline is not None and loop.time() >= deadline):
+                return False
+            if not waiting and on_wait is not None:
+                on_wait(True)
+            waiting = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return True
+    finally:
+        if waiting and on_wait is not None:
+            on_wait(False)
+
+async def relay(loop, master_fd, chan, bufsize=1024, limits=None):
+    #yields ('in', data) for what the client typed and ('out', data) for the shell output,
+    #forwarding both ways, then ('end', reason) when either side closes ('shell_exit',
+    #'client_closed') or when limits (a relay.SessionLimits) is exceeded (its reason)
+    ready = set()
+    wakeup = asyncio.Event()
+
+    def on_readable(direction):
+        ready.add(direction)
+        wakeup.set()
+
+    def watch(on):
+        #readers off while the client's window is full: the shell blocks on its pty instead of the loop spinning
+        if on:
+            loop.add_reader(master_fd, on_readable, 'out')
+            loop.add_reader(chan_fd, on_readable, 'in')
+        else:
+            loop.remove_reader(master_fd)
+            loop.remove_reader(chan_fd)
+
+    chan_fd = chan.fileno()
+    os.set_blocking(master_fd, False)  #readiness callbacks can fire for data already consumed
+    watch(True)
+    try:
+        while True:
+            if limits is not None:
+                reason = limits.exceeded()
+                if reason is not None:
+                    yield 'end', reason
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), limits.timeout())
+                except asyncio.TimeoutError:
+                    continue
+            else:
+                await wakeup.wait()
+            wakeup.clear()
+            if 'out' in ready:
+                ready.discard('out')
+                try:
+                    output = os.read(master_fd, bufsize)
+                except BlockingIOError:
+                    output = None
+                except OSError:
+                    output = b''  #EIO once the shell has exited
+                if output == b'':
+                    yield 'end', 'shell_exit'
+                    return
+                if output:
+                    if not await send_all(chan, output, limits, on_wait=lambda waiting: watch(not waiting)):
+                        reason = limits.exceeded() if limits is not None else None
+                        yield 'end', reason or 'client_closed'
+                        return
+                    if limits is not None:
+                        limits.output(len(output))
+                    yield 'out', output
+            if 'in' in ready:
+                ready.discard('in')
+                if chan.recv_ready() or chan.closed or chan.eof_received:
+                    data = chan.recv(bufsize)
+                    if not data:
+                        yield 'end', 'client_closed'
+                        return
+                    await write_fd(master_fd, data)
+                    if limits is not None:
+                        limits.input(len(data))
+                    yield 'in', data
+    finally:
+        watch(False)
+
+def _take_backlog(server_socket, start):
+    #connections already queued on the socket, which would be reset when it is closed
+    #(no more accepts after these: the slots they release don't matter anymore)
+    while True:
+        try:
+            client, addr = server_socket.accept()
+        except OSError:
+            return  #BlockingIOError: nothing left
+        start(client, addr)
+
+async def serve(server_sockets, handle, is_shutdown, max_connections=10000, on_accept=None, on_close=None, admit=None,
+                divert=None, is_draining=None):
+    #accept loop over every listening socket: one task per connection, no fork
+    #on_accept(addr, listener)/on_close(addr, listener) let the caller keep accept and active-session counts,
+    #listener being the index of the socket the connection came from in server_sockets
+    #admit(addr) returning False closes the connection right away, before on_accept
+    #divert(client, addr) returning True means it took the connection over (tarpit), checked first
+    #when the task is cancelled while is_draining() is true (graceful reload), the connections already
+    #queued are still taken, the sockets are closed and the open connections run to their end
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    slots = asyncio.Semaphore(max_connections)  #shared by all the listeners
+
+    def start(client, addr, listener):
+        if divert is not None and divert(client, addr):
+            slots.release()
+            return
+        if admit is not None and not admit(addr):
+            client.close()
+            slots.release()
+            return
+        logging.info('Connection from %s', addr)
+        if on_accept is not None:
+            on_accept(addr, listener)
+        task = asyncio.ensure_future(run(client, addr, listener))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def run(client, addr, listener):
+        try:
+            await handle(client, addr)
+        except Exception as e:
+            logging.error(f'Error: {e}')
+        finally:
+            client.close()
+            slots.release()
+            if on_close is not None:
+                on_close(addr, listener)
+
+    async def accept(listener):
+        server_socket = server_sockets[listener]
+        while not is_shutdown():
+            await slots.acquire()
+            try:
+                client, addr = await loop.sock_accept(server_socket)
+            except OSError as e:
+                slots.release()
+                logging.error(f'Error: {e}')
+                continue
+            start(client, addr, listener)
+
+    for server_socket in server_sockets:
+        server_socket.setblocking(False)
+    accepting = [asyncio.ensure_future(accept(listener)) for listener in range(len(server_sockets))]
+    try:
+        await asyncio.gather(*accepting)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for accept_task in accepting:
+            accept_task.cancel()
+        await asyncio.gather(*accepting, return_exceptions=True)
+        if is_draining is not None and is_draining():
+            for listener, server_socket in enumerate(server_sockets):
+                _take_backlog(server_socket, lambda client, addr: start(client, addr, listener))
+                server_socket.close()
+            logging.info(f"Draining {len(tasks)} open connections")
+        else:
+            for task in list(tasks):
+                task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
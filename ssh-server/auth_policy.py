@@ -0,0 +1,60 @@
+import logging
+import random
+
+import stats
+
+#Sensor mode: password attempts are answered from memory instead of PAM, so bots that only
+#try credentials cost a dictionary lookup. Every attempt is still logged by the caller.
+#With pam set, the attempts the policy lets through are checked with PAM as well (PAM then only
+#runs for the few sessions that may get a shell); otherwise they run as shell_user without PAM.
+#
+#Credentials file: one "username:password" pair per line, "*" matches anything on either side,
+#lines starting with # are ignored:
+#   root:123456
+#   admin:*
+
+WILDCARD = '*'
+
+def load_credentials(path):
+    pairs = set()
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            username, sep, password = line.partition(':')
+            if not sep:
+                logging.error(f"{path}:{number}: expected username:password, line ignored")
+                continue
+            pairs.add((username, password))
+    return pairs
+
+class SensorPolicy:
+    def __init__(self, accept_ratio=0.0, credentials=(), shell_user='froot', pam=False):
+        self.accept_ratio = accept_ratio    #share of the other attempts that are accepted (0.0 - 1.0)
+        self.credentials = set(credentials) #(username, password) pairs that are always accepted
+        self.shell_user = shell_user        #system user the accepted sessions' fshell runs as (without pam)
+        self.pam = pam                      #accepted attempts must pass PAM too
+        #counted by every server process (forked children authenticate in fork mode), created before forking
+        self.stats = stats.SharedCounters(['attempts', 'accepted', 'pam_checked', 'pam_accepted'])
+
+    def allows(self, username, password):
+        self.stats.add('attempts')
+        accepted = ((username, password) in self.credentials
+                    or (username, WILDCARD) in self.credentials
+                    or (WILDCARD, password) in self.credentials
+                    or (self.accept_ratio > 0 and random.random() < self.accept_ratio))
+        if accepted:
+            self.stats.add('accepted')
+        return accepted
+
+    def pam_checked(self, accepted):
+        self.stats.add('pam_checked')
+        if accepted:
+            self.stats.add('pam_accepted')
+
+    def get_stats(self):
+        return self.stats.snapshot()
+
+    def log_stats(self):
+        logging.info(f"Sensor policy stats: {self.get_stats()}")
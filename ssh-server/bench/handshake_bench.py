@@ -0,0 +1,132 @@
+#Measures SSH handshakes (banner + KEX, no auth) per second for each handshake profile.
+#Runs a paramiko server with the profile applied and paramiko clients on loopback, in this process.
+#
+#Usage (from ssh-server/):
+#   python bench/handshake_bench.py [--count 200] [--concurrency 8] [--profiles paramiko openssh fast]
+#
+#Uses the keys in key/ when present, otherwise throwaway RSA 2048 and Ed25519 keys.
+
+import argparse
+import io
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import handshake
+
+def throwaway_keys():
+    ed_key = ed25519.Ed25519PrivateKey.generate()
+    pem = ed_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption()
+    ).decode()
+    return {
+        'rsa': paramiko.RSAKey.generate(2048),
+        'ed25519': paramiko.Ed25519Key(file_obj=io.StringIO(pem)),
+    }
+
+def run_server(listener, profile, stop):
+    def serve(client):
+        transport = paramiko.Transport(client)
+        profile.apply(transport)
+        try:
+            transport.start_server(server=paramiko.ServerInterface())
+            transport.join(10)  #the client hangs up once KEX is done
+        except Exception:
+            pass
+        finally:
+            transport.close()
+
+    listener.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            client, _ = listener.accept()
+        except socket.timeout:
+            continue
+        threading.Thread(target=serve, args=(client,), daemon=True).start()
+
+def run_clients(port, count, concurrency):
+    lock = threading.Lock()
+    state = {'left': count, 'ok': 0, 'failed': 0, 'kex': None}
+    durations = []
+
+    def worker():
+        while True:
+            with lock:
+                if state['left'] == 0:
+                    return
+                state['left'] -= 1
+            start = time.perf_counter()
+            transport = None
+            try:
+                sock = socket.create_connection(('127.0.0.1', port))
+                transport = paramiko.Transport(sock)
+                transport.start_client(timeout=15)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    state['ok'] += 1
+                    state['kex'] = f"{transport.remote_version} / {transport.host_key_type}"
+                    durations.append(elapsed)
+            except Exception:
+                with lock:
+                    state['failed'] += 1
+            finally:
+                if transport is not None:
+                    transport.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, state, sorted(durations)
+
+def bench(name, host_keys, count, concurrency):
+    profile = handshake.HandshakeProfile(name, host_keys)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    stop = threading.Event()
+    server = threading.Thread(target=run_server, args=(listener, profile, stop), daemon=True)
+    server.start()
+    try:
+        run_clients(listener.getsockname()[1], min(count, concurrency), concurrency)  #warm up
+        elapsed, state, durations = run_clients(listener.getsockname()[1], count, concurrency)
+    finally:
+        stop.set()
+        server.join()
+        listener.close()
+
+    p50 = durations[len(durations) // 2] * 1000 if durations else 0
+    p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000 if durations else 0
+    print(f"{name:10} {state['ok'] / elapsed:8.1f} handshakes/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  "
+          f"failed {state['failed']}  ({state['kex']})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Handshakes/sec per handshake profile")
+    parser.add_argument("--count", type=int, default=200, help="Handshakes per profile")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--profiles", nargs="+", default=list(handshake.PROFILES), choices=list(handshake.PROFILES))
+    args = parser.parse_args()
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)  #clients hanging up after KEX is expected
+
+    try:
+        keys = handshake.load_host_keys('key')
+        if 'ed25519' not in keys:
+            keys['ed25519'] = throwaway_keys()['ed25519']
+    except FileNotFoundError:
+        keys = throwaway_keys()
+
+    print(f"{args.count} handshakes per profile, {args.concurrency} concurrent clients (client and server in this process)")
+    for name in args.profiles:
+        bench(name, keys, args.count, args.concurrency)
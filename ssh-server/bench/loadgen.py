@@ -0,0 +1,701 @@
+#Drives a local SSH server with many concurrent fake bots and reports what it could take: handshakes/sec,
+#auth latency, time to first prompt, DB write lag (login attempt answered -> row in login_attempts)
+#and memory per open session. Everything runs on this machine:
+#- ssh_server.py is started in a subprocess, on a free loopback port, in the --mode given;
+#- the database is a SQLite file standing in for MariaDB (pymysql.connect is replaced in the server
+#  process only), or the MariaDB of .env / DB_* with --db mariadb;
+#- geolocation (GEO_API_URL) and dashboard notifications (DASHBOARD_URL) go to a stub HTTP server here;
+#- bots connect from many 127.x.y.z addresses (all routed to lo on Linux), so that per-IP admission
+#  limits apply the way they do with real bots.
+#
+#Usage (from ssh-server/):
+#   python bench/loadgen.py [--mode fork|async|prefork] [--count 500] [--rate 50] [--concurrency 64]
+#                           [--credentials creds.txt] [--attempts 3] [--shell-ratio 0.1] [--commands script.txt]
+#                           [--hold 5] [--fshell /usr/bin/fshell] [--shell-user froot] [-- extra server arguments]
+#
+#Bots try --attempts pairs from --credentials (username:password lines, as for SENSOR_CREDENTIALS), and a
+#--shell-ratio share of them then logs in with --login, opens a shell, runs the --commands script (one
+#command per line, after each prompt) and stays --hold seconds before "exit". The server runs with --sensor
+#and only --login accepted, unless --auth pam (then --login must be a real account). Admission limits
+#(ADMIT_*) and every other server setting come from the environment, as for the real server.
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import re
+import runpy
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import defaultdict, deque
+
+import paramiko
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SERVER_DIR)
+import auth_policy
+
+DEFAULT_CREDENTIALS = [('root', '123456'), ('root', 'root'), ('admin', 'admin'), ('root', 'password'),
+                       ('ubuntu', 'ubuntu'), ('user', '1234'), ('pi', 'raspberry'), ('test', 'test')]
+DEFAULT_COMMANDS = ['uname -a', 'whoami', 'cat /proc/cpuinfo | grep name | wc -l', 'free -m', 'ls -la /tmp']
+PROMPTS = (b'$ ', b'# ')  #fshell prompt endings (user / root)
+PHASES = ('banner', 'kex', 'auth', 'db_write', 'db_batch', 'geolocation', 'spawn')  #ssh_server.PHASES
+POLL_INTERVAL = 0.05  #seconds between two reads of login_attempts
+
+#MariaDB tables of setup/mariadb_tables.txt, in SQLite
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS connections (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, ip TEXT NOT NULL, pseudo_id TEXT NOT NULL, duration INTEGER,
+    status BOOLEAN NOT NULL DEFAULT 0, end_reason TEXT, cpu_seconds REAL, peak_rss_kb INTEGER, port INTEGER,
+    fingerprint_id INTEGER, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS user_commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, connection_id INTEGER NOT NULL, command TEXT NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS ip_geolocations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, ip TEXT NOT NULL UNIQUE, country TEXT, country_code TEXT, region TEXT,
+    city TEXT, lat REAL, lon REAL, fetched_at DATETIME DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS login_attempts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, ip TEXT NOT NULL, username TEXT NOT NULL, password TEXT NOT NULL,
+    attempt_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP, status BOOLEAN NOT NULL DEFAULT 0, fingerprint_id INTEGER);
+CREATE TABLE IF NOT EXISTS client_fingerprints (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, hassh TEXT NOT NULL, version TEXT NOT NULL, kex_algorithms TEXT,
+    host_key_algorithms TEXT, ciphers TEXT, macs TEXT, compression TEXT,
+    first_seen DATETIME DEFAULT CURRENT_TIMESTAMP, UNIQUE (hassh, version));
+"""
+
+#--- server side: the SQLite stand-in for pymysql, used in the server process only ---
+
+def to_sqlite(sql):
+    #the MariaDB statements of the server, in SQLite syntax
+    sql = sql.replace('%s', '?')
+    sql = sql.replace("NOW() - INTERVAL ? SECOND", "datetime('now', '-' || ? || ' seconds')")
+    sql = sql.replace('NOW()', 'CURRENT_TIMESTAMP')
+    head, sep, updates = sql.partition('ON DUPLICATE KEY UPDATE')
+    if not sep:
+        return sql, False
+    if 'LAST_INSERT_ID(id)' in updates:
+        return head + 'ON CONFLICT DO UPDATE SET id = id RETURNING id', True  #id of the new or existing row
+    return head + 'ON CONFLICT DO UPDATE SET' + re.sub(r"VALUES\((\w+)\)", r"excluded.\1", updates), False
+
+class ForkGuard:
+    #a fork while another thread is inside sqlite would leave its mutexes locked in the child: the
+    #stand-in's calls run inside the guard, and os.fork() in the server process waits until none is running
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._running = 0
+
+    def __enter__(self):
+        with self._cond:
+            self._running += 1
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def before_fork(self):
+        self._cond.acquire()  #held through the fork: no new call starts meanwhile
+        self._cond.wait_for(lambda: self._running == 0)
+
+    def after_fork(self):
+        self._cond.release()
+
+_sqlite_guard = ForkGuard()
+
+class SQLiteCursor:
+    def __init__(self, connection):
+        with _sqlite_guard:
+            self._cursor = connection.cursor()
+        self.lastrowid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with _sqlite_guard:
+            self._cursor.close()
+
+    def execute(self, sql, args=None):
+        import pymysql
+        sql, returning = to_sqlite(sql)
+        try:
+            with _sqlite_guard:
+                self._cursor.execute(sql, tuple(args or ()))
+                self.lastrowid = self._cursor.fetchall()[0][0] if returning else self._cursor.lastrowid
+        except sqlite3.Error as e:
+            raise pymysql.err.OperationalError(0, str(e)) from e  #caught like MariaDB errors
+
+    def executemany(self, sql, rows):
+        import pymysql
+        try:
+            with _sqlite_guard:
+                self._cursor.executemany(to_sqlite(sql)[0], [tuple(row) for row in rows])
+        except sqlite3.Error as e:
+            raise pymysql.err.OperationalError(0, str(e)) from e
+
+    def _row(self, row):
+        return dict(zip([column[0] for column in self._cursor.description], row))  #DictCursor
+
+    def fetchone(self):
+        with _sqlite_guard:
+            row = self._cursor.fetchone()
+        return self._row(row) if row is not None else None
+
+    def fetchall(self):
+        with _sqlite_guard:
+            rows = self._cursor.fetchall()
+        return [self._row(row) for row in rows]
+
+class SQLiteConnection:
+    def __init__(self, path):
+        with _sqlite_guard:
+            self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)  #pooled across threads
+
+    def cursor(self):
+        return SQLiteCursor(self._connection)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def commit(self):
+        with _sqlite_guard:
+            self._connection.commit()
+
+    def rollback(self):
+        with _sqlite_guard:
+            self._connection.rollback()
+
+    def close(self):
+        with _sqlite_guard:
+            self._connection.close()
+
+def run_server(db_path, server_args):
+    #entry point of the server subprocess: ssh_server.py with pymysql.connect opening db_path instead
+    import pymysql
+    if db_path:
+        pymysql.connect = lambda **kwargs: SQLiteConnection(db_path)
+        os.register_at_fork(before=_sqlite_guard.before_fork, after_in_parent=_sqlite_guard.after_fork,
+                            after_in_child=_sqlite_guard.after_fork)
+    os.chdir(SERVER_DIR)
+    sys.argv = [os.path.join(SERVER_DIR, 'ssh_server.py')] + server_args
+    runpy.run_path(sys.argv[0], run_name='__main__')
+
+#--- bench side ---
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    #ip-api.com batch endpoint (every IP found) and the dashboard's /notify_status
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/batch'):
+            time.sleep(self.server.geo_delay)
+            ips = json.loads(body or b'[]')
+            with self.server.lock:
+                self.server.geo_batches += 1
+                self.server.geo_ips += len(ips)
+            reply = [{'status': 'success', 'query': ip, 'country': 'Loopback', 'countryCode': 'LO',
+                      'regionName': 'Bench', 'city': 'Bench', 'lat': 0.0, 'lon': 0.0} for ip in ips]
+        else:
+            reply = {}
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub(geo_delay):
+    stub = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    stub.daemon_threads = True
+    stub.geo_delay = geo_delay
+    stub.lock = threading.Lock()
+    stub.geo_batches = stub.geo_ips = 0
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    return stub
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.latencies = defaultdict(list)  #seconds per step: handshake, auth, prompt
+        self.active_shells = 0
+        self.peak_shells = 0
+        self.started_at = None     #perf_counter() of the first connection
+        self.handshakes_done = None  #and of the last handshake completed
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def observe(self, step, seconds):
+        with self.lock:
+            self.latencies[step].append(seconds)
+
+    def handshake(self, start):
+        now = time.perf_counter()
+        with self.lock:
+            self.counts['handshakes'] += 1
+            self.latencies['handshake'].append(now - start)
+            self.handshakes_done = now
+
+    def shell_opened(self):
+        with self.lock:
+            self.active_shells += 1
+            self.peak_shells = max(self.peak_shells, self.active_shells)
+
+    def shell_closed(self):
+        with self.lock:
+            self.active_shells -= 1
+
+class WriteLag:
+    #time from a login attempt's answer to its row in login_attempts, matched by (source ip, password) in order
+    RECHECK = 1000  #ids below the newest one read again: concurrent transactions may commit out of id order
+
+    def __init__(self, connect, placeholder='?'):
+        self.connect = connect
+        self.placeholder = placeholder
+        self.lock = threading.Lock()
+        self.sent = defaultdict(deque)  #(ip, password) -> answer times not matched yet
+        self.early = defaultdict(int)   #(ip, password) -> rows read before the bot got the answer
+        self.seen = set()
+        self.expected = 0
+        self.lags = []
+        self.stop = threading.Event()
+        self._thread = None
+
+    def answered(self, ip, password):
+        with self.lock:
+            self.expected += 1
+            if self.early[(ip, password)]:
+                self.early[(ip, password)] -= 1
+                self.lags.append(0.0)  #written before the answer reached the bot
+            else:
+                self.sent[(ip, password)].append(time.monotonic())
+
+    def start(self):
+        self._connection = self.connect()
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM login_attempts")
+        self.first_id = self.last_id = cursor.fetchone()[0]
+        cursor.close()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self.stop.wait(POLL_INTERVAL):
+            self.poll()
+
+    def poll(self):
+        cursor = self._connection.cursor()
+        cursor.execute(f"SELECT id, ip, password FROM login_attempts WHERE id > {self.placeholder} ORDER BY id",
+                       (max(self.first_id, self.last_id - self.RECHECK),))
+        rows = cursor.fetchall()
+        cursor.close()
+        now = time.monotonic()
+        with self.lock:
+            for row_id, ip, password in rows:
+                if row_id in self.seen:
+                    continue
+                self.seen.add(row_id)
+                self.last_id = max(self.last_id, row_id)
+                sent = self.sent.get((ip, password))
+                if sent:
+                    self.lags.append(now - sent.popleft())
+                else:
+                    self.early[(ip, password)] += 1
+
+    def wait(self, timeout):
+        #until every answered attempt has its row, or timeout
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and len(self.lags) < self.expected:
+            time.sleep(POLL_INTERVAL)
+        self.stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._connection.close()
+
+def sqlite_lag(path):
+    return WriteLag(lambda: sqlite3.connect(path, isolation_level=None, check_same_thread=False))
+
+def mariadb_lag():
+    import pymysql
+    return WriteLag(lambda: pymysql.connect(host=os.getenv('DB_HOST'), user=os.getenv('DB_USER'),
+                                            password=os.getenv('DB_PASSWORD'), database=os.getenv('DB_NAME'),
+                                            autocommit=True),  #every poll sees the new rows
+                    placeholder='%s')
+
+def process_tree(pid):
+    #pid and all its descendants
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    children[int(f.read().rsplit(')', 1)[1].split()[1])].append(int(entry))
+            except (OSError, IndexError):
+                continue
+    pids, todo = [], [pid]
+    while todo:
+        pids.append(todo.pop())
+        todo.extend(children.get(pids[-1], ()))
+    return pids
+
+def memory_kb(pid):
+    #(RSS, PSS) of the process tree in kB; PSS counts the pages forked processes share once
+    rss = pss = 0
+    for child in process_tree(pid):
+        try:
+            with open(f'/proc/{child}/smaps_rollup') as f:
+                fields = dict(line.split(':', 1) for line in f if line.startswith(('Rss:', 'Pss:')))
+            rss += int(fields['Rss'].split()[0])
+            pss += int(fields['Pss'].split()[0])
+        except (OSError, KeyError):
+            try:
+                with open(f'/proc/{child}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            rss += int(line.split()[1])
+                            pss += int(line.split()[1])
+            except OSError:
+                pass  #exited in between
+    return rss, pss
+
+def sample_memory(pid, results, samples, stop):
+    while not stop.wait(0.5):
+        with results.lock:
+            active = results.active_shells
+        samples.append((active, *memory_kb(pid)))
+
+def read_until_prompt(chan, timeout):
+    chan.settimeout(timeout)
+    tail = b''
+    while True:
+        data = chan.recv(4096)
+        if not data:
+            raise EOFError("shell closed")
+        tail = (tail + data)[-64:]
+        if tail.rstrip(b'\r\n').endswith(PROMPTS) or tail.endswith(PROMPTS):
+            return
+
+def try_password(transport, ip, username, password, results, lag):
+    start = time.perf_counter()
+    try:
+        transport.auth_password(username, password)
+        accepted = True
+    except paramiko.AuthenticationException:
+        accepted = False
+    results.observe('auth', time.perf_counter() - start)
+    results.add('auth_attempts')
+    lag.answered(ip, password)
+    return accepted
+
+def run_bot(number, config, results, lag):
+    rng = random.Random(f"{config.seed}-{number}")
+    source = config.sources[number % len(config.sources)]
+    opens_shell = rng.random() < config.shell_ratio
+    transport = None
+    try:
+        start = time.perf_counter()
+        sock = socket.create_connection(('127.0.0.1', config.port), timeout=config.timeout, source_address=(source, 0))
+        transport = paramiko.Transport(sock)
+        transport.start_client(timeout=config.timeout)
+        results.handshake(start)
+
+        #one username per connection (servers refuse a change in mid-flight), its passwords from the list
+        username = config.login[0] if opens_shell else rng.choice(config.credentials)[0]
+        passwords = ([p for u, p in config.credentials if u == username and p != config.login[1]]
+                     or [p for _, p in config.credentials if p != config.login[1]] or ['x'])
+        for _ in range(config.attempts):
+            if try_password(transport, source, username, rng.choice(passwords), results, lag):
+                results.add('accepted')  #not expected: only --login is accepted
+                return
+        if not opens_shell:
+            return
+        if not try_password(transport, source, config.login[0], config.login[1], results, lag):
+            results.add('login_refused')
+            return
+
+        chan = transport.open_session(timeout=config.timeout)
+        chan.get_pty(width=80, height=24)
+        chan.invoke_shell()
+        results.shell_opened()
+        try:
+            start = time.perf_counter()
+            read_until_prompt(chan, config.timeout)
+            results.observe('prompt', time.perf_counter() - start)
+            for command in config.commands:
+                time.sleep(config.think)
+                chan.sendall(command.encode() + b'\n')
+                read_until_prompt(chan, config.timeout)
+                results.add('commands')
+            time.sleep(config.hold)
+            chan.sendall(b'exit\n')
+            while chan.recv(4096):
+                pass
+            results.add('shells')
+        finally:
+            results.shell_closed()
+    except Exception as e:
+        results.add('failed')
+        logging.debug(f"bot {number} from {source}: {e!r}")
+    finally:
+        if transport is not None:
+            transport.close()
+
+def drive(config, results, lag):
+    #starts bots at config.rate per second (0: as fast as slots free up), at most config.concurrency at once
+    slots = threading.BoundedSemaphore(config.concurrency)
+
+    def bot(number):
+        try:
+            run_bot(number, config, results, lag)
+        finally:
+            slots.release()
+
+    start = results.started_at = time.perf_counter()
+    for number in range(config.count):
+        if config.duration and time.perf_counter() - start >= config.duration:
+            break
+        if config.rate:
+            delay = start + number / config.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        slots.acquire()
+        results.add('started')
+        threading.Thread(target=bot, args=(number,), daemon=True).start()
+    for _ in range(config.concurrency):
+        slots.acquire()  #every bot is done
+    return time.perf_counter() - start
+
+def scrape(metrics_port):
+    #{metric line without value: value} from the server's /metrics, {} if it can't be read
+    try:
+        text = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5).read().decode()
+    except OSError:
+        return {}
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+def phase_quantile(samples, phase, q):
+    #upper bound of the honeypot_phase_seconds bucket holding the q quantile
+    buckets = []
+    for key, count in samples.items():
+        match = re.match(r'honeypot_phase_seconds_bucket\{phase="(\w+)",le="([^"]+)"\}', key)
+        if match and match.group(1) == phase:
+            buckets.append((float(match.group(2)), count))
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+    for le, count in buckets:
+        if count >= total * q:
+            return le
+    return float('nan')
+
+def ms(seconds):
+    return f"{seconds * 1000:7.1f} ms"
+
+def report(config, elapsed, results, lag, stub, baseline, samples, metrics):
+    counts = results.counts
+    latencies = results.latencies
+    print(f"{config.mode} mode, {counts['started']} bots in {elapsed:.1f} s "
+          f"(rate {config.rate or 'max'}/s, concurrency {config.concurrency}, {len(config.sources)} source IPs, "
+          f"{config.shell_ratio:.0%} open a shell)")
+    rejected = {reason: int(metrics.get(f'honeypot_connections_rejected_total{{reason="{reason}"}}', 0))
+                for reason in ('admission', 'denied', 'tarpit')}
+    print(f"connections   {counts['handshakes']} handshakes, {counts['failed']} bots failed "
+          f"(rejected by the server: {', '.join(f'{r} {n}' for r, n in rejected.items())})")
+    window = results.handshakes_done - results.started_at if results.handshakes_done else float('nan')
+    print(f"handshakes    {counts['handshakes'] / window:8.1f} /s        p50 {ms(percentile(latencies['handshake'], 0.5))}"
+          f"  p99 {ms(percentile(latencies['handshake'], 0.99))}")
+    print(f"auth          {counts['auth_attempts']:8} attempts  p50 {ms(percentile(latencies['auth'], 0.5))}"
+          f"  p99 {ms(percentile(latencies['auth'], 0.99))}")
+    print(f"shell         {counts['shells']:8} sessions  first prompt p50 {ms(percentile(latencies['prompt'], 0.5))}"
+          f"  p99 {ms(percentile(latencies['prompt'], 0.99))}  ({counts['commands']} commands, "
+          f"peak {results.peak_shells} open)")
+    print(f"db write lag  {len(lag.lags)}/{lag.expected} rows  p50 {ms(percentile(lag.lags, 0.5))}"
+          f"  p99 {ms(percentile(lag.lags, 0.99))}  (login_attempts, {POLL_INTERVAL * 1000:.0f} ms polling)")
+
+    rss0, pss0 = baseline
+    print(f"memory        {rss0 / 1024:.1f} MB RSS / {pss0 / 1024:.1f} MB PSS idle", end='')
+    busiest = max(samples, key=lambda sample: sample[0], default=(0, 0, 0))
+    active, rss, pss = busiest
+    if active:
+        print(f", {active} sessions open: {(rss - rss0) / active / 1024:.2f} MB RSS, "
+              f"{(pss - pss0) / active / 1024:.2f} MB PSS per session")
+    else:
+        print(", no session open while sampled")
+
+    if metrics:
+        print("server phases (from /metrics: mean, p99 bucket)")
+        for phase in PHASES:
+            count = metrics.get(f'honeypot_phase_seconds_count{{phase="{phase}"}}', 0)
+            if count:
+                mean = metrics[f'honeypot_phase_seconds_sum{{phase="{phase}"}}'] / count
+                print(f"  {phase:12} {int(count):8}  mean {ms(mean)}  p99 <= {ms(phase_quantile(metrics, phase, 0.99))}")
+    print(f"geolocation   {stub.geo_batches} batches, {stub.geo_ips} IPs sent to the stub")
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\r\n') for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+def host_key_env(workdir):
+    #throwaway RSA host key when the server has none of its own
+    if (os.getenv('HOST_KEY_RSA') or os.getenv('HOST_KEY_ED25519')
+            or any(os.path.exists(os.path.join(SERVER_DIR, 'key', name)) for name in ('serv_rsa.key', 'serv_ed25519.key'))):
+        return {}
+    path = os.path.join(workdir, 'serv_rsa.key')
+    paramiko.RSAKey.generate(2048).write_private_key_file(path)
+    return {'HOST_KEY_RSA': path}
+
+def start_server(config, workdir, db_path, stub):
+    env = dict(os.environ,
+               GEO_API_URL=f"http://127.0.0.1:{stub.server_port}/batch",
+               DASHBOARD_URL=f"http://127.0.0.1:{stub.server_port}",
+               LOG_FILE=os.path.join(workdir, 'server.log'),
+               LOG_DIR=workdir,
+               TTYREC_DIR=os.path.join(workdir, 'ttyrec'),
+               GEO_CACHE_PATH=os.path.join(workdir, 'geo_cache.sqlite'),
+               FSHELL_PATH=config.fshell,
+               **host_key_env(workdir))
+    if db_path:
+        env.update(DB_HOST='localhost', DB_USER='loadgen', DB_PASSWORD='loadgen', DB_NAME=db_path)  #checked, not used
+    server_args = ['--mode', config.mode, '--listen', f"127.0.0.1:{config.port}",
+                   '--metrics-port', str(config.metrics_port), '--no-console']
+    if config.auth == 'sensor':
+        credentials = os.path.join(workdir, 'accept.txt')
+        with open(credentials, 'w') as f:
+            f.write(f"{config.login[0]}:{config.login[1]}\n")
+        env.update(SENSOR_CREDENTIALS=credentials, SENSOR_ACCEPT_RATIO='0', SENSOR_SHELL_USER=config.shell_user)
+        server_args.append('--sensor')
+    output = open(os.path.join(workdir, 'server.out'), 'wb')
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run-server', db_path, '--']
+                               + server_args + config.server_args,
+                               cwd=SERVER_DIR, env=env, stdout=output, stderr=subprocess.STDOUT)
+    output.close()
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', config.port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    with open(os.path.join(workdir, 'server.out'), errors='replace') as f:
+        sys.exit(f"The server did not start:\n{f.read()[-2000:]}")
+
+def stop_server(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run-server']:
+        run_server(sys.argv[2], sys.argv[4:])  #started by the bench itself: DB path, '--', server arguments
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Load test of the SSH server with concurrent fake bots")
+    parser.add_argument("--mode", choices=["fork", "async", "prefork"], default="fork", help="Server mode")
+    parser.add_argument("--count", type=int, default=500, help="Bots (connections) in total")
+    parser.add_argument("--duration", type=float, default=0, help="Stop starting bots after this many seconds")
+    parser.add_argument("--rate", type=float, default=50, help="New connections per second, 0: as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=64, help="Bots connected at the same time, at most")
+    parser.add_argument("--sources", type=int, default=200, help="Source IPs (127.1.x.y) the bots are spread over")
+    parser.add_argument("--credentials", help="username:password per line (default: a few common pairs)")
+    parser.add_argument("--attempts", type=int, default=3, help="Refused passwords tried by each bot")
+    parser.add_argument("--shell-ratio", type=float, default=0.1, help="Share of bots that log in and open a shell")
+    parser.add_argument("--login", default="root:loadgen", help="username:password the shell bots log in with")
+    parser.add_argument("--commands", help="Command script, one command per line (default: a short recon script)")
+    parser.add_argument("--think", type=float, default=0.2, help="Seconds between two commands")
+    parser.add_argument("--hold", type=float, default=0, help="Seconds a shell stays open after the script")
+    parser.add_argument("--timeout", type=float, default=15, help="Seconds for each handshake, login and command")
+    parser.add_argument("--auth", choices=["sensor", "pam"], default="sensor",
+                        help="sensor: only --login accepted, no PAM; pam: the server's PAM setup")
+    parser.add_argument("--fshell", default=os.getenv('FSHELL_PATH', '/usr/bin/fshell'), help="Shell of the sessions")
+    parser.add_argument("--shell-user", default=os.getenv('SENSOR_SHELL_USER', 'froot'),
+                        help="System user the shells run as (--auth sensor)")
+    parser.add_argument("--db", choices=["sqlite", "mariadb"], default="sqlite",
+                        help="sqlite: throwaway SQLite file; mariadb: the database of .env / DB_*")
+    parser.add_argument("--geo-delay", type=float, default=0, help="Seconds the geolocation stub takes per batch")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the bots' random choices")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory (server log, SQLite file)")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="-- then extra ssh_server.py arguments")
+    config = parser.parse_args()
+    config.server_args = [arg for arg in config.server_args if arg != '--']
+    config.credentials = (sorted(auth_policy.load_credentials(config.credentials)) if config.credentials
+                          else DEFAULT_CREDENTIALS)
+    config.commands = read_lines(config.commands) if config.commands else DEFAULT_COMMANDS
+    username, sep, password = config.login.partition(':')
+    if not sep or not config.credentials:
+        parser.error("--login is username:password and --credentials needs at least one pair")
+    config.login = (username, password)
+    config.sources = [f"127.1.{n // 250}.{n % 250 + 1}" for n in range(max(1, config.sources))]
+    config.port = free_port()
+    config.metrics_port = free_port()
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)  #refused logins and closed sessions are expected
+
+    workdir = tempfile.mkdtemp(prefix='honeypot-loadgen-')
+    db_path = ''
+    if config.db == 'sqlite':
+        db_path = os.path.join(workdir, 'honeypot.sqlite')
+        with sqlite3.connect(db_path) as db:
+            db.execute("PRAGMA journal_mode=WAL")  #the poller reads while the server processes write
+            db.executescript(SQLITE_SCHEMA)
+        lag = sqlite_lag(db_path)
+    else:
+        from dotenv import load_dotenv
+        load_dotenv(os.path.join(SERVER_DIR, '.env'))
+        lag = mariadb_lag()
+
+    stub = start_stub(config.geo_delay)
+    server = start_server(config, workdir, db_path, stub)
+    results = Results()
+    try:
+        time.sleep(1)  #server settled (prefork workers started)
+        baseline = memory_kb(server.pid)
+        samples = []
+        stop_sampling = threading.Event()
+        sampler = threading.Thread(target=sample_memory, args=(server.pid, results, samples, stop_sampling), daemon=True)
+        lag.start()
+        sampler.start()
+        elapsed = drive(config, results, lag)
+        stop_sampling.set()
+        sampler.join()
+        lag.wait(timeout=10)
+        metrics = scrape(config.metrics_port)
+    finally:
+        stop_server(server)
+        stub.shutdown()
+
+    report(config, elapsed, results, lag, stub, baseline, samples, metrics)
+    if config.keep:
+        print(f"work directory: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
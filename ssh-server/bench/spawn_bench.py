@@ -0,0 +1,107 @@
+#Measures time to first prompt when starting fshell for a session, for each spawn method:
+#   preexec  the previous path: subprocess.Popen with a Python preexec_fn dropping privileges
+#   direct   spawner.spawn(): privileges dropped by subprocess itself (user=, group=, umask=)
+#   pool     spawner.ShellPool.take(): a warm launcher bound to the session (refills not timed)
+#
+#Usage (from ssh-server/, as root to include the privilege drop):
+#   python bench/spawn_bench.py [--count 100] [--user froot] [--shell /usr/bin/fshell] [--methods preexec direct pool]
+
+import argparse
+import grp
+import os
+import pty
+import pwd
+import select
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import spawner
+
+PROMPTS = (b'$ ', b'# ')  #fshell prompt endings (user / root)
+
+def spawn_preexec(shell_path, username, ip, env):
+    def drop_privileges():
+        if os.getuid() != 0:
+            return
+        os.setgid(grp.getgrnam(username).gr_gid)
+        os.setgroups([])
+        os.setuid(pwd.getpwnam(username).pw_uid)
+        os.umask(0o077)
+
+    master_fd, slave_fd = pty.openpty()
+    try:
+        process = subprocess.Popen([shell_path], stdin=slave_fd, stdout=slave_fd, stderr=slave_fd,
+                                   env=dict(env, SSH_CLIENT_IP=ip), preexec_fn=drop_privileges, close_fds=True)
+    finally:
+        os.close(slave_fd)
+    return process, master_fd
+
+def wait_prompt(master_fd, timeout=5):
+    #reads the shell output until it ends with a prompt, returns False on timeout or EOF
+    output = b''
+    deadline = time.perf_counter() + timeout
+    while True:
+        left = deadline - time.perf_counter()
+        if left <= 0 or not select.select([master_fd], [], [], left)[0]:
+            return False
+        try:
+            data = os.read(master_fd, 4096)
+        except OSError:
+            return False
+        if not data:
+            return False
+        output += data
+        if output.endswith(PROMPTS):
+            return True
+
+def stop(process, master_fd):
+    os.close(master_fd)
+    process.kill()  #interactive shells ignore SIGTERM
+    process.wait()
+
+def bench(method, count, shell_path, username, env):
+    pool = None
+    if method == 'pool':
+        pool = spawner.ShellPool(shell_path, env, size=1)
+        pool.fill(username)
+
+    durations = []
+    failed = 0
+    for i in range(count):
+        ip = f"198.51.100.{i % 250 + 1}"
+        start = time.perf_counter()
+        if method == 'preexec':
+            process, master_fd = spawn_preexec(shell_path, username, ip, env)
+        elif method == 'direct':
+            process, master_fd = spawner.spawn(shell_path, username, ip, env)
+        else:
+            process, master_fd = pool.take(username, ip)
+        if wait_prompt(master_fd):
+            durations.append(time.perf_counter() - start)
+        else:
+            failed += 1
+        stop(process, master_fd)
+        if pool is not None:
+            pool.fill(username)  #warm shell for the next session, outside the measurement
+
+    if pool is not None:
+        pool.close()
+    durations.sort()
+    p50 = durations[len(durations) // 2] * 1000 if durations else 0
+    p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000 if durations else 0
+    print(f"{method:8} p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  failed {failed}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time to first prompt per fshell spawn method")
+    parser.add_argument("--count", type=int, default=100, help="Shells started per method")
+    parser.add_argument("--user", default='froot', help="User the shells run as (when running as root)")
+    parser.add_argument("--shell", default=os.getenv('FSHELL_PATH', '/usr/bin/fshell'), help="Shell to start")
+    parser.add_argument("--methods", nargs="+", default=['preexec', 'direct', 'pool'], choices=['preexec', 'direct', 'pool'])
+    args = parser.parse_args()
+
+    env = dict(os.environ, LOG_DIR=os.getenv('LOG_DIR', '/var/log/analytics'))
+    print(f"{args.count} shells per method ({args.shell} as {args.user if os.getuid() == 0 else 'the current user'})")
+    for method in args.methods:
+        bench(method, args.count, args.shell, args.user, env)
@@ -0,0 +1,150 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+
+#Small per-process pool of pymysql connections shared by the ssh_server.py write helpers.
+#Connections are never shared across a fork: the child drops what it inherited and
+#opens its own connections lazily on first use.
+
+class ConnectionPool:
+    def __init__(self, connect, max_size=4, max_idle=300, check_after=30, wait_timeout=10):
+        self.connect = connect            #factory returning a new pymysql connection
+        self.max_size = max_size          #max connections open at once in this process
+        self.max_idle = max_idle          #seconds before an idle connection is evicted
+        self.check_after = check_after    #seconds idle before a ping is done on checkout
+        self.wait_timeout = wait_timeout  #seconds to wait for a free connection
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        #called at init and in forked children: the inherited sockets belong to the parent,
+        #so we forget them without sending COM_QUIT on them
+        self._pid = os.getpid()
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'reconnects': 0, 'evictions': 0, 'discards': 0}
+        self._cond = threading.Condition()
+        self._idle = []  #list of (connection, last_used) with the most recently used last
+        self._open = 0
+
+    def _evict_idle(self, now):
+        #called with the condition held
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.pop(0)
+            self._open -= 1
+            self.stats['evictions'] += 1
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, last_used, now):
+        if now - last_used < self.check_after:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        if os.getpid() != self._pid:
+            self._reset()
+
+        deadline = time.monotonic() + self.wait_timeout
+        with self._cond:
+            waited = False
+            while True:
+                now = time.monotonic()
+                self._evict_idle(now)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._open < self.max_size:
+                    self._open += 1
+                    conn = None
+                    break
+                if not waited:
+                    self.stats['waits'] += 1
+                    waited = True
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise pymysql.err.OperationalError(2013, "Timed out waiting for a pooled database connection")
+                self._cond.wait(remaining)
+
+        if conn is None:
+            self.stats['misses'] += 1
+            return self._new_connection()
+
+        if self._healthy(conn, last_used, time.monotonic()):
+            self.stats['hits'] += 1
+            return conn
+
+        #stale connection (server restart, wait_timeout expired...): replace it
+        self.stats['reconnects'] += 1
+        self._close(conn)
+        return self._new_connection()
+
+    def _new_connection(self):
+        try:
+            return self.connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        if os.getpid() != self._pid:
+            return  #connection checked out before a fork, let it go
+        with self._cond:
+            if discard:
+                self._open -= 1
+                self.stats['discards'] += 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except pymysql.Error:
+            #the connection may be in an unknown state after a DB error, don't reuse it
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                self.release(conn, discard=True)
+                raise
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._open -= 1
+                self._close(conn)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['open'] = self._open
+            stats['idle'] = len(self._idle)
+        return stats
+
+    def log_stats(self):
+        logging.info(f"DB pool stats: {self.get_stats()}")
@@ -0,0 +1,145 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import pymysql
+
+#Background writer for high volume events (login attempts, commands).
+#Callers only put a row on a bounded queue; a dedicated thread drains it and writes
+#each batch with one executemany() per statement and a single COMMIT (group commit).
+#Work a row needs before it can be written (e.g. looking an id up) is done there too, per batch,
+#by the prepare function of its kind, so that it stays off the caller's path.
+
+class EventWriter:
+    def __init__(self, pool, statements, max_queue=10000, batch_size=200, flush_interval=0.5, on_batch=None,
+                 prepare=None):
+        self.pool = pool                      #db_pool.ConnectionPool used for the writes
+        self.statements = statements          #event kind -> INSERT statement
+        self.prepare = prepare or {}          #event kind -> function(rows) returning the rows to insert
+        self.max_queue = max_queue            #events kept in memory before dropping
+        self.batch_size = batch_size          #flush as soon as this many events are pending
+        self.flush_interval = flush_interval  #or after this many seconds
+        self.on_batch = on_batch              #called with the seconds each batch write took
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        #the writer thread doesn't survive a fork, and the parent's pending events are its own
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.stats = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'batches': 0}
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, kind, row):
+        #never blocks: when the queue is full the event is counted and dropped
+        if os.getpid() != self._pid:
+            self._reset()
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((kind, row))
+            self.stats['queued'] += 1
+            return True
+        except queue.Full:
+            self.stats['dropped'] += 1
+            if self.stats['dropped'] % 1000 == 1:
+                logging.error(f"Event queue full, {self.stats['dropped']} events dropped so far")
+            return False
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                event = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                event = None
+            if event is None:  #timeout, or wake-up sent by close()
+                if self._stopping and self._queue.empty():
+                    return
+                continue
+            batch.append(event)
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopping:
+                    #when stopping, only take what is already queued
+                    try:
+                        event = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                else:
+                    try:
+                        event = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if event is None:
+                    break
+                batch.append(event)
+
+            self._flush(batch)
+            if self._stopping and self._queue.empty():
+                return
+
+    def _flush(self, batch):
+        rows = {}
+        for kind, row in batch:
+            rows.setdefault(kind, []).append(row)
+
+        start = time.perf_counter()
+        try:
+            for kind, prepare in self.prepare.items():
+                if kind in rows:
+                    rows[kind] = prepare(rows[kind])
+            with self.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    for kind, kind_rows in rows.items():
+                        cursor.executemany(self.statements[kind], kind_rows)
+                connection.commit()
+            self.stats['written'] += len(batch)
+            self.stats['batches'] += 1
+        except pymysql.Error as e:
+            self.stats['failed'] += len(batch)
+            logging.error(f"Database error while writing {len(batch)} events: {e}")
+        except Exception as e:
+            self.stats['failed'] += len(batch)
+            logging.error(f"Error while writing {len(batch)} events: {e}")
+        if self.on_batch is not None:
+            self.on_batch(time.perf_counter() - start)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=10):
+        #flushes everything still queued, then stops the writer thread
+        if os.getpid() != self._pid or self._thread is None:
+            return
+        self._stopping = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass  #the writer is busy anyway and will see the flag
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.error(f"Event writer did not finish in {timeout}s, {self.depth()} events left in queue")
+        self._thread = None
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['depth'] = self.depth()
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Event writer stats: {self.get_stats()}")
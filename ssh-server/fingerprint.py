@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import paramiko
+import pymysql
+
+#SSH client fingerprints: the version string a client sends and the algorithm lists of its
+#KEXINIT, captured during the handshake (before authentication, so tools that never log in are
+#seen too). The HASSH of a client is the MD5 of its client->server kex;ciphers;macs;compression
+#lists, which tells SSH implementations apart whatever version string they claim.
+#Each distinct (HASSH, version) pair is stored once in client_fingerprints; connections and
+#login_attempts reference it by id, so per-tool counts are an integer GROUP BY.
+
+INTERN_SQL = """
+    INSERT INTO client_fingerprints (hassh, version, kex_algorithms, host_key_algorithms, ciphers, macs, compression)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+"""
+
+MAX_VERSION = 255  #client_fingerprints.version
+
+class Fingerprint:
+    def __init__(self, version, kex_algorithms, host_key_algorithms, ciphers, macs, compression):
+        self.version = version[:MAX_VERSION]
+        self.kex_algorithms = kex_algorithms  #comma separated, in the client's order
+        self.host_key_algorithms = host_key_algorithms
+        self.ciphers = ciphers
+        self.macs = macs
+        self.compression = compression
+        self.hassh = hashlib.md5(';'.join((kex_algorithms, ciphers, macs, compression)).encode()).hexdigest()
+
+    @classmethod
+    def from_kexinit(cls, version, payload):
+        #payload: KEXINIT message without its type byte (cookie, then the name-lists)
+        m = paramiko.Message(payload)
+        m.get_bytes(16)  #cookie
+        kex, host_keys, ciphers, _, macs, _, compression = (m.get_string().decode('ascii', 'replace')
+                                                             for _ in range(7))
+        return cls(version, kex, host_keys, ciphers, macs, compression)
+
+    def row(self):
+        return (self.hassh, self.version, self.kex_algorithms, self.host_key_algorithms, self.ciphers, self.macs,
+                self.compression)
+
+class Transport(paramiko.Transport):
+    #paramiko.Transport that keeps the client's first KEXINIT (paramiko drops it after the key
+    #exchange, and never keeps it when no algorithm matches), and when each handshake step ended
+    client_fingerprint = None
+    accepted_at = None  #monotonic times: connection accepted (set by the caller),
+    banner_at = None    #client version line read,
+    kex_done_at = None  #first key exchange done
+
+    def _check_banner(self):
+        super()._check_banner()
+        self.banner_at = time.monotonic()
+
+    def _parse_kex_init(self, m):
+        if self.server_mode and self.client_fingerprint is None:
+            try:
+                self.client_fingerprint = Fingerprint.from_kexinit(self.remote_version, m.asbytes())
+            except Exception as e:
+                logging.debug(f"Unreadable KEXINIT: {e}")  #paramiko rejects it just below
+        return super()._parse_kex_init(m)
+
+    def _parse_newkeys(self, m):
+        if self.kex_done_at is None:
+            self.kex_done_at = time.monotonic()  #before paramiko wakes up start_server()
+        return super()._parse_newkeys(m)
+
+class FingerprintStore:
+    def __init__(self, pool, max_cached=10000):
+        self.pool = pool
+        self.max_cached = max_cached
+        self._ids = OrderedDict()  #(hassh, version) -> client_fingerprints.id, least recently used first
+        self._lock = threading.Lock()  #transport threads of the async mode
+        self.stats = {'cached': 0, 'stored': 0, 'failed': 0}
+
+    def intern(self, fingerprint):
+        #id of the fingerprint's row, inserted if it is new (None if the database can't be reached)
+        key = (fingerprint.hassh, fingerprint.version)
+        with self._lock:
+            fingerprint_id = self._ids.get(key)
+            if fingerprint_id is not None:
+                self._ids.move_to_end(key)
+                self.stats['cached'] += 1
+                return fingerprint_id
+        try:
+            with self.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(INTERN_SQL, fingerprint.row())
+                    fingerprint_id = cursor.lastrowid
+                connection.commit()
+        except pymysql.Error as e:
+            logging.error(f"Could not store client fingerprint {fingerprint.hassh}: {e}")
+            self.stats['failed'] += 1
+            return None
+        with self._lock:
+            self._ids[key] = fingerprint_id
+            while len(self._ids) > self.max_cached:
+                self._ids.popitem(last=False)
+            self.stats['stored'] += 1
+        return fingerprint_id
+
+    def resolve(self, rows, column):
+        #rows with the Fingerprint (or None) in column replaced by its id, each distinct fingerprint
+        #interned once (event writer thread: login attempts carry the fingerprint itself)
+        ids = {}
+        resolved = []
+        for row in rows:
+            client_fingerprint = row[column]
+            fingerprint_id = None
+            if client_fingerprint is not None:
+                key = (client_fingerprint.hassh, client_fingerprint.version)
+                if key not in ids:
+                    ids[key] = self.intern(client_fingerprint)
+                fingerprint_id = ids[key]
+            resolved.append(row[:column] + (fingerprint_id,) + row[column + 1:])
+        return resolved
+
+    def get_stats(self):
+        return dict(self.stats, size=len(self._ids))
+
+    def log_stats(self):
+        logging.info(f"Fingerprint stats: {self.get_stats()}")
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+#IP -> geolocation cache shared by every server process through a local SQLite file in WAL mode
+#(readers never wait for the writer). Entries expire after a TTL; when the cache grows past
+#max_entries the least recently used ones are evicted (checked every evict_interval seconds per
+#process, not on every write: counting the rows scans the table). Failed lookups are cached too,
+#with their own shorter TTL, so they aren't retried by every process.
+
+FAILED = 'failed'  #returned by get() for a cached failed lookup
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geo (
+    ip TEXT PRIMARY KEY,
+    data TEXT,              -- JSON geolocation, NULL for a failed lookup
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS geo_accessed ON geo (accessed);
+"""
+
+class GeoCache:
+    def __init__(self, path, ttl=86400, negative_ttl=3600, max_entries=200000, evict_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        #sqlite connections must not cross a fork, each process opens its own
+        self._pid = os.getpid()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._touched = set()  #hits whose LRU timestamp is refreshed at the next write
+        self._evict_after = 0  #time of the next expiry and size check
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'expired': 0, 'stored': 0, 'evicted': 0}
+
+    def _connection(self):
+        if os.getpid() != self._pid:
+            self._reset()
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=1.0, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def get(self, ip):
+        #returns the geolocation dict, FAILED, or None on a miss
+        with self._lock:
+            try:
+                row = self._connection().execute("SELECT data, expires FROM geo WHERE ip = ?", (ip,)).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"Geolocation cache error: {e}")
+                return None
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            data, expires = row
+            if expires < time.time():
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self._touched.add(ip)
+            if data is None:
+                self.stats['negative_hits'] += 1
+                return FAILED
+            self.stats['hits'] += 1
+            return json.loads(data)
+
+    def put(self, results, failed=()):
+        #stores {ip: geo} and the failed ips in one transaction, then evicts if needed
+        now = time.time()
+        rows = [(ip, json.dumps(geo), now + self.ttl, now) for ip, geo in results.items()]
+        rows += [(ip, None, now + self.negative_ttl, now) for ip in failed]
+        with self._lock:
+            touched, self._touched = self._touched, set()
+            try:
+                conn = self._connection()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany("INSERT OR REPLACE INTO geo (ip, data, expires, accessed) VALUES (?, ?, ?, ?)", rows)
+                    conn.executemany("UPDATE geo SET accessed = ? WHERE ip = ?", [(now, ip) for ip in touched])
+                    if now >= self._evict_after:
+                        self._evict(conn, now)
+                        self._evict_after = now + self.evict_interval
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                logging.error(f"Geolocation cache error: {e}")
+                return
+            self.stats['stored'] += len(rows)
+
+    def _evict(self, conn, now):
+        evicted = conn.execute("DELETE FROM geo WHERE expires < ?", (now,)).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM geo").fetchone()[0]
+        if count > self.max_entries:
+            #drop the least recently used tenth, room for the writes until the next check
+            extra = count - self.max_entries + self.max_entries // 10
+            evicted += conn.execute(
+                "DELETE FROM geo WHERE ip IN (SELECT ip FROM geo ORDER BY accessed LIMIT ?)", (extra,)
+            ).rowcount
+        self.stats['evicted'] += evicted
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['negative_hits']) / lookups, 3) if lookups else 0.0
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Geolocation cache stats: {self.get_stats()}")
@@ -0,0 +1,272 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pymysql
+import requests
+
+import geo_cache
+
+#Background geolocation: IPs are submitted without waiting, deduplicated, and resolved in
+#batches by a worker thread (local GeoIP table first, then ip-api.com's batch endpoint).
+#A batch is sent once batch_size IPs are pending or batch_wait seconds after the first one.
+#Results are written to ip_geolocations with one upsert per batch. With a geo_cache.GeoCache,
+#IPs any server process already resolved are answered from it and never reach MariaDB or the network.
+
+IP_API_BATCH_URL = 'http://ip-api.com/batch'
+IP_API_FIELDS = 'status,message,country,countryCode,regionName,city,lat,lon,query'
+
+#placeholders only in VALUES (fetched_at comes from its default), so that executemany() sends the
+#batch as one multi-row INSERT instead of one statement per row
+UPSERT_SQL = """
+    INSERT INTO ip_geolocations (ip, country, country_code, region, city, lat, lon)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        country = VALUES(country),
+        country_code = VALUES(country_code),
+        region = VALUES(region),
+        city = VALUES(city),
+        lat = VALUES(lat),
+        lon = VALUES(lon),
+        fetched_at = NOW()
+"""
+
+class ExpiringSet:
+    #bounded set of keys that are forgotten after ttl seconds (oldest dropped first when full)
+    def __init__(self, ttl, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def add(self, key):
+        self._items.pop(key, None)
+        self._items[key] = time.monotonic() + self.ttl
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        expires = self._items.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._items[key]
+            return False
+        return True
+
+def fetch_batch(session, api_url, ips, timeout=5):
+    #returns ({ip: geo}, failed ips, seconds to wait before the next request or 0)
+    response = session.post(f"{api_url}?fields={IP_API_FIELDS}", json=ips, timeout=timeout)
+    #handling rate limiting from the API
+    remaining = response.headers.get("X-Rl")
+    ttl = response.headers.get("X-Ttl")
+    wait = 0
+    if response.status_code == 429 or (remaining is not None and int(remaining) == 0):
+        wait = int(ttl) if ttl is not None else 60
+    if response.status_code == 429:
+        return {}, [], wait
+
+    results = {}
+    failed = []
+    for data in response.json():
+        ip = data.get('query')
+        if data.get('status') == 'success':
+            results[ip] = {
+                'country': data.get('country'),
+                'country_code': data.get('countryCode'),
+                'region': data.get('regionName'),
+                'city': data.get('city'),
+                'lat': data.get('lat'),
+                'lon': data.get('lon')
+            }
+        else:
+            failed.append(ip)  #private/reserved ranges, invalid queries
+    return results, failed, wait
+
+class GeoWorker:
+    def __init__(self, pool, local_lookup=None, remote=True, api_url=IP_API_BATCH_URL, batch_size=100,
+                 max_pending=10000, refresh_after=86400, negative_ttl=3600, timeout=5, cache=None, on_batch=None,
+                 batch_wait=0.25):
+        self.pool = pool                    #db_pool.ConnectionPool for the reads and upserts
+        self.cache = cache                  #geo_cache.GeoCache shared with the other processes, optional
+        self.local_lookup = local_lookup    #ip -> geo dict or None (local GeoIP table)
+        self.remote = remote                #ask ip-api.com for what the local table can't answer
+        self.api_url = api_url
+        self.batch_size = min(batch_size, 100)  #ip-api.com accepts at most 100 IPs per batch
+        self.batch_wait = batch_wait        #seconds given to more IPs to join a batch that isn't full
+        self.max_pending = max_pending
+        self.refresh_after = refresh_after  #seconds before a stored location is looked up again
+        self.negative_ttl = negative_ttl    #seconds a failed lookup is not retried
+        self.timeout = timeout
+        self.on_batch = on_batch            #called with the seconds each batch took to resolve and store
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  #ips waiting to be resolved, in submission order
+        self._thread = None
+        self._stopping = False
+        self._backoff_until = 0
+        self._recent = ExpiringSet(self.refresh_after)
+        self._failed = ExpiringSet(self.negative_ttl)
+        self.stats = {'submitted': 0, 'skipped': 0, 'cached': 0, 'dropped': 0, 'local': 0, 'remote': 0,
+                      'fresh': 0, 'failed': 0, 'batches': 0, 'backoffs': 0}
+
+    def submit(self, ip):
+        #never blocks: IPs already known, pending, or recently failed are skipped
+        if os.getpid() != self._pid:
+            self._reset()
+        with self._cond:
+            self.stats['submitted'] += 1
+            if ip in self._pending or ip in self._recent or ip in self._failed:
+                self.stats['skipped'] += 1
+                return
+        cached = self.cache.get(ip) if self.cache is not None else None
+        with self._cond:
+            if cached is not None:
+                #resolved (or failed) recently by this or another process
+                (self._failed if cached == geo_cache.FAILED else self._recent).add(ip)
+                self.stats['cached'] += 1
+                return
+            if ip in self._pending:
+                self.stats['skipped'] += 1
+                return
+            if len(self._pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                return
+            self._pending[ip] = None
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="geo-worker", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._stopping:
+                wait = self._backoff_until - time.monotonic()
+                if self._pending and wait <= 0:
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            deadline = time.monotonic() + self.batch_wait
+            while not self._stopping and len(self._pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._stopping:
+                return None
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False)[0])
+            return batch
+
+    def _run(self):
+        session = requests.Session()  #keep-alive between batches
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            try:
+                self._resolve(session, batch)
+            except Exception as e:
+                logging.error(f"Geolocation batch of {len(batch)} IPs failed: {e}")
+                with self._cond:
+                    for ip in batch:
+                        self._failed.add(ip)
+                    self.stats['failed'] += len(batch)
+            if self.on_batch is not None:
+                self.on_batch(time.perf_counter() - start)
+
+    def _fresh_in_db(self, ips):
+        #returns {ip: geo} for the IPs stored less than refresh_after seconds ago
+        placeholders = ', '.join(['%s'] * len(ips))
+        sql = (f"SELECT ip, country, country_code, region, city, lat, lon FROM ip_geolocations "
+               f"WHERE ip IN ({placeholders}) AND fetched_at > NOW() - INTERVAL %s SECOND")
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, (*ips, self.refresh_after))
+                return {row.pop('ip'): row for row in cursor.fetchall()}
+
+    def _resolve(self, session, batch):
+        fresh = self._fresh_in_db(batch)
+        results = {}
+        missing = []
+        for ip in batch:
+            if ip in fresh:
+                continue
+            geo = self.local_lookup(ip) if self.local_lookup is not None else None
+            if geo:
+                results[ip] = geo
+            else:
+                missing.append(ip)
+        local_count = len(results)
+
+        failed = []
+        if missing and self.remote:
+            remote_results, failed, wait = fetch_batch(session, self.api_url, missing, self.timeout)
+            if wait:
+                logging.info(f"Rate limit reached for IP-API. Waiting {wait} seconds until the limit resets.")
+                with self._cond:
+                    self._backoff_until = time.monotonic() + wait
+                    self.stats['backoffs'] += 1
+                    if not remote_results and not failed:
+                        #rejected request: put the IPs back in front of the queue
+                        for ip in reversed(missing):
+                            self._pending[ip] = None
+                            self._pending.move_to_end(ip, last=False)
+            results.update(remote_results)
+        elif missing:
+            failed = missing  #no remote lookups: unknown to the local table
+
+        if results:
+            rows = [(ip, geo.get('country'), geo.get('country_code'), geo.get('region'),
+                     geo.get('city'), geo.get('lat'), geo.get('lon')) for ip, geo in results.items()]
+            try:
+                with self.pool.connection() as connection:
+                    with connection.cursor() as cursor:
+                        cursor.executemany(UPSERT_SQL, rows)
+                    connection.commit()
+            except pymysql.Error as e:
+                logging.error(f"Database error while storing {len(rows)} geolocations: {e}")
+                return
+
+        if self.cache is not None:
+            self.cache.put({**fresh, **results}, failed)
+
+        with self._cond:
+            for ip in fresh:
+                self._recent.add(ip)
+            for ip in results:
+                self._recent.add(ip)
+            for ip in failed:
+                self._failed.add(ip)
+            self.stats['fresh'] += len(fresh)
+            self.stats['local'] += local_count
+            self.stats['remote'] += len(results) - local_count
+            self.stats['failed'] += len(failed)
+            self.stats['batches'] += 1
+
+    def close(self, timeout=5):
+        if os.getpid() != self._pid or self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Geolocation worker stats: {self.get_stats()}")
+        if self.cache is not None:
+            self.cache.log_stats()
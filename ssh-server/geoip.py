@@ -0,0 +1,117 @@
+import array
+import bisect
+import csv
+import ipaddress
+import mmap
+import socket
+import struct
+import sys
+
+#Offline IPv4 geolocation: a range table compiled from a CSV into a binary file that is
+#memory-mapped read-only, so forked children share the same pages, and searched with bisect.
+#
+#Building the table (CSV columns: start_ip, end_ip, country_code, country, region, city, lat, lon;
+#the IPs can be dotted quads or integers, as in the IP2Location LITE DB5 CSV):
+#   python geoip.py build IP2LOCATION-LITE-DB5.CSV geoip.bin
+#Looking up an address:
+#   python geoip.py lookup geoip.bin 8.8.8.8
+
+MAGIC = b'HPGEO001'
+HEADER = struct.Struct('=8sII')  #magic, number of ranges, number of distinct records
+
+def _ip_to_int(value):
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    return int(ipaddress.IPv4Address(value))
+
+def build(csv_path, out_path):
+    ranges = []
+    records = {}  #many ranges share a location: each distinct record is stored once
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if len(row) < 8:
+                continue
+            try:
+                start = _ip_to_int(row[0])
+                end = _ip_to_int(row[1])
+            except ValueError:
+                continue  #header line or IPv6 range
+            if end > 0xFFFFFFFF or start > end:
+                continue
+            record = '\t'.join(field.strip() for field in row[2:8])
+            index = records.setdefault(record, len(records))
+            ranges.append((start, end, index))
+    ranges.sort()
+
+    starts = array.array('I', (r[0] for r in ranges))
+    ends = array.array('I', (r[1] for r in ranges))
+    indexes = array.array('I', (r[2] for r in ranges))
+    blob = bytearray()
+    offsets = array.array('I')
+    for record in records:  #dicts keep insertion order, i.e. record index order
+        offsets.append(len(blob))
+        blob += record.encode('utf-8')
+    offsets.append(len(blob))
+
+    with open(out_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(ranges), len(records)))
+        for table in (starts, ends, indexes, offsets):
+            table.tofile(f)
+        f.write(blob)
+    return len(ranges), len(records)
+
+class GeoIPTable:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mem = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, record_count = HEADER.unpack_from(self._mem, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a GeoIP table built by geoip.py")
+        self.size = count
+        view = memoryview(self._mem)
+        pos = HEADER.size
+        self._starts = view[pos:pos + 4 * count].cast('I')
+        pos += 4 * count
+        self._ends = view[pos:pos + 4 * count].cast('I')
+        pos += 4 * count
+        self._indexes = view[pos:pos + 4 * count].cast('I')
+        pos += 4 * count
+        self._offsets = view[pos:pos + 4 * (record_count + 1)].cast('I')
+        pos += 4 * (record_count + 1)
+        self._blob = view[pos:]
+
+    def lookup(self, ip):
+        #returns the same dict as fetch_geolocation(), or None if the IP isn't in the table
+        if ip.startswith('::ffff:'):
+            ip = ip[7:]  #IPv4 client accepted on an IPv6 socket
+        try:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        except OSError:
+            return None  #IPv6 or invalid
+        i = bisect.bisect_right(self._starts, value) - 1
+        if i < 0 or self._ends[i] < value:
+            return None
+        record = self._indexes[i]
+        raw = bytes(self._blob[self._offsets[record]:self._offsets[record + 1]]).decode('utf-8')
+        country_code, country, region, city, lat, lon = raw.split('\t')
+        if country_code in ('', '-'):
+            return None  #unallocated / reserved ranges
+        return {
+            'country': country,
+            'country_code': country_code,
+            'region': region,
+            'city': city,
+            'lat': float(lat) if lat else None,
+            'lon': float(lon) if lon else None
+        }
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'build':
+        count, record_count = build(sys.argv[2], sys.argv[3])
+        print(f"Wrote {count} ranges ({record_count} distinct locations) to {sys.argv[3]}")
+    elif len(sys.argv) == 4 and sys.argv[1] == 'lookup':
+        print(GeoIPTable(sys.argv[2]).lookup(sys.argv[3]))
+    else:
+        print("Usage: geoip.py build <ranges.csv> <table.bin> | geoip.py lookup <table.bin> <ip>")
+        sys.exit(1)
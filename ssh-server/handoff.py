@@ -0,0 +1,110 @@
+import logging
+import os
+import socket
+import subprocess
+import sys
+
+#Graceful reload (SIGUSR2): the server starts a new copy of itself, same command line, which
+#inherits the listening sockets instead of binding its ports again, so no connection is refused in
+#between. The new process writes a byte on a pipe once it accepts connections; only then does the
+#old one stop accepting and wait for its open sessions to end before exiting. Listening sockets
+#passed by systemd socket activation (LISTEN_FDS) are picked up the same way.
+#
+#The new process is started through a short-lived intermediate one, so it isn't a child of the old
+#server and outlives it. Under systemd it stays in the service's cgroup: once it is ready, the old
+#process (still the main PID) hands the main PID over to it (sd_notify MAINPID=, needs
+#NotifyAccess=main or all), so systemd doesn't stop the service when the old process exits.
+
+LISTEN_FDS_ENV = 'HONEYPOT_LISTEN_FDS'
+READY_FD_ENV = 'HONEYPOT_READY_FD'
+SD_LISTEN_FDS_START = 3  #first fd passed by systemd
+NOTIFY_SOCKET_ENV = 'NOTIFY_SOCKET'  #systemd notification socket (Type=notify, NotifyAccess=)
+
+#taken out of the environment when the server starts, so that fshell and later copies don't see them
+_listen_fds = [int(fd) for fd in os.environ.pop(LISTEN_FDS_ENV, '').split(',') if fd]
+_ready_fd = os.environ.pop(READY_FD_ENV, None)
+_notify_socket = os.environ.pop(NOTIFY_SOCKET_ENV, None)
+if not _listen_fds and os.environ.get('LISTEN_PID') == str(os.getpid()):
+    _listen_fds = list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + int(os.environ.get('LISTEN_FDS', 0))))
+for _name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+    os.environ.pop(_name, None)
+
+def inherited_sockets():
+    #the listening sockets passed by the previous server process or by systemd, in order
+    return [socket.socket(fileno=fd) for fd in _listen_fds]
+
+def sd_notify(message):
+    #systemd service notification, nothing when the server wasn't started by systemd
+    if not _notify_socket:
+        return
+    address = '\0' + _notify_socket[1:] if _notify_socket.startswith('@') else _notify_socket  #abstract socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.sendto(message.encode(), address)
+    except OSError as e:
+        logging.error(f"Could not notify systemd ({message}): {e}")
+
+def notify_ready():
+    #tells the previous server process (or systemd, on the first start) that this one accepts connections now
+    global _ready_fd
+    if _ready_fd is None:
+        sd_notify('READY=1')
+        return
+    try:
+        os.write(int(_ready_fd), str(os.getpid()).encode())  #the previous process hands our pid to systemd
+        os.close(int(_ready_fd))
+    except OSError as e:
+        logging.error(f"Could not notify the previous server process: {e}")
+    _ready_fd = None
+
+class Successor:
+    def __init__(self, listen_sockets=()):
+        #starts the new server process, handing it listen_sockets (none: it binds its own sockets,
+        #e.g. SO_REUSEPORT ones next to ours)
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ)
+        env[READY_FD_ENV] = str(ready_w)
+        if _notify_socket:
+            env[NOTIFY_SOCKET_ENV] = _notify_socket
+        listen_fds = [listen_socket.fileno() for listen_socket in listen_sockets]
+        if listen_fds:
+            env[LISTEN_FDS_ENV] = ','.join(map(str, listen_fds))
+        pass_fds = [ready_w] + listen_fds
+        try:
+            intermediate = os.fork()
+            if intermediate == 0:
+                #starts the new server and exits right away: the new server is re-parented (to init or
+                #the service manager) instead of being our child
+                try:
+                    subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=pass_fds)
+                    os._exit(0)
+                except BaseException:
+                    os._exit(1)
+            _, status = os.waitpid(intermediate, 0)
+            if os.waitstatus_to_exitcode(status) != 0:
+                raise OSError(f"could not execute {sys.executable}")
+        except Exception:
+            os.close(ready_r)
+            raise
+        finally:
+            os.close(ready_w)
+        os.set_blocking(ready_r, False)
+        self.ready_fd = ready_r
+        self.pid = None  #known once it is ready
+        logging.info("Reload: started the new server process")
+
+    def poll(self):
+        #True once the new process accepts connections, False if it exited before that, None meanwhile
+        try:
+            data = os.read(self.ready_fd, 32)
+        except BlockingIOError:
+            return None
+        os.close(self.ready_fd)
+        self.ready_fd = None
+        if data:
+            self.pid = int(data)
+            logging.info(f"Reload: the new server process (pid {self.pid}) is ready")
+            sd_notify(f'MAINPID={self.pid}')  #this process exits once drained, the service goes on
+            return True
+        logging.error("Reload: the new server process exited before it was ready")
+        return False
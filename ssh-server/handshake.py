@@ -0,0 +1,100 @@
+import logging
+import os
+
+import paramiko
+
+#Handshake profiles for the server side paramiko.Transport.
+#"openssh" looks like a stock OpenSSH server (banner, algorithm order, RSA + Ed25519 host keys),
+#"fast" only keeps the cheap algorithms (curve25519/ECDH, Ed25519, AES-GCM) so KEX costs as
+#little CPU as possible, and "paramiko" keeps paramiko's own defaults.
+#Algorithms the installed paramiko doesn't support are skipped.
+
+PROFILES = {
+    'paramiko': {'host_keys': ['rsa']},
+    'openssh': {
+        'banner': "SSH-2.0-OpenSSH_8.9p1 Ubuntu-3ubuntu0.10",
+        'kex': [
+            'curve25519-sha256', 'curve25519-sha256@libssh.org',
+            'ecdh-sha2-nistp256', 'ecdh-sha2-nistp384', 'ecdh-sha2-nistp521',
+            'diffie-hellman-group-exchange-sha256',
+            'diffie-hellman-group16-sha512', 'diffie-hellman-group18-sha512',
+            'diffie-hellman-group14-sha256',
+        ],
+        'key_types': ['rsa-sha2-512', 'rsa-sha2-256', 'ecdsa-sha2-nistp256', 'ssh-ed25519'],
+        'ciphers': [
+            'chacha20-poly1305@openssh.com', 'aes128-ctr', 'aes192-ctr', 'aes256-ctr',
+            'aes128-gcm@openssh.com', 'aes256-gcm@openssh.com',
+        ],
+        'digests': [
+            'hmac-sha2-256-etm@openssh.com', 'hmac-sha2-512-etm@openssh.com', 'hmac-sha1-etm@openssh.com',
+            'hmac-sha2-256', 'hmac-sha2-512', 'hmac-sha1',
+        ],
+        'host_keys': ['rsa', 'ed25519'],
+    },
+    'fast': {
+        'banner': "SSH-2.0-OpenSSH_8.9p1 Ubuntu-3ubuntu0.10",
+        #no DH group exchange / big MODP groups: clients that only speak those fail negotiation cheaply
+        'kex': ['curve25519-sha256', 'curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256'],
+        'key_types': ['ssh-ed25519', 'rsa-sha2-256', 'rsa-sha2-512'],
+        'ciphers': ['aes128-gcm@openssh.com', 'aes128-ctr', 'aes256-gcm@openssh.com', 'aes256-ctr'],
+        'digests': ['hmac-sha2-256-etm@openssh.com', 'hmac-sha2-256', 'hmac-sha2-512'],
+        'host_keys': ['ed25519', 'rsa'],
+        'first_host_key_only': True,  #sign with Ed25519 only when we have it, RSA signatures are the slow part
+    },
+}
+
+def load_host_keys(key_dir='key'):
+    #returns {'rsa': key, 'ed25519': key} for the keys found in key_dir
+    keys = {}
+    rsa_path = os.getenv('HOST_KEY_RSA', os.path.join(key_dir, 'serv_rsa.key'))
+    ed25519_path = os.getenv('HOST_KEY_ED25519', os.path.join(key_dir, 'serv_ed25519.key'))
+    if os.path.exists(rsa_path):
+        keys['rsa'] = paramiko.RSAKey(filename=rsa_path)
+    if os.path.exists(ed25519_path):
+        keys['ed25519'] = paramiko.Ed25519Key(filename=ed25519_path)
+    if not keys:
+        raise FileNotFoundError(f"No host key found ({rsa_path}, {ed25519_path})")
+    return keys
+
+class HandshakeProfile:
+    def __init__(self, name, host_keys, banner=None):
+        if name not in PROFILES:
+            raise ValueError(f"Unknown handshake profile: {name}")
+        self.name = name
+        self.settings = PROFILES[name]
+        self.banner = banner or self.settings.get('banner')
+
+        wanted = self.settings.get('host_keys', ['rsa', 'ed25519'])
+        self.host_keys = [host_keys[kind] for kind in wanted if kind in host_keys]
+        if not self.host_keys:
+            self.host_keys = list(host_keys.values())
+            logging.error(f"Handshake profile {name}: none of {wanted} host keys found, using {list(host_keys)}")
+        if self.settings.get('first_host_key_only'):
+            self.host_keys = self.host_keys[:1]
+        if name == 'fast' and 'ed25519' not in host_keys:
+            logging.error("Handshake profile fast: no Ed25519 host key, falling back to RSA (slower KEX)")
+        self._filtered = None
+
+    def _algorithms(self, options):
+        #computed once: the algorithm names from the profile that this paramiko supports
+        if self._filtered is None:
+            self._filtered = {}
+            for field in ('kex', 'key_types', 'ciphers', 'digests'):
+                if field not in self.settings:
+                    continue
+                supported = getattr(options, field)
+                names = [n for n in self.settings[field] if n in supported]
+                if names:
+                    self._filtered[field] = tuple(names)
+                else:
+                    logging.error(f"Handshake profile {self.name}: no supported {field}, keeping paramiko defaults")
+        return self._filtered
+
+    def apply(self, transport):
+        for key in self.host_keys:
+            transport.add_server_key(key)
+        if self.banner:
+            transport.local_version = self.banner
+        options = transport.get_security_options()
+        for field, names in self._algorithms(options).items():
+            setattr(options, field, names)
@@ -0,0 +1,139 @@
+import ipaddress
+import logging
+import socket
+import sys
+
+#Source address lists checked in the accept loop, before any handshake:
+#- deny: connections are closed right away, unless the address is also in allow
+#- allow: exceptions to deny (e.g. a /24 inside a denied /8)
+#- exclude: our own scanners and monitoring probes, served normally but never recorded
+#Each list is a file with one address or CIDR per line (IPv4 or IPv6, # starts a comment),
+#compiled into a binary prefix tree per address family. The files are read again on SIGHUP.
+
+DENY, EXCLUDE = 'deny', 'exclude'  #verdicts returned by AccessLists.check
+
+class PrefixTree:
+    #binary trie on the address bits, a node is [child 0, child 1, end of a prefix]
+    def __init__(self, bits):
+        self.bits = bits
+        self.size = 0
+        self._root = [None, None, False]
+        self._depth = 0  #longest prefix inserted, lookups never walk further
+
+    def add(self, value, prefixlen):
+        node = self._root
+        for i in range(prefixlen):
+            if node[2]:
+                return  #already covered by a shorter prefix
+            bit = (value >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[0] = node[1] = None  #longer prefixes below are covered by this one
+        node[2] = True
+        self.size += 1
+        self._depth = max(self._depth, prefixlen)
+
+    def __contains__(self, value):
+        node = self._root
+        shift = self.bits - 1
+        for _ in range(self._depth):
+            if node[2]:
+                return True
+            node = node[(value >> shift) & 1]
+            if node is None:
+                return False
+            shift -= 1
+        return node[2]
+
+def _parse(ip):
+    #returns (family bits, integer value), IPv4-mapped IPv6 addresses are treated as IPv4
+    if ':' in ip:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+        if value >> 32 == 0xFFFF:
+            return 32, value & 0xFFFFFFFF
+        return 128, value
+    return 32, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+
+class IPList:
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path
+        self.hits = 0
+        self._trees = {32: PrefixTree(32), 128: PrefixTree(128)}
+        if path:
+            self.reload()
+
+    def reload(self):
+        trees = {32: PrefixTree(32), 128: PrefixTree(128)}
+        with open(self.path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    network = ipaddress.ip_network(line, strict=False)
+                except ValueError:
+                    logging.error(f"{self.path}:{number}: invalid address or network {line!r}, ignored")
+                    continue
+                trees[network.max_prefixlen].add(int(network.network_address), network.prefixlen)
+        self._trees = trees  #swapped in one step, lookups never see a half loaded list
+        logging.info(f"Loaded {trees[32].size} IPv4 and {trees[128].size} IPv6 networks into the {self.name} list")
+
+    def __len__(self):
+        return self._trees[32].size + self._trees[128].size
+
+    def __contains__(self, ip):
+        try:
+            bits, value = _parse(ip)
+        except OSError:
+            return False
+        return value in self._trees[bits]
+
+class AccessLists:
+    def __init__(self, allow_path=None, deny_path=None, exclude_path=None):
+        self.allow = IPList('allow', allow_path)
+        self.deny = IPList('deny', deny_path)
+        self.exclude = IPList('exclude', exclude_path)
+
+    def lookup(self, ip):
+        #DENY, EXCLUDE or None, without counting a hit
+        if len(self.deny) and ip in self.deny and not (len(self.allow) and ip in self.allow):
+            return DENY
+        if len(self.exclude) and ip in self.exclude:
+            return EXCLUDE
+        return None
+
+    def check(self, ip):
+        #lookup() for a new connection, counted in the lists' hits
+        verdict = self.lookup(ip)
+        if verdict == DENY:
+            self.deny.hits += 1
+        elif verdict == EXCLUDE:
+            self.exclude.hits += 1
+        elif len(self.allow) and len(self.deny) and ip in self.deny:
+            self.allow.hits += 1  #denied range, let through by allow
+        return verdict
+
+    def reload(self):
+        for ip_list in (self.allow, self.deny, self.exclude):
+            if ip_list.path:
+                try:
+                    ip_list.reload()
+                except OSError as e:
+                    logging.error(f"Could not reload the {ip_list.name} list: {e}")
+
+    def get_stats(self):
+        return {f'{ip_list.name}_hits': ip_list.hits for ip_list in (self.allow, self.deny, self.exclude)}
+
+    def log_stats(self):
+        logging.info(f"Access list stats: {self.get_stats()}")
+
+if __name__ == '__main__':
+    #checks addresses against a list file: python iplists.py deny.txt 1.2.3.4 2001:db8::1
+    if len(sys.argv) < 3:
+        print("Usage: iplists.py <list file> <ip> [<ip> ...]")
+        sys.exit(1)
+    ip_list = IPList('test', sys.argv[1])
+    for ip in sys.argv[2:]:
+        print(ip, ip in ip_list)
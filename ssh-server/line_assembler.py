@@ -0,0 +1,97 @@
+import codecs
+
+#Turns the raw keystrokes received from the client into the command lines fshell reads.
+#fshell reads lines with fgets() on a pty in canonical mode, so the line discipline applies
+#erase (DEL/^H), kill (^U), word erase (^W) and interrupt (^C) before the shell sees anything.
+#Keystrokes are processed once, as they arrive, and the pending line is bounded.
+
+MAX_LINE = 4096  #canonical mode line limit (N_TTY_BUF_SIZE - 1 plus the newline)
+
+#escape sequence parser states
+NORMAL, ESC, CSI, OSC, OSC_ESC, SKIP_ONE = range(6)
+
+class LineAssembler:
+    def __init__(self, max_line=MAX_LINE, encoding='utf-8'):
+        self.max_line = max_line
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._line = []
+        self._state = NORMAL
+        self._last_cr = False
+        self.truncated_lines = 0
+        self._truncated = False
+
+    def feed(self, data):
+        #returns the lines completed by this chunk (stripped, empty lines skipped)
+        lines = []
+        for ch in self._decoder.decode(data):
+            if self._state != NORMAL:
+                self._escape(ch)
+                continue
+
+            if ch == '\n' and self._last_cr:
+                self._last_cr = False  #CR LF is a single line end
+                continue
+            self._last_cr = ch == '\r'
+
+            if ch == '\r' or ch == '\n':
+                line = self._end_line()
+                if line:
+                    lines.append(line)
+            elif ch == '\x7f' or ch == '\x08':  #DEL / backspace
+                if self._line:
+                    self._line.pop()
+            elif ch == '\x15' or ch == '\x03':  #^U kill, ^C interrupt: the line is dropped
+                self._clear()
+            elif ch == '\x17':  #^W word erase
+                while self._line and self._line[-1] in ' \t':
+                    self._line.pop()
+                while self._line and self._line[-1] not in ' \t':
+                    self._line.pop()
+            elif ch == '\x1b':
+                self._state = ESC
+            elif ch == '\t' or ch >= ' ':
+                if len(self._line) < self.max_line:
+                    self._line.append(ch)
+                else:
+                    self._truncated = True
+            #other control characters don't end up in the line
+        return lines
+
+    def _escape(self, ch):
+        #skips ANSI escape sequences (arrow keys, function keys, bracketed paste markers...)
+        if self._state == ESC:
+            if ch == '[':
+                self._state = CSI
+            elif ch == ']':
+                self._state = OSC
+            elif ch in 'O()':
+                self._state = SKIP_ONE  #SS3 keys (ESC O A), charset selection (ESC ( B)
+            else:
+                self._state = NORMAL  #two character sequence (ESC x)
+        elif self._state == SKIP_ONE:
+            self._state = NORMAL
+        elif self._state == CSI:
+            if '@' <= ch <= '~' and ch != '[':
+                self._state = NORMAL  #final byte
+        elif self._state == OSC:
+            if ch == '\x07':
+                self._state = NORMAL
+            elif ch == '\x1b':
+                self._state = OSC_ESC
+        elif self._state == OSC_ESC:
+            self._state = NORMAL if ch == '\\' else OSC
+
+    def _clear(self):
+        self._line = []
+        self._truncated = False
+
+    def _end_line(self):
+        line = ''.join(self._line).strip()
+        if self._truncated:
+            self.truncated_lines += 1
+        self._clear()
+        return line
+
+    def pending(self):
+        #what has been typed on the current, unfinished line
+        return ''.join(self._line)
@@ -0,0 +1,64 @@
+import socket
+
+#Listening addresses of the SSH server. LISTEN_ADDRS (or --listen) lists several host:port pairs,
+#e.g. "0.0.0.0:22,[::]:22,0.0.0.0:2222", all served by the same accept loop, so extra ports and IPv6
+#share the process's DB pool, caches and admission state instead of needing a server each.
+#IPv6 sockets are IPV6_V6ONLY, so [::]:22 and 0.0.0.0:22 can be listed together.
+
+DEFAULT = '0.0.0.0:22'
+
+def parse_address(text):
+    #'[::]:2222' -> ('::', 2222), a bare port listens on every IPv4 address
+    text = text.strip()
+    host, sep, port = text.rpartition(':')
+    if not sep:
+        host, port = '0.0.0.0', text
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    elif ':' in host:
+        raise ValueError(f"IPv6 listen address without brackets: {text!r}")
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"invalid listen address: {text!r}")
+    return host or '0.0.0.0', int(port)
+
+def parse(spec):
+    #comma separated addresses
+    return [parse_address(part) for part in spec.split(',') if part.strip()]
+
+def name(address):
+    host, port = address
+    return f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+
+def address_of(server_socket):
+    #(host, port) a listening socket is bound to, for the sockets inherited from another process
+    return server_socket.getsockname()[:2]
+
+def open_socket(address, reuse_port=False, backlog=100):
+    host, port = address
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    server_socket = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6:
+            server_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)  #IPv4 goes to its own listener
+        if reuse_port:
+            #every pre-forked worker binds its own socket, the kernel spreads connections between them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+        server_socket.listen(backlog)
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
+def open_sockets(addresses, reuse_port=False, backlog=100):
+    #one socket per address, none left open if one of them can't be bound
+    sockets = []
+    try:
+        for address in addresses:
+            sockets.append(open_socket(address, reuse_port, backlog))
+    except OSError as e:
+        for server_socket in sockets:
+            server_socket.close()
+        raise OSError(e.errno, f"cannot listen on {name(address)}: {e.strerror}") from e
+    return sockets
@@ -0,0 +1,222 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+
+#Logging pipeline for the SSH server: logging calls never touch the disk or the console.
+#In the process that set it up, records go through a bounded queue to a QueueListener thread
+#that does the formatting and the writing (size-rotated file, optional console). Processes
+#forked from it (connection children, prefork workers) send each record as one datagram on a
+#local UNIX socket instead, read back into the queue by a receiver thread, so there is a single
+#writer for the file and its rotation (during a reload, the new server process rotates it and the
+#old one follows, see set_rotating()). When the queue or the socket buffer is full, records are
+#dropped and counted rather than waited for.
+#
+#Records carry the client (ip:port) and the connection id of the session that logged them:
+#set with the CLIENT and CONNECTION_ID context variables (per asyncio task), or as a log_client
+#attribute on a thread serving a single connection (paramiko's Transport thread).
+#Records logged with extra={'sample': <key>} are rate limited per key by the writer: under a
+#flood of e.g. failed logins, only sample_rate lines per second and key are written, followed by
+#a count of the ones suppressed.
+
+CLIENT = contextvars.ContextVar('client', default=None)
+CONNECTION_ID = contextvars.ContextVar('connection_id', default=None)
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+MAX_DATAGRAM = 16 * 1024  #longer messages are cut
+
+class JSONFormatter(logging.Formatter):
+    #one JSON object per line
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'pid': record.process,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('client', 'connection_id', 'sample', 'suppressed'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class _Handler(logging.handlers.QueueHandler):
+    def __init__(self, pipeline):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        record = super().prepare(record)  #message formatted, args and traceback folded into it
+        if getattr(record, 'client', None) is None:
+            record.client = CLIENT.get() or getattr(threading.current_thread(), 'log_client', None)
+        if getattr(record, 'connection_id', None) is None:
+            record.connection_id = CONNECTION_ID.get()
+        return record
+
+    def enqueue(self, record):
+        pipeline = self.pipeline
+        if os.getpid() == pipeline.pid:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                pipeline.stats['dropped'] += 1
+            return
+        #forked process: no threads here, the setup process writes it
+        entry = {key: getattr(record, key, None) for key in
+                 ('name', 'levelno', 'levelname', 'created', 'msecs', 'process', 'client', 'connection_id', 'sample')}
+        entry['msg'] = record.msg[:MAX_DATAGRAM]
+        try:
+            pipeline._send.send(json.dumps(entry, ensure_ascii=False).encode())
+        except OSError:
+            pipeline.stats['dropped'] += 1  #only seen by this process
+
+class _Listener(logging.handlers.QueueListener):
+    def __init__(self, pipeline, *handlers):
+        super().__init__(pipeline.queue, *handlers, respect_handler_level=True)
+        self.pipeline = pipeline
+
+    def handle(self, record):
+        for sampled in self.pipeline._sample(record):
+            super().handle(sampled)
+
+class LogPipeline:
+    def __init__(self, path='server.log', json_lines=False, console=True, max_bytes=50 * 1024 * 1024, backups=5,
+                 sample_rate=20, queue_size=10000, level=logging.INFO):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rate = sample_rate  #lines per second written per sample key (0: no sampling)
+        self.rotating = True  #False while another process rotates the file, see set_rotating()
+        self.pid = os.getpid()
+        self.queue = queue.Queue(queue_size)
+        self.stats = {'dropped': 0, 'received': 0, 'suppressed': 0}
+        self._windows = {}  #sample key -> [window start second, lines in the window, suppressed]
+        self._recv, self._send = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send.setblocking(False)
+        try:
+            self._send.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)  #shared by every forked process
+        except OSError:
+            pass
+        self._listener = _Listener(self, *self._handlers(json_lines, console))
+        self._listener.start()
+        self._receiver = threading.Thread(target=self._receive, name="log-receiver", daemon=True)
+        self._receiver.start()
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_Handler(self))
+
+    def _handlers(self, json_lines, console):
+        formatter = JSONFormatter() if json_lines else logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+        handlers = [self._file_handler()]
+        if console:
+            handlers.append(logging.StreamHandler(sys.stderr))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        return handlers
+
+    def _file_handler(self):
+        if self.rotating:
+            return logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                        backupCount=self.backups, encoding='utf-8')
+        return logging.handlers.WatchedFileHandler(self.path, encoding='utf-8')  #reopened once rotated
+
+    def configure(self, json_lines=False, console=True):
+        #switches the output format / console on the running listener (command line flags)
+        old = self._listener.handlers
+        self._listener.handlers = tuple(self._handlers(json_lines, console))
+        for handler in old:
+            handler.close()
+
+    def set_rotating(self, rotating):
+        #False while another process writing to the same file rotates it (the new server during a
+        #reload): this one keeps appending and follows the rotations instead of doing its own
+        self.rotating = rotating
+        if os.getpid() != self.pid or self._listener is None:
+            return
+        handlers = list(self._listener.handlers)
+        old = handlers[0]
+        handlers[0] = self._file_handler()
+        handlers[0].setFormatter(old.formatter)
+        self._listener.handlers = tuple(handlers)
+        old.close()
+
+    def _receive(self):
+        #records from the forked processes, into the writer queue
+        while True:
+            data = self._recv.recv(4 * MAX_DATAGRAM + 1024)  #UTF-8 encoded
+            if not data:
+                return  #stop()
+            try:
+                record = logging.makeLogRecord(json.loads(data))
+            except ValueError:
+                continue
+            self.stats['received'] += 1
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.stats['dropped'] += 1
+
+    def _sample(self, record):
+        #records to write for this one: none when over the rate of its sample key, plus the count
+        #of the suppressed ones once a new second starts
+        key = getattr(record, 'sample', None)
+        if key is None or not self.sample_rate:
+            return (record,)
+        second = int(record.created)
+        window = self._windows.get(key)
+        if window is None or window[0] != second:
+            summary = self._summary(key, window)
+            self._windows[key] = [second, 1, 0]
+            return (summary, record) if summary is not None else (record,)
+        window[1] += 1
+        if window[1] <= self.sample_rate:
+            return (record,)
+        window[2] += 1
+        self.stats['suppressed'] += 1
+        return ()
+
+    def _summary(self, key, window):
+        if window is None or not window[2]:
+            return None
+        summary = logging.makeLogRecord({'name': 'log_setup', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                         'msg': f"{window[2]} '{key}' lines suppressed", 'sample': key,
+                                         'suppressed': window[2], 'process': os.getpid()})
+        return summary
+
+    def stop(self):
+        #writes what is queued, in the process that set the pipeline up only
+        if os.getpid() != self.pid or self._listener is None:
+            return
+        self._send.send(b'')  #empty datagram: the receiver thread stops
+        self._receiver.join(2)
+        self.log_stats()
+        for key, window in list(self._windows.items()):
+            summary = self._summary(key, window)
+            if summary is not None:
+                self.queue.put(summary)
+        self._windows = {}
+        self._listener.stop()
+        self._listener = None
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Logging stats: {self.get_stats()}")
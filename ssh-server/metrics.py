@@ -0,0 +1,193 @@
+import bisect
+import http.server
+import logging
+import mmap
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+#Prometheus metrics shared by every server process. Like stats.SharedCounters, values live in
+#anonymous shared mappings created before forking, so connection children and prefork workers
+#update the same counters and histograms, and the process running the accept loop serves them
+#all from one HTTP endpoint (--metrics-port) in the Prometheus text format:
+#   curl http://127.0.0.1:9100/metrics
+#A metric has at most one label, whose values are declared up front (one row of cells each).
+
+#seconds, for the per-connection phases (handshake steps, PAM, DB writes, spawn)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+#seconds, for whole sessions
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, label=None, values=(), cells=1):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = list(values) if label else [None]
+        self._rows = {value: row for row, value in enumerate(self.values)}
+        self._cells = cells
+        self._mem = mmap.mmap(-1, 8 * cells * len(self.values))  #MAP_SHARED | MAP_ANONYMOUS
+        self._data = memoryview(self._mem).cast('q')
+        self._lock = multiprocessing.Lock()  #written by many forked processes
+
+    def _base(self, value):
+        return self._rows[value] * self._cells
+
+    def _labels(self, value, extra=None):
+        labels = [f'{self.label}="{value}"'] if self.label else []
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, label=None, amount=1):
+        pos = self._base(label)
+        with self._lock:
+            self._data[pos] += amount
+
+    def get(self, label=None):
+        return self._data[self._base(label)]
+
+    def _samples(self):
+        return [f"{self.name}{self._labels(value)} {self.get(value)}" for value in self.values]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, label=None, amount=1):
+        self.inc(label, -amount)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, label=None, values=()):
+        self.buckets = sorted(buckets)
+        #per row: one count per bucket and +Inf (not cumulative), then the sum in microseconds
+        super().__init__(name, help, label, values, cells=len(self.buckets) + 2)
+
+    def observe(self, seconds, label=None):
+        base = self._base(label)
+        bucket = bisect.bisect_left(self.buckets, seconds)  #first upper bound >= seconds, or +Inf
+        with self._lock:
+            self._data[base + bucket] += 1
+            self._data[base + len(self.buckets) + 1] += int(seconds * 1000000)
+
+    @contextmanager
+    def time(self, label=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, label)
+
+    def _samples(self):
+        samples = []
+        for value in self.values:
+            base = self._base(value)
+            count = 0
+            for bucket, bound in enumerate(self.buckets + ['+Inf']):
+                count += self._data[base + bucket]
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{bound}"'
+                samples.append(f"{self.name}_bucket{self._labels(value, le)} {count}")
+            samples.append(f"{self.name}_sum{self._labels(value)} {self._data[base + len(self.buckets) + 1] / 1000000}")
+            samples.append(f"{self.name}_count{self._labels(value)} {count}")
+        return samples
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []  #functions returning more exposition lines, for values kept elsewhere
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None, values=()):
+        return self._add(Counter(name, help, label, values))
+
+    def gauge(self, name, help, label=None, values=()):
+        return self._add(Gauge(name, help, label, values))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, label=None, values=()):
+        return self._add(Histogram(name, help, buckets, label, values))
+
+    def collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                lines.extend(collect())
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+        return '\n'.join(lines) + '\n'
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  #no log line per scrape
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registry):
+        self.address_family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+        self.registry = registry
+        super().__init__(address, _Handler)
+
+    def server_bind(self):
+        #a new server process (graceful reload) binds the port while the old one still listens
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+class MetricsServer:
+    def __init__(self, registry, port, host='127.0.0.1'):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self._server = None
+        self._pid = os.getpid()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget)
+
+    def start(self):
+        self._server = _HTTPServer((self.host, self.port), self.registry)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Metrics endpoint on http://{self.host}:{self.port}/metrics")
+
+    def _forget(self):
+        #forked children (sessions, workers) must not keep the listening socket open
+        if self._server is not None:
+            self._server.socket.close()
+            self._server = None
+
+    def stop(self):
+        if self._server is None or os.getpid() != self._pid:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
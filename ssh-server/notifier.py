@@ -0,0 +1,140 @@
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+import requests
+
+#Fire-and-forget presence updates for the dashboard. Sessions (in any process forked after
+#start()) send a datagram on a local UNIX socket and move on; one sender thread counts the open
+#sessions per IP and posts only the changes (online when the first session from an IP opens,
+#offline when its last one closes) to the dashboard in batches, over a keep-alive connection.
+#When the socket buffer is full or the dashboard is down, updates are dropped or coalesced,
+#never waited for.
+
+class Notifier:
+    def __init__(self, url, flush_interval=0.5, retry_after=5, max_pending=10000, timeout=2):
+        self.url = url
+        self.flush_interval = flush_interval  #max seconds an update waits to be batched
+        self.retry_after = retry_after        #seconds before trying a dashboard that failed again
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._recv, self._send = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._recv.setblocking(False)
+        self._send.setblocking(False)
+        self._thread = None
+        self._started = False  #also true in the processes forked from the one running the thread
+        self._stopping = False
+        self._sessions = {}    #ip -> open sessions
+        self._online = set()   #IPs the dashboard shows as online
+        self._pending = {}     #ip -> presence to send
+        self.stats = {'updates': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0, 'batches': 0, 'failed': 0}
+
+    def notify(self, ip, online):
+        #never blocks: dropped if the sender thread is that far behind
+        try:
+            self._send.send((b'+' if online else b'-') + ip.encode())
+        except OSError:
+            self.stats['dropped'] += 1  #only seen by this process
+
+    def start(self):
+        #starts the sender thread, unless this process was forked from the one running it
+        if self._started:
+            return
+        self._started = True
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+        self._thread.start()
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._recv.recv(128)
+            except BlockingIOError:
+                return
+            if not data:
+                continue  #wake up from close()
+            self.stats['updates'] += 1
+            ip = data[1:].decode()
+            count = self._sessions.get(ip, 0) + (1 if data[:1] == b'+' else -1)
+            if count > 0:
+                self._sessions[ip] = count
+            else:
+                self._sessions.pop(ip, None)
+            online = count > 0
+            if online == (ip in self._online):
+                #no change for the dashboard (another session from the same IP, or back to the sent state)
+                if self._pending.pop(ip, None) is not None:
+                    self.stats['coalesced'] += 1
+                continue
+            if ip in self._pending:
+                self.stats['coalesced'] += 1
+            elif len(self._pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                continue
+            self._pending[ip] = online
+
+    def _flush(self, session):
+        batch, self._pending = self._pending, {}
+        try:
+            response = session.post(self.url, json=[{'ip': ip, 'online': online} for ip, online in batch.items()],
+                                    timeout=self.timeout)
+            response.raise_for_status()
+        except Exception as e:
+            self.stats['failed'] += 1
+            logging.error("Error notifying status update: %s", e)
+            for ip, online in batch.items():
+                self._pending.setdefault(ip, online)  #newer updates win
+            return False
+        for ip, online in batch.items():
+            if online:
+                self._online.add(ip)
+            else:
+                self._online.discard(ip)
+        self.stats['sent'] += len(batch)
+        self.stats['batches'] += 1
+        return True
+
+    def _run(self):
+        session = requests.Session()
+        next_flush = None
+        while True:
+            timeout = None if next_flush is None else max(0, next_flush - time.monotonic())
+            readable, _, _ = select.select([self._recv], [], [], timeout)
+            if readable:
+                self._receive()
+            if self._stopping:
+                if self._pending:
+                    self._flush(session)
+                return
+            if not self._pending:
+                next_flush = None  #everything pending was coalesced away
+            elif next_flush is None:
+                next_flush = time.monotonic() + self.flush_interval
+            if next_flush is not None and time.monotonic() >= next_flush:
+                ok = self._flush(session)
+                next_flush = None if ok else time.monotonic() + self.retry_after
+
+    def close(self, timeout=3):
+        #sends what is pending and logs the stats, in the process running the thread only
+        if self._thread is None or os.getpid() != self._pid:
+            return
+        self._stopping = True
+        try:
+            self._send.send(b'')  #wakes the thread up
+        except OSError:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        self.log_stats()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['pending'] = len(self._pending)
+        stats['online_ips'] = len(self._online)
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Notifier stats: {self.get_stats()}")
@@ -0,0 +1,277 @@
+import errno
+import os
+import select
+import signal
+import threading
+import time
+
+#Event driven relay between the SSH channel and the fshell pty, used by the forked
+#connection handler. It sleeps in epoll until there is data on either side, the shell
+#exits (pidfd, or SIGCHLD through a wakeup pipe), a session limit is reached or a signal
+#asks for shutdown: an idle session only wakes up when its idle timeout expires.
+#Shell output is only sent as far as the client's window allows: while some waits for a client
+#that doesn't read, the pty isn't read either and the relay polls the channel again on a short
+#backoff, so that the session limits still apply.
+
+MIN_READ = 1024
+MAX_READ = 64 * 1024
+COALESCE_BYTES = 32 * 1024  #shell output gathered into one channel write
+SEND_WAIT_MIN, SEND_WAIT_MAX = 0.005, 0.1  #backoff while the client's window is closed
+DRAIN_TIMEOUT = 5  #seconds given to the client to take the last output of an exited shell
+
+#sessions ended by the server because of a SessionLimits limit
+IDLE_TIMEOUT, MAX_DURATION, MAX_BYTES = 'idle_timeout', 'max_duration', 'max_bytes'
+LIMIT_REASONS = (IDLE_TIMEOUT, MAX_DURATION, MAX_BYTES)
+#what the client sees before the channel closes: bash's TMOUT auto-logout, or a plain logout
+DISCONNECT_MESSAGES = {
+    IDLE_TIMEOUT: b"\r\ntimed out waiting for input: auto-logout\r\n",
+    MAX_DURATION: b"\r\nlogout\r\n",
+    MAX_BYTES: b"\r\nlogout\r\n",
+}
+
+class SessionLimits:
+    #idle timeout (no client input), max session duration and max bytes relayed both ways, 0 disables one
+    def __init__(self, idle_timeout=0, max_duration=0, max_bytes=0):
+        self.idle_timeout = idle_timeout
+        self.max_duration = max_duration
+        self.max_bytes = max_bytes
+        self.started = self.last_input = time.monotonic()
+        self.bytes = 0
+
+    def input(self, size):
+        self.last_input = time.monotonic()
+        self.bytes += size
+
+    def output(self, size):
+        self.bytes += size
+
+    def timeout(self):
+        #seconds until the next time limit expires, None when there is none
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append(self.last_input + self.idle_timeout)
+        if self.max_duration:
+            deadlines.append(self.started + self.max_duration)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def exceeded(self):
+        #the reason the session has to end now, or None
+        now = time.monotonic()
+        if self.max_bytes and self.bytes >= self.max_bytes:
+            return MAX_BYTES
+        if self.max_duration and now >= self.started + self.max_duration:
+            return MAX_DURATION
+        if self.idle_timeout and now >= self.last_input + self.idle_timeout:
+            return IDLE_TIMEOUT
+        return None
+
+class PtyRelay:
+    def __init__(self, master_fd, chan, shell_process, on_input=None, on_output=None, is_shutdown=None,
+                 limits=None):
+        self.master_fd = master_fd
+        self.chan = chan
+        self.shell_process = shell_process
+        self.on_input = on_input      #called with the bytes typed by the client
+        self.on_output = on_output    #called with the bytes sent back by the shell
+        self.is_shutdown = is_shutdown or (lambda: False)
+        self.limits = limits or SessionLimits()
+        self.read_size = MIN_READ
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._pending_in = b""  #client input the pty couldn't take yet
+        self._pending_out = b""  #shell output the channel couldn't take yet
+        self._send_wait = SEND_WAIT_MIN
+
+    def _adapt(self, got, asked):
+        #grow the read size while reads come back full, shrink it back for interactive traffic
+        if got >= asked:
+            self.read_size = min(asked * 2, MAX_READ)
+        elif got < asked // 4:
+            self.read_size = max(asked // 2, MIN_READ)
+
+    def _read_shell(self):
+        #returns the output available right now (coalesced), b"" once the shell side is closed
+        chunks = []
+        total = 0
+        while total < COALESCE_BYTES:
+            asked = self.read_size
+            try:
+                output = os.read(self.master_fd, asked)
+            except BlockingIOError:
+                break
+            except OSError:
+                output = b""  #EIO once the shell has exited
+            if not output:
+                if not chunks:
+                    return b""
+                break
+            self._adapt(len(output), asked)
+            chunks.append(output)
+            total += len(output)
+        return b"".join(chunks) if chunks else None
+
+    def _write_shell(self, data):
+        data = self._pending_in + data
+        try:
+            written = os.write(self.master_fd, data)
+        except BlockingIOError:
+            written = 0
+        self._pending_in = data[written:]
+
+    def _send_output(self):
+        #sends what the client's window allows without blocking, False once the channel is closed
+        while self._pending_out and self.chan.send_ready():
+            if self.chan.closed:
+                return False
+            try:
+                sent = self.chan.send(self._pending_out)
+            except OSError:
+                return False
+            self._pending_out = self._pending_out[sent:]
+            self._send_wait = SEND_WAIT_MIN
+        return True
+
+    def _watch(self, poller, chan_fd):
+        #the shell isn't read while its output waits for the client, the client isn't read while
+        #its input waits for the pty
+        events = (0 if self._pending_out else select.EPOLLIN) | (select.EPOLLOUT if self._pending_in else 0)
+        if events != self._master_events:
+            if not events:
+                poller.unregister(self.master_fd)  #else EPOLLHUP would still be reported
+            elif not self._master_events:
+                poller.register(self.master_fd, events)
+            else:
+                poller.modify(self.master_fd, events)
+            self._master_events = events
+        poller.modify(chan_fd, 0 if self._pending_in else select.EPOLLIN)
+
+    def _wakeup_pipe(self):
+        #signals (shutdown, SIGCHLD) write a byte here so epoll returns right away
+        if threading.current_thread() is not threading.main_thread():
+            return None, None, None
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(w, False)
+        previous = signal.set_wakeup_fd(w, warn_on_full_buffer=False)
+        return r, w, previous
+
+    def run(self):
+        #returns why the relay stopped: 'shell_exit', 'client_closed', 'shutdown' or one of LIMIT_REASONS
+        chan_fd = self.chan.fileno()
+        os.set_blocking(self.master_fd, False)
+        poller = select.epoll()
+        poller.register(self.master_fd, select.EPOLLIN)
+        self._master_events = select.EPOLLIN
+        poller.register(chan_fd, select.EPOLLIN)
+
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(self.shell_process.pid)
+                poller.register(pidfd, select.EPOLLIN)
+            except OSError:
+                pidfd = None
+        wake_r, wake_w, previous_wakeup = self._wakeup_pipe()
+        previous_sigchld = None
+        if wake_r is not None:
+            poller.register(wake_r, select.EPOLLIN)
+            if pidfd is None:
+                #no pidfd (old kernel): a SIGCHLD handler is needed for the wakeup byte to be written
+                previous_sigchld = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        try:
+            return self._loop(poller, chan_fd, pidfd, wake_r)
+        finally:
+            poller.close()
+            if pidfd is not None:
+                os.close(pidfd)
+            if wake_r is not None:
+                signal.set_wakeup_fd(previous_wakeup)
+                if previous_sigchld is not None:
+                    signal.signal(signal.SIGCHLD, previous_sigchld)
+                os.close(wake_r)
+                os.close(wake_w)
+
+    def _loop(self, poller, chan_fd, pidfd, wake_r):
+        while True:
+            if self.is_shutdown():
+                return 'shutdown'
+            limit = self.limits.exceeded()
+            if limit is not None:
+                return limit
+            timeout = self.limits.timeout()
+            if wake_r is None:
+                #no wakeup pipe (not in the main thread): check the flags at least every second
+                timeout = 1 if timeout is None else min(timeout, 1)
+            if self._pending_out:
+                #the channel has no fd to wait on for its window to open
+                timeout = self._send_wait if timeout is None else min(timeout, self._send_wait)
+                self._send_wait = min(self._send_wait * 2, SEND_WAIT_MAX)
+            elif timeout is None:
+                timeout = -1
+            try:
+                events = poller.poll(timeout)
+            except InterruptedError:
+                continue
+            for fd, mask in events:
+                if fd == self.master_fd:
+                    if mask & select.EPOLLOUT:
+                        self._write_shell(b"")
+                    if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR) and not self._pending_out:
+                        output = self._read_shell()
+                        if output == b"":
+                            return 'shell_exit'
+                        if output:
+                            self._pending_out = output
+                            self.bytes_out += len(output)
+                            self.limits.output(len(output))
+                            if self.on_output is not None:
+                                self.on_output(output)
+                elif fd == chan_fd:
+                    if not (self.chan.recv_ready() or self.chan.closed or self.chan.eof_received):
+                        continue
+                    data = self.chan.recv(self.read_size)
+                    if not data:
+                        return 'client_closed'
+                    self.bytes_in += len(data)
+                    self.limits.input(len(data))
+                    self._write_shell(data)  #pty input buffer full: the client isn't read until the shell catches up
+                    if self.on_input is not None:
+                        self.on_input(data)
+                elif fd == pidfd:
+                    return self._drain_and_stop()
+                elif fd == wake_r:
+                    try:
+                        while os.read(wake_r, 512):
+                            pass
+                    except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+                    if self._shell_exited():
+                        return self._drain_and_stop()
+            if not self._send_output():
+                return 'client_closed'
+            self._watch(poller, chan_fd)
+
+    def _shell_exited(self):
+        #without collecting it (poll() would): close_session reads its resource usage with wait4
+        try:
+            return os.waitid(os.P_PID, self.shell_process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+        except ChildProcessError:
+            return True
+
+    def _drain_and_stop(self):
+        #the shell exited: forward its last output before stopping, as far as the client takes it in time
+        output = self._read_shell()
+        if output:
+            self._pending_out += output
+            self.bytes_out += len(output)
+            if self.on_output is not None:
+                self.on_output(output)
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self._send_output() and self._pending_out and time.monotonic() < deadline:
+            time.sleep(self._send_wait)
+            self._send_wait = min(self._send_wait * 2, SEND_WAIT_MAX)
+        return 'shell_exit'
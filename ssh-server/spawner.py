@@ -0,0 +1,297 @@
+import grp
+import logging
+import os
+import pty
+import pwd
+import resource
+import signal
+import subprocess
+import threading
+import time
+
+#Starting fshell for a session. The privileges are dropped by subprocess itself (user=, group=,
+#extra_groups=, umask=) instead of a preexec_fn, so no Python code runs in the child between
+#fork and exec.
+#
+#ShellPool keeps a few shells per user started in advance: a small sh launcher, already on its
+#own pty and running as the user, that reads the client IP from a pipe on stdin, puts the pty back
+#as stdin and execs fshell (fshell reads SSH_CLIENT_IP when it starts). Binding one to a session
+#is a pipe write.
+#
+#ResourceLimits caps what one session's shell can use: rlimits set on the shell process with
+#prlimit (inherited by everything it starts) and, when a delegated cgroup v2 directory is given,
+#a leaf cgroup per session. reap() collects the shell with wait4 for its CPU time and peak RSS.
+#The kernel counts the RSS the forked server had before exec in that peak: one no higher than the
+#spawning process's RSS at fork time says nothing about the shell and is reported as None (the
+#session cgroup's memory.peak, when there is one, doesn't have that problem).
+#Each shell runs in its own session and process group, so that reap() can also kill what the shell
+#left running (fshell has no job control, its commands stay in its group).
+
+LAUNCHER = 'IFS= read -r SSH_CLIENT_IP || exit 0; exec 0<&1; export SSH_CLIENT_IP; exec "$0"'
+
+def user_context(username):
+    #returns (Popen keyword arguments dropping to the user, home directory)
+    if os.getuid() != 0:
+        #not running as root: nothing to drop
+        try:
+            return {}, pwd.getpwnam(username).pw_dir
+        except KeyError:
+            return {}, os.path.expanduser("~")
+    try:
+        user = pwd.getpwnam(username)
+        group = grp.getgrnam(username)
+    except KeyError as e:
+        raise Exception(f"User or group {username} not found: {e}")
+    return {'user': user.pw_uid, 'group': group.gr_gid, 'extra_groups': [], 'umask': 0o077}, user.pw_dir
+
+def _rss_kb():
+    #current RSS of this process: what the child of a fork starts with, None if unknown
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _popen(args, username, env, stdin=None):
+    credentials, home = user_context(username)
+    fork_rss_kb = _rss_kb()
+    master_fd, slave_fd = pty.openpty() #create pseudo-terminal for shell interaction
+    try:
+        process = subprocess.Popen(
+            args,
+            stdin=slave_fd if stdin is None else stdin,
+            stdout=slave_fd,
+            stderr=slave_fd,
+            cwd=home if os.path.isdir(home) else None,
+            env=env,
+            close_fds=True,
+            start_new_session=True,  #its own process group, killed as a whole when the session ends
+            **credentials
+        )
+    except Exception:
+        os.close(master_fd)
+        raise
+    finally:
+        os.close(slave_fd)
+    process.fork_rss_kb = fork_rss_kb  #baseline of its wait4 peak RSS
+    return process, master_fd
+
+def spawn(shell_path, username, ip, env):
+    #starts fshell for a session right away, returns (process, pty master fd)
+    env = dict(env, SSH_CLIENT_IP=ip)
+    return _popen([shell_path], username, env)
+
+def reap(process, timeout=2):
+    #stops the shell if it's still running, kills what it left in its process group and collects it:
+    #returns (CPU seconds, peak RSS in kB) from wait4, or (None, None) if it was already collected;
+    #the peak RSS is None when it doesn't exceed the fork baseline
+    if process.returncode is not None:
+        return None, None
+    deadline = time.monotonic() + timeout
+    signal_sent = None
+    while True:
+        try:
+            exited = os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            return None, None
+        if exited is not None:
+            break
+        if signal_sent is None:
+            process.terminate()
+            signal_sent = 'term'
+        elif signal_sent == 'term' and time.monotonic() >= deadline:
+            process.kill()
+            signal_sent = 'kill'
+        time.sleep(0.01)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)  #the exited shell still holds its pid, so this is still its group
+    except OSError:
+        pass  #nothing left in the group
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)  #so that Popen never waits for it again
+    peak_rss_kb = usage.ru_maxrss
+    baseline = getattr(process, 'fork_rss_kb', None)
+    if baseline is None or peak_rss_kb <= baseline:
+        peak_rss_kb = None  #the forked server's memory, not the shell's
+    return round(usage.ru_utime + usage.ru_stime, 3), peak_rss_kb
+
+class ResourceLimits:
+    def __init__(self, cpu=0, address_space=0, nproc=0, fsize=0, cgroup_parent=None, cgroup_limits=None):
+        #rlimits (0 leaves one unset): CPU seconds, address space and file size in bytes, processes per user
+        self.rlimits = [(limit, value) for limit, value in ((resource.RLIMIT_CPU, cpu),
+                                                            (resource.RLIMIT_AS, address_space),
+                                                            (resource.RLIMIT_NPROC, nproc),
+                                                            (resource.RLIMIT_FSIZE, fsize)) if value]
+        self.cgroup_parent = cgroup_parent        #delegated cgroup v2 directory, one leaf per session is created in it
+        self.cgroup_limits = cgroup_limits or {}  #interface file -> value, e.g. {'pids.max': '64'}
+        self._lock = threading.Lock()
+        self._cgroups = {}  #shell pid -> its session cgroup
+        self.stats = {'applied': 0, 'failed': 0, 'cgroups': 0, 'cgroup_failed': 0}
+        if cgroup_parent:
+            self._enable_controllers()
+
+    def _enable_controllers(self):
+        controllers = {name.split('.', 1)[0] for name in self.cgroup_limits}
+        try:
+            with open(os.path.join(self.cgroup_parent, 'cgroup.subtree_control'), 'w') as f:
+                f.write(' '.join(f'+{controller}' for controller in sorted(controllers)))
+        except OSError as e:
+            logging.error(f"Could not enable the {sorted(controllers)} controllers in {self.cgroup_parent}: {e}")
+
+    def apply(self, pid):
+        #limits a freshly started shell, its children inherit them
+        try:
+            for limit, value in self.rlimits:
+                resource.prlimit(pid, limit, (value, value))
+        except OSError as e:
+            logging.error("Could not set the resource limits of shell %s: %s", pid, e)
+            with self._lock:
+                self.stats['failed'] += 1
+        else:
+            with self._lock:
+                self.stats['applied'] += 1
+        if self.cgroup_parent:
+            self._add_cgroup(pid)
+
+    def _add_cgroup(self, pid):
+        path = os.path.join(self.cgroup_parent, f'session-{pid}')
+        try:
+            os.mkdir(path)
+            for name, value in self.cgroup_limits.items():
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write(str(value))
+            with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+        except OSError as e:
+            logging.error("Could not put shell %s in cgroup %s: %s", pid, path, e)
+            self._remove_cgroup(path)
+            with self._lock:
+                self.stats['cgroup_failed'] += 1
+            return
+        with self._lock:
+            self._cgroups[pid] = path
+            self.stats['cgroups'] += 1
+
+    def release(self, pid):
+        #removes the session cgroup once the shell is gone, killing whatever it left running;
+        #returns its memory.peak in kB (the whole session, children included), None without a cgroup
+        with self._lock:
+            path = self._cgroups.pop(pid, None)
+        if path is None:
+            return None
+        try:
+            with open(os.path.join(path, 'memory.peak')) as f:
+                peak_kb = int(f.read()) // 1024
+        except (OSError, ValueError):
+            peak_kb = None  #no memory controller, or a kernel older than 5.19
+        self._remove_cgroup(path)
+        return peak_kb
+
+    def _remove_cgroup(self, path, timeout=1):
+        try:
+            with open(os.path.join(path, 'cgroup.kill'), 'w') as f:
+                f.write('1')
+        except OSError:
+            pass  #not created, or a kernel older than 5.14
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                os.rmdir(path)
+                return
+            except FileNotFoundError:
+                return
+            except OSError as e:
+                if time.monotonic() >= deadline:
+                    logging.error("Could not remove cgroup %s: %s", path, e)
+                    return
+                time.sleep(0.01)  #busy until the killed processes are gone
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def log_stats(self):
+        logging.info(f"Shell limits stats: {self.get_stats()}")
+
+class ShellPool:
+    def __init__(self, shell_path, env, size=2):
+        self.shell_path = shell_path
+        self.env = env
+        self.size = size    #warm shells kept per user
+        self._lock = threading.Lock()
+        self._shells = {}   #username -> [(process, master fd, ip pipe write end)]
+        self.stats = {'hits': 0, 'misses': 0, 'started': 0, 'dead': 0}
+
+    def _start(self, username):
+        ip_r, ip_w = os.pipe()
+        try:
+            process, master_fd = _popen(['/bin/sh', '-c', LAUNCHER, self.shell_path], username, self.env, ip_r)
+        finally:
+            os.close(ip_r)
+        return process, master_fd, ip_w
+
+    def fill(self, username):
+        #tops the user's pool up to size (blocking: run it off the event loop)
+        while True:
+            with self._lock:
+                if len(self._shells.setdefault(username, [])) >= self.size:
+                    return
+            try:
+                shell = self._start(username)
+            except Exception as e:
+                logging.error(f"Could not start a warm shell for {username}: {e}")
+                return
+            with self._lock:
+                self._shells[username].append(shell)
+                self.stats['started'] += 1
+
+    def take(self, username, ip):
+        #returns (process, pty master fd) bound to ip, or None if no warm shell is ready
+        while True:
+            with self._lock:
+                shells = self._shells.get(username)
+                if not shells:
+                    self.stats['misses'] += 1
+                    return None
+                process, master_fd, ip_w = shells.pop()
+            if process.poll() is None:
+                try:
+                    os.write(ip_w, ip.encode() + b'\n')
+                    os.close(ip_w)
+                    with self._lock:
+                        self.stats['hits'] += 1
+                    return process, master_fd
+                except OSError:
+                    pass
+            #the launcher died while waiting: discard it and try the next one
+            with self._lock:
+                self.stats['dead'] += 1
+            self._discard(process, master_fd, ip_w)
+
+    def _discard(self, process, master_fd, ip_w):
+        for fd in (ip_w, master_fd):
+            try:
+                os.close(fd)  #EOF on the launcher's stdin makes it exit
+            except OSError:
+                pass
+        try:
+            process.wait(1)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def close(self):
+        with self._lock:
+            shells = [shell for user_shells in self._shells.values() for shell in user_shells]
+            self._shells = {}
+        for shell in shells:
+            self._discard(*shell)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['warm'] = sum(len(shells) for shells in self._shells.values())
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Shell pool stats: {self.get_stats()}")
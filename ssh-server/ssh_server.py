@@ -1,58 +1,146 @@
 import logging
+import asyncio
 import argparse
-import select
-import socket
+import contextvars
 import threading
 import paramiko
 import time
 import os
+import select
 import signal
 import sys
-import subprocess
 import pymysql
-import pty
-import requests
-import pwd, grp
 import pam
 from dotenv import load_dotenv
 
-#logging to file with date and time.
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    filename="server.log",    # Log file (relative or absolute path)
-    filemode="a"              # Append mode
-)
-
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S")
-console.setFormatter(formatter)
-logging.getLogger("").addHandler(console)
+import admission
+import async_server
+import auth_policy
+import db_pool
+import event_writer
+import fingerprint
+import geo_cache
+import geo_worker
+import geoip
+import handoff
+import handshake
+import iplists
+import line_assembler
+import listeners
+import log_setup
+import metrics
+import notifier
+import relay
+import spawner
+import stats
+import tarpit
+import ttyrec
 
 #For soft shutdown with CTRL+C
 shutdown_requested = False
-
-HOST_KEY = paramiko.RSAKey(filename='key/serv_rsa.key')
+#graceful reload (SIGUSR2): a new server process takes the listening socket over, this one drains
+reload_requested = False
+#listening sockets handed over by the previous server process or by systemd (see handoff.py)
+INHERITED_SOCKETS = handoff.inherited_sockets()
 
 load_dotenv()
+
+#logging to file with date and time (text or JSON lines), written by a background thread of the
+#main process for every process of the server, see log_setup.py
+LOG_PIPELINE = log_setup.LogPipeline(
+    os.getenv('LOG_FILE', 'server.log'),
+    json_lines=os.getenv('LOG_FORMAT', 'text') == 'json',
+    console=os.getenv('LOG_CONSOLE', '1') == '1',
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024)),
+    backups=int(os.getenv('LOG_BACKUPS', 5)),
+    sample_rate=int(os.getenv('LOG_SAMPLE_RATE', 20))
+)
+
 DB_HOST = os.getenv('DB_HOST')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_NAME = os.getenv('DB_NAME')
 
+HOST_KEYS = handshake.load_host_keys('key')  #key/serv_rsa.key and, if generated, key/serv_ed25519.key
+#paramiko (stock paramiko settings), openssh (realistic OpenSSH fingerprint) or fast (cheapest KEX)
+HANDSHAKE = handshake.HandshakeProfile(os.getenv('SSH_HANDSHAKE_PROFILE', 'paramiko'), HOST_KEYS, os.getenv('SSH_BANNER'))
+
 DASHBOARD_URL = os.getenv('DASHBOARD_URL', 'http://localhost:5000')  # default: localhost:5000
 LOG_DIR = os.getenv('LOG_DIR', '/var/log/analytics')  # default: /var/log/analytics
 
+#local GeoIP range table (built with geoip.py), mapped once here and shared by the forked children
+GEOIP_DB = os.getenv('GEOIP_DB')
+GEOIP_TABLE = geoip.GeoIPTable(GEOIP_DB) if GEOIP_DB else None
+#ip-api.com is only used when there is no local table, unless asked for explicitly
+GEOIP_REMOTE_FALLBACK = os.getenv('GEOIP_REMOTE_FALLBACK', '0' if GEOIP_DB else '1') == '1'
+
+FSHELL_PATH = os.getenv('FSHELL_PATH', '/usr/bin/fshell')
+#warm shells kept per user in async/prefork mode (0: every shell is started on demand)
+SHELL_POOL_SIZE = int(os.getenv('SHELL_POOL_SIZE', 0))
+SHELL_POOL_USERS = [u.strip() for u in os.getenv('SHELL_POOL_USERS', 'froot').split(',') if u.strip()]
+SHELL_POOL = spawner.ShellPool(FSHELL_PATH, dict(os.environ, LOG_DIR=LOG_DIR), SHELL_POOL_SIZE) if SHELL_POOL_SIZE > 0 else None
+#per-session limits set on fshell when it is handed to a session (0/empty: unset), and optionally
+#a cgroup v2 leaf per session under SHELL_CGROUP (a directory delegated to the server)
+SHELL_LIMITS = spawner.ResourceLimits(
+    cpu=int(os.getenv('SHELL_RLIMIT_CPU', 60)),
+    address_space=int(os.getenv('SHELL_RLIMIT_AS_MB', 512)) * 1024 * 1024,
+    nproc=int(os.getenv('SHELL_RLIMIT_NPROC', 0)),
+    fsize=int(os.getenv('SHELL_RLIMIT_FSIZE_MB', 16)) * 1024 * 1024,
+    cgroup_parent=os.getenv('SHELL_CGROUP') or None,
+    cgroup_limits={name: value for name, value in (('pids.max', os.getenv('SHELL_CGROUP_PIDS_MAX', '64')),
+                                                   ('memory.max', os.getenv('SHELL_CGROUP_MEMORY_MAX', '256M')),
+                                                   ('cpu.max', os.getenv('SHELL_CGROUP_CPU_MAX', '50000 100000')))
+                   if value}
+)
+
+#sessions are ended by the server after this long without client input, this long in total or
+#this many bytes relayed both ways (0 disables a limit)
+SESSION_IDLE_TIMEOUT = int(os.getenv('SESSION_IDLE_TIMEOUT', 600))
+SESSION_MAX_DURATION = int(os.getenv('SESSION_MAX_DURATION', 3600))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 50 * 1024 * 1024))
+#sessions reaped per limit, counted by every forked child / worker in shared memory
+REAPED_SESSIONS = stats.SharedCounters(relay.LIMIT_REASONS)
+
+#Prometheus metrics shared by every server process, served on --metrics-port (see metrics.py)
+METRICS = metrics.Registry()
+PHASES = ('banner', 'kex', 'auth', 'db_write', 'db_batch', 'geolocation', 'spawn')
+PHASE_SECONDS = METRICS.histogram('honeypot_phase_seconds', "Time spent in each step of a connection "
+                                  "(accept to client banner, key exchange, PAM, session row writes, batched event "
+                                  "writes, geolocation batches, fshell spawn)", label='phase', values=PHASES)
+SESSION_SECONDS = METRICS.histogram('honeypot_session_duration_seconds', "Duration of the shell sessions",
+                                    metrics.DURATION_BUCKETS)
+REJECTED = METRICS.counter('honeypot_connections_rejected_total', "Connections closed or diverted before the handshake",
+                           label='reason', values=('denied', 'admission', 'tarpit'))
+AUTHENTICATED = METRICS.counter('honeypot_sessions_authenticated_total', "Clients that logged in and opened a shell")
+ACTIVE_SESSIONS = METRICS.gauge('honeypot_sessions_active', "Shell sessions in progress")
+METRICS_SERVER = None  #metrics.MetricsServer, started with --metrics-port in the process running the accept loop
+
+#addresses served by the accept loop (see listeners.py), --listen overrides them
+LISTEN_ADDRESSES = listeners.parse(os.getenv('LISTEN_ADDRS', listeners.DEFAULT))
+LISTENER_STATS = None  #accepted/active connections per listener, created once the listeners are known
+
+#session recordings (both directions of the relay, see ttyrec.py), empty disables them
+TTYREC_DIR = os.getenv('TTYREC_DIR', 'ttyrec')
+
+#sensor mode (--sensor): passwords are checked against an in-memory policy instead of PAM
+SENSOR_POLICY = None
+
 if not all([DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DASHBOARD_URL]):
     raise EnvironmentError("Missing required database environment variables")
 
 class Server(paramiko.ServerInterface):
-    def __init__(self):
-        self.event = threading.Event()
-        self.pam_auth = pam.pam()
+    def __init__(self, event=None):
+        self.event = event if event is not None else threading.Event()  #set on shell request
+        self.pam_auth = None  #created on first use: sensor mode never needs it
         self.ip = 'unknown'  #default if not set externally
+        self.shell_user = None  #system user fshell runs as, set once authenticated
+        self.term_size = (80, 24)  #from the pty request, for the session recording
+        self.port = None  #local port the client connected to
+        self.transport = None  #fingerprint.Transport serving the client, set by create_transport
+
+    def client_fingerprint(self):
+        #version string and KEXINIT of the client, captured during the key exchange
+        return self.transport.client_fingerprint if self.transport is not None else None
 
     def check_channel_request(self, kind, chanid):
         if kind == 'session':
@@ -61,30 +149,56 @@ class Server(paramiko.ServerInterface):
 
     def check_auth_password(self, username, password):
         original_username = username #storing the original username for logging
+        if TARPIT is not None:
+            TARPIT.check_credentials(self.ip, original_username, password)  #traps the IP's next connections
         if username == "root":
             username = "froot"
-            logging.info(f"Redirecting root user to {username}")
+            logging.info("Redirecting root user to %s", username, extra={'sample': 'root_redirect'})
 
         if ALLOW_ROOT and original_username == "root": #automatically accept all root connections
-            logging.info("ALLOW_ROOT mode enabled: accepting authentication for root for user: " + original_username)
-            log_login_attempt(self.ip, original_username, password, True)
-            logging.info(f"PAM authentication successful for user: {original_username}")
+            logging.info("ALLOW_ROOT mode enabled: accepting authentication for root for user: %s", original_username)
+            log_login_attempt(self.ip, original_username, password, True, self.client_fingerprint())
+            logging.info("PAM authentication successful for user: %s", original_username)
+            self.shell_user = username
             return paramiko.AUTH_SUCCESSFUL
+        elif SENSOR_POLICY is not None: #sensor mode: answered from memory, PAM only for what the policy accepts
+            accepted = SENSOR_POLICY.allows(original_username, password)
+            shell_user = SENSOR_POLICY.shell_user
+            if accepted and SENSOR_POLICY.pam:
+                accepted = self.pam_authenticate(username, password)
+                SENSOR_POLICY.pam_checked(accepted)
+                shell_user = username
+            log_login_attempt(self.ip, original_username, password, accepted, self.client_fingerprint())
+            if accepted:
+                logging.info("Sensor policy accepted user: %s", original_username)
+                self.shell_user = shell_user
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
         else: #use PAM authentication for non-root (or redirected root) users
-            if self.pam_auth.authenticate(username, password, service='honeypot'):
-                logging.info(f"PAM authentication successful for user: {username}")
-                result = paramiko.AUTH_SUCCESSFUL
-            else:
-                logging.error(f"PAM authentication failed for user: {username} - {self.pam_auth.reason}")
-                result = paramiko.AUTH_FAILED
+            authenticated = self.pam_authenticate(username, password)
+            if authenticated:
+                self.shell_user = username
+            log_login_attempt(self.ip, username, password, authenticated, self.client_fingerprint())
+            return paramiko.AUTH_SUCCESSFUL if authenticated else paramiko.AUTH_FAILED
 
-            log_login_attempt(self.ip, username, password, result == paramiko.AUTH_SUCCESSFUL)
-            return result
+    def pam_authenticate(self, username, password):
+        if self.pam_auth is None:
+            self.pam_auth = pam.pam()
+        with PHASE_SECONDS.time('auth'):
+            authenticated = self.pam_auth.authenticate(username, password, service='honeypot')
+        if authenticated:
+            logging.info("PAM authentication successful for user: %s", username)
+        else:
+            logging.error("PAM authentication failed for user: %s - %s", username, self.pam_auth.reason,
+                          extra={'sample': 'auth_failure'})
+        return authenticated
 
     def get_allowed_auths(self, username):
         return 'password'
 
     def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        if width and height:
+            self.term_size = (width, height)
         return True
 
     def check_channel_shell_request(self, channel):
@@ -100,355 +214,910 @@ def get_db_connection():
         cursorclass=pymysql.cursors.DictCursor
     )
 
-def log_connection(ip, pseudo_id, duration):
-    connection = get_db_connection()
+#one pool per process; forked children start with an empty pool of their own
+DB_POOL = db_pool.ConnectionPool(
+    get_db_connection,
+    max_size=int(os.getenv('DB_POOL_SIZE', 4)),
+    max_idle=int(os.getenv('DB_POOL_MAX_IDLE', 300))
+)
+
+#IP -> location cache shared by every server process (SQLite, WAL mode), empty path to disable
+GEO_CACHE_PATH = os.getenv('GEO_CACHE_PATH', 'geo_cache.sqlite')
+GEO_CACHE = geo_cache.GeoCache(
+    GEO_CACHE_PATH,
+    negative_ttl=int(os.getenv('GEO_NEGATIVE_TTL', 3600)),
+    max_entries=int(os.getenv('GEO_CACHE_SIZE', 200000))
+) if GEO_CACHE_PATH else None
+
+#source IPs are geolocated in the background (cache, local table, then ip-api.com), in batches
+GEO_WORKER = geo_worker.GeoWorker(
+    DB_POOL,
+    local_lookup=GEOIP_TABLE.lookup if GEOIP_TABLE is not None else None,
+    remote=GEOIP_REMOTE_FALLBACK,
+    api_url=os.getenv('GEO_API_URL', geo_worker.IP_API_BATCH_URL),
+    negative_ttl=int(os.getenv('GEO_NEGATIVE_TTL', 3600)),
+    batch_wait=float(os.getenv('GEO_BATCH_WAIT', 0.25)),
+    cache=GEO_CACHE,
+    on_batch=lambda seconds: PHASE_SECONDS.observe(seconds, 'geolocation')
+)
+
+#allow/deny/exclude address lists (one address or CIDR per line), reloaded on SIGHUP
+ACCESS_LISTS = iplists.AccessLists(
+    allow_path=os.getenv('ACCESS_ALLOW_FILE'),
+    deny_path=os.getenv('ACCESS_DENY_FILE'),
+    exclude_path=os.getenv('ACCESS_EXCLUDE_FILE')
+)
+
+#dashboard presence updates, batched and sent by a single thread for all server processes
+NOTIFIER = notifier.Notifier(f"{DASHBOARD_URL}/notify_status")
+
+#per-IP rate and concurrency limits, checked before forking or starting the handshake
+ADMISSION = admission.Admission(
+    rate=float(os.getenv('ADMIT_RATE', 0.5)),
+    burst=int(os.getenv('ADMIT_BURST', 10)),
+    max_per_ip=int(os.getenv('ADMIT_MAX_PER_IP', 4)),
+    max_total=int(os.getenv('ADMIT_MAX_TOTAL', 512)),
+    max_ips=int(os.getenv('ADMIT_MAX_IPS', 100000)),
+    log_every=int(os.getenv('ADMIT_LOG_EVERY', 100))
+)
+
+#sources held in the tarpit instead of being served: TARPIT_NETWORKS (comma separated CIDRs)
+#and IPs that tried one of the TARPIT_CREDENTIALS patterns (username:password globs, one per line)
+TARPIT_NETWORKS = [n.strip() for n in os.getenv('TARPIT_NETWORKS', '').split(',') if n.strip()]
+TARPIT_CREDENTIALS = os.getenv('TARPIT_CREDENTIALS')
+TARPIT = tarpit.Tarpit(
+    networks=TARPIT_NETWORKS,
+    credentials=auth_policy.load_credentials(TARPIT_CREDENTIALS) if TARPIT_CREDENTIALS else (),
+    delay=float(os.getenv('TARPIT_DELAY', 10)),
+    max_trapped=int(os.getenv('TARPIT_MAX', 10000)),
+    mark_ttl=int(os.getenv('TARPIT_MARK_TTL', 86400))
+) if TARPIT_NETWORKS or TARPIT_CREDENTIALS else None
+
+#client fingerprints (version string, KEXINIT, HASSH) interned into client_fingerprints, ids cached per process
+FINGERPRINTS = fingerprint.FingerprintStore(DB_POOL, max_cached=int(os.getenv('FINGERPRINT_CACHE_SIZE', 10000)))
+
+#login attempts and commands are written off the SSH path, in batches
+EVENT_WRITER = event_writer.EventWriter(
+    DB_POOL,
+    {
+        'login_attempt': "INSERT INTO login_attempts (ip, username, password, status, fingerprint_id) VALUES (%s, %s, %s, %s, %s)",
+        'command': "INSERT INTO user_commands (connection_id, command) VALUES (%s, %s)",
+    },
+    max_queue=int(os.getenv('EVENT_QUEUE_SIZE', 10000)),
+    batch_size=int(os.getenv('EVENT_BATCH_SIZE', 200)),
+    flush_interval=float(os.getenv('EVENT_FLUSH_INTERVAL', 0.5)),
+    on_batch=lambda seconds: PHASE_SECONDS.observe(seconds, 'db_batch'),
+    prepare={'login_attempt': lambda rows: FINGERPRINTS.resolve(rows, 4)}  #fingerprint -> id, off the auth path
+)
+
+def log_connection(ip, pseudo_id, duration, port=None, fingerprint_id=None):
     try:
-        with connection.cursor() as cursor:
-            sql = "INSERT INTO connections (ip, pseudo_id, duration, status) VALUES (%s, %s, %s, %s)"
-            cursor.execute(sql, (ip, pseudo_id, duration, True))  #setting the status to true for the dashboard to read it
-            connection.commit()
-            return cursor.lastrowid  #returning the ID of the new connection
+        with DB_POOL.connection() as connection:
+            with connection.cursor() as cursor:
+                sql = ("INSERT INTO connections (ip, pseudo_id, duration, status, port, fingerprint_id) "
+                       "VALUES (%s, %s, %s, %s, %s, %s)")
+                cursor.execute(sql, (ip, pseudo_id, duration, True, port, fingerprint_id))  #setting the status to true for the dashboard to read it
+                connection.commit()
+                return cursor.lastrowid  #returning the ID of the new connection
     except pymysql.Error as e:
-        logging.error(f"Database error: {e}")
+        logging.error("Database error: %s", e)
         raise
-    finally:
-        connection.close()
 
 def update_connection_status(connection_id, status):
-    connection = get_db_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = "UPDATE connections SET status = %s WHERE id = %s"
-            cursor.execute(sql, (status, connection_id))
-        connection.commit()
+        with DB_POOL.connection() as connection:
+            with connection.cursor() as cursor:
+                sql = "UPDATE connections SET status = %s WHERE id = %s"
+                cursor.execute(sql, (status, connection_id))
+            connection.commit()
     except pymysql.Error as e:
-        logging.error(f"Database error: {e}")
+        logging.error("Database error: %s", e)
         raise
-    finally:
-        connection.close()
 
-def update_connection_duration(connection_id, duration):
-    connection = get_db_connection()
+def update_connection_duration(connection_id, duration, end_reason=None, cpu_seconds=None, peak_rss_kb=None):
     try:
-        with connection.cursor() as cursor:
-            sql = "UPDATE connections SET duration = %s WHERE id = %s"
-            cursor.execute(sql, (duration, connection_id))
-        connection.commit()
+        with DB_POOL.connection() as connection:
+            with connection.cursor() as cursor:
+                sql = "UPDATE connections SET duration = %s, end_reason = %s, cpu_seconds = %s, peak_rss_kb = %s WHERE id = %s"
+                cursor.execute(sql, (duration, end_reason, cpu_seconds, peak_rss_kb, connection_id))
+            connection.commit()
     except pymysql.Error as e:
-        logging.error(f"Database error: {e}")
+        logging.error("Database error: %s", e)
         raise
-    finally:
-        connection.close()
 
 def log_command(connection_id, command):
-    connection = get_db_connection()
-    try:
-        with connection.cursor() as cursor:
-            sql = "INSERT INTO user_commands (connection_id, command) VALUES (%s, %s)"
-            cursor.execute(sql, (connection_id, command))
-        connection.commit()
-    finally:
-        connection.close()
+    #queued, written in batches by the event writer thread
+    EVENT_WRITER.submit('command', (connection_id, command))
 
-def log_login_attempt(ip, username, password, success):
-    connection = get_db_connection()
-    try:
-        with connection.cursor() as cursor:
-            sql = "INSERT INTO login_attempts (ip, username, password, status) VALUES (%s, %s, %s, %s)"
-            cursor.execute(sql, (ip, username, password, success))
-        connection.commit()
-    finally:
-        connection.close()
+def intern_fingerprint(client_fingerprint):
+    #client_fingerprints id (cached per process), None when the key exchange wasn't seen
+    return FINGERPRINTS.intern(client_fingerprint) if client_fingerprint is not None else None
 
-def drop_privileges(uid_name, gid_name):
-    #security measure to run as non-root user
-    if os.getuid() != 0:
-        return
+def log_login_attempt(ip, username, password, success, client_fingerprint=None):
+    if ip in ACCESS_LISTS.exclude:
+        return  #our own scanners and probes
+    EVENT_WRITER.submit('login_attempt', (ip, username, password, success, client_fingerprint))  #id resolved by the writer
 
-    try:
-        running_uid = pwd.getpwnam(uid_name).pw_uid
-        running_gid = grp.getgrnam(gid_name).gr_gid
-    except KeyError as e:
-        raise Exception(f"User or group {uid_name} not found: {e}")
-
-    os.setgid(running_gid)
-    os.setgroups([]) #remove all additional groups
-    os.setuid(running_uid)
-    os.umask(0o077) #set restrictive file creation mask
-
-def handle_connection(client, addr):
-    transport = paramiko.Transport(client)
-    transport.add_server_key(HOST_KEY)
-    server = Server()
+def create_transport(client, addr, server_event=None, accepted_at=None):
+    transport = fingerprint.Transport(client)  #keeps the client's KEXINIT and the handshake timings
+    transport.accepted_at = accepted_at if accepted_at is not None else time.monotonic()
+    HANDSHAKE.apply(transport)  #host keys, banner and allowed algorithms
+    server = Server(server_event)
     server.ip = addr[0]  #passing connection IP for logging
+    server.port = client.getsockname()[1]
+    server.transport = transport
+    transport.log_client = f"{addr[0]}:{addr[1]}"  #tags the records logged by the transport thread (auth)
     
     transport.banner_timeout = 15 
     transport.auth_timeout = 30
+    return transport, server
+
+def notify_status(ip, online):
+    NOTIFIER.notify(ip, online)  #sent to the dashboard by the notifier thread, never waited for
+
+def open_session(ip, port=None, client_fingerprint=None):
+    if ip in ACCESS_LISTS.exclude:
+        return None  #served, but neither recorded nor shown on the dashboard
+
+    #notifying the dashboard about new connection
+    notify_status(ip, True)
+
+    pseudo_id = str(time.time())
+    fingerprint_id = intern_fingerprint(client_fingerprint)
+    with PHASE_SECONDS.time('db_write'):
+        connection_id = log_connection(ip, pseudo_id, 0, port, fingerprint_id)
+    logging.info("New connection logged with ID: %s", connection_id)
+    return connection_id
+
+def spawn_shell(ip, username):
+    #fshell with dropped privileges, from the warm pool when there is one
+    with PHASE_SECONDS.time('spawn'):
+        shell = SHELL_POOL.take(username, ip) if SHELL_POOL is not None else None
+        if shell is None:
+            env = os.environ.copy()
+            env["LOG_DIR"] = LOG_DIR
+            shell = spawner.spawn(FSHELL_PATH, username, ip, env)
+        SHELL_LIMITS.apply(shell[0].pid)
+    return shell
+
+def open_recorder(ip, connection_id, term_size):
+    #session recording, None when disabled, for unrecorded (excluded) sessions or if the file can't be created
+    if not TTYREC_DIR or connection_id is None:
+        return None
+    path = os.path.join(TTYREC_DIR, f"session_{ip}_{time.strftime('%Y%m%d-%H%M%S')}_{connection_id}.hprec")
+    try:
+        os.makedirs(TTYREC_DIR, exist_ok=True)
+        return ttyrec.Recorder(path, *term_size)
+    except OSError as e:
+        logging.error("Could not create recording %s: %s", path, e)
+        return None
+
+def close_recorder(recorder):
+    if recorder is not None:
+        recorder.close()
+        logging.info("Recorded %s bytes in, %s bytes out to %s", recorder.bytes_in, recorder.bytes_out, recorder.path)
+
+def command_logger(connection_id, recorder=None):
+    #returns the relay input callback: logs each command line once it's complete (and records the raw input)
+    assembler = line_assembler.LineAssembler()
+
+    def on_input(data):
+        if recorder is not None:
+            recorder.input(data)
+        for line in assembler.feed(data):
+            log_command(connection_id, line)
+    return on_input
+
+def session_limits():
+    return relay.SessionLimits(SESSION_IDLE_TIMEOUT, SESSION_MAX_DURATION, SESSION_MAX_BYTES)
+
+def reap_session(chan, ip, reason):
+    #ends a session that hit a limit the way a shell logging out would: message, exit status, close
+    logging.info("Reaping session from %s: %s", ip, reason)
+    REAPED_SESSIONS.add(reason)
+    try:
+        chan.settimeout(5)  #given up on if the client doesn't read it in time, as reap_session_async
+        chan.sendall(relay.DISCONNECT_MESSAGES[reason])
+        chan.send_exit_status(0)
+    except TimeoutError:
+        pass  #socket.timeout: the channel is closed all the same
+    except Exception as e:
+        logging.error("Could not send the disconnect message to %s: %s", ip, e)
+
+async def reap_session_async(chan, ip, reason):
+    #reap_session for the event loop: the message is given up on if the client doesn't read it in time
+    logging.info("Reaping session from %s: %s", ip, reason)
+    REAPED_SESSIONS.add(reason)
+    try:
+        if await async_server.send_all(chan, relay.DISCONNECT_MESSAGES[reason], timeout=5):
+            chan.send_exit_status(0)
+    except Exception as e:
+        logging.error("Could not send the disconnect message to %s: %s", ip, e)
+
+def close_session(ip, connection_id, start_time, shell_process, master_fd, end_reason=None):
+    if master_fd is not None:
+        os.close(master_fd)
+    cpu_seconds = peak_rss_kb = None
+    if shell_process is not None:
+        cpu_seconds, peak_rss_kb = spawner.reap(shell_process)
+        cgroup_peak_kb = SHELL_LIMITS.release(shell_process.pid)
+        if cgroup_peak_kb is not None:
+            peak_rss_kb = cgroup_peak_kb  #whole session, without the fork baseline
+    ACTIVE_SESSIONS.dec()
+    SESSION_SECONDS.observe(time.time() - start_time)
+    duration = int(time.time() - start_time)
+    logging.info('Connection from %s closed after %s seconds (%s, shell used %s CPU seconds, %s kB peak RSS)',
+                 ip, duration, end_reason, cpu_seconds, peak_rss_kb)
+    if connection_id is not None:
+        with PHASE_SECONDS.time('db_write'):
+            update_connection_duration(connection_id, duration, end_reason, cpu_seconds, peak_rss_kb)
+            update_connection_status(connection_id, False)  # offline
+
+def observe_handshake(transport):
+    #accept to client banner, then banner to keys exchanged (as far as the client got)
+    if transport.banner_at is not None:
+        PHASE_SECONDS.observe(transport.banner_at - transport.accepted_at, 'banner')
+        if transport.kex_done_at is not None:
+            PHASE_SECONDS.observe(transport.kex_done_at - transport.banner_at, 'kex')
+
+def handle_connection(client, addr, accepted_at=None):
+    log_setup.CLIENT.set(f"{addr[0]}:{addr[1]}")
+    transport, server = create_transport(client, addr, accepted_at=accepted_at)
     
     try:
         transport.start_server(server=server)
     except (paramiko.SSHException, EOFError) as e:
-        logging.error(f'SSH negotiation failed: {str(e)}')
+        logging.error('SSH negotiation failed: %s', e, extra={'sample': 'negotiation_failure'})
         transport.close()
         client.close()
         return
+    finally:
+        observe_handshake(transport)
 
     chan = transport.accept(20)
     if chan is None:
         logging.error('No channel.')
+        transport.close()
         return
 
     ip = addr[0]
-    username = transport.get_username()
-    logging.info(f'Authenticated connection from {ip} as {username}')
-
-    #ensuring root user is redirected to froot
-    if username == "root":
-        username = "froot"
-        logging.info(f"Redirecting root user to {username}")
+    logging.info('Authenticated connection from %s as %s (%s)', ip, transport.get_username(), transport.remote_version)
+    username = server.shell_user  #root is redirected to froot, sensor sessions run as the policy's user
+    AUTHENTICATED.inc()
 
-    #notifying the dashboard about new connection
-    try:
-        requests.post(f"{DASHBOARD_URL}/notify_status", json={'ip': ip, 'online': True}, timeout=10)
-    except Exception as e:
-        logging.error(f"Error notifying status update: {e}")
-
-    pseudo_id = str(time.time())
     start_time = time.time()
+    ACTIVE_SESSIONS.inc()  #until close_session
+    connection_id = None
+    shell_process = None
+    master_fd = None
+    recorder = None
+    end_reason = 'error'
     
     try:
-        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-        connection_id = log_connection(ip, pseudo_id, 0)
-        logging.info(f"New connection logged with ID: {connection_id}")
-        #threading.Thread(target=update_ip_geolocation, args=(ip,)).start()
-        update_ip_geolocation(ip) #trying in the main thread
-
-        try:
-            user_home = pwd.getpwnam(username).pw_dir
-        except KeyError:
-            user_home = os.path.expanduser("~")
-        logging.info(f"User home directory: {user_home}")
-
-        env = os.environ.copy()
-        env["SSH_CLIENT_IP"] = ip #passing client IP to shell environment
-        env["LOG_DIR"] = LOG_DIR
-
-        shell_path = os.path.abspath('/usr/bin/fshell')
-        master_fd, slave_fd = pty.openpty() #create pseudo-terminal for shell interaction
-
-        env = os.environ.copy()
-        env["SSH_CLIENT_IP"] = ip
-
-        #launching fshell with dropped privileges
-        shell_process = subprocess.Popen(
-            [shell_path],
-            stdin=slave_fd,
-            stdout=slave_fd,
-            stderr=slave_fd,
-            cwd=user_home,
-            env=env,
-            preexec_fn=lambda: drop_privileges(username, username),
-            close_fds=True
-        )
-        os.close(slave_fd)
+        connection_id = open_session(ip, server.port, server.client_fingerprint())
+        log_setup.CONNECTION_ID.set(connection_id)
+        shell_process, master_fd = spawn_shell(ip, username)
 
-        cmd_buffer = b""
-        while not shutdown_requested:
-            rlist, _, _ = select.select([master_fd, chan], [], [], 0.1)
-            if master_fd in rlist:
-                try:
-                    output = os.read(master_fd, 1024)
-                    if output:
-                        chan.send(output)
-                    else:
-                        break
-                except OSError:
-                    break
-            if chan in rlist:
-                try:
-                    data = chan.recv(1024)
-                    if data:
-                        os.write(master_fd, data)
-                        cmd_buffer += data
-                        if cmd_buffer.endswith(b'\n') or cmd_buffer.endswith(b'\r'):
-                            lines = cmd_buffer.decode('utf-8', errors='ignore').splitlines()
-                            for line in lines:
-                                line = line.strip()
-                                if line:
-                                    log_command(connection_id, line)
-                            cmd_buffer = b""
-                    else:
-                        break
-                except Exception:
-                    break
-            if shell_process.poll() is not None:
-                break
+        recorder = open_recorder(ip, connection_id, server.term_size)
+        on_input = command_logger(connection_id, recorder) if connection_id is not None else None
+        session_relay = relay.PtyRelay(master_fd, chan, shell_process, on_input=on_input,
+                                       on_output=recorder.output if recorder is not None else None,
+                                       is_shutdown=lambda: shutdown_requested, limits=session_limits())
+        end_reason = session_relay.run()
+        logging.info("Session relay ended (%s): %s bytes in, %s bytes out", end_reason, session_relay.bytes_in, session_relay.bytes_out)
+        if end_reason in relay.LIMIT_REASONS:
+            reap_session(chan, ip, end_reason)
     except Exception as e:
-        logging.error(f'Connection error: {e}')
+        logging.error('Connection error: %s', e)
     finally:
-        if shell_process.poll() is None:
-            shell_process.terminate()
-        duration = int(time.time() - start_time)
-        logging.info(f'Connection from {addr[0]} closed after {duration} seconds')
-        update_connection_duration(connection_id, duration)
-        update_connection_status(connection_id, False)  # offline
+        close_recorder(recorder)
+        close_session(ip, connection_id, start_time, shell_process, master_fd, end_reason)
         chan.close()
         transport.close()
-        try:
-            requests.post(f"{DASHBOARD_URL}/notify_status", json={'ip': ip, 'online': False}, timeout=10)
-        except Exception as e:
-            logging.error(f"Error notifying status update: {e}")
+        if connection_id is not None:
+            notify_status(ip, False)
+
+def run_blocking(loop, func, *args):
+    #run_in_executor, keeping the task's context (client and connection id of the log records)
+    return loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+async def handle_connection_async(client, addr):
+    #same flow as handle_connection, but the waits happen on the event loop instead of
+    #blocking a forked process; paramiko still runs one Transport thread per connection
+    loop = asyncio.get_running_loop()
+    ip = addr[0]
+    log_setup.CLIENT.set(f"{addr[0]}:{addr[1]}")  #this task's context only
+    client.setblocking(True)  #paramiko expects a blocking socket with its own timeouts
+    transport, server = create_transport(client, addr, async_server.LoopEvent(loop))
 
-def fetch_geolocation(ip):
-    url = f"http://ip-api.com/json/{ip}"
+    negotiated = async_server.LoopEvent(loop)
     try:
-        response = requests.get(url, timeout=5)
-        #handling rate limiting from the API
-        remaining = response.headers.get("X-Rl")
-        ttl = response.headers.get("X-Ttl")
-        if remaining is not None and int(remaining) == 0:
-            logging.info(f"Rate limit reached for IP-API. Please wait {ttl} seconds until the limit resets.")
-            return None
-
-        data = response.json()
-        if data.get('status') == 'success':
-            return {
-                'country': data.get('country'),
-                'country_code': data.get('countryCode'),
-                'region': data.get('regionName'),
-                'city': data.get('city'),
-                'lat': data.get('lat'),
-                'lon': data.get('lon')
-            }
-    except Exception as e:
-        logging.error(f"Error fetching geolocation: {e}")
-    return None
+        transport.start_server(event=negotiated, server=server)
+        await negotiated.wait_async(transport.banner_timeout + 30)
+    except (paramiko.SSHException, EOFError, asyncio.TimeoutError) as e:
+        logging.error('SSH negotiation failed: %s', e, extra={'sample': 'negotiation_failure'})
+        transport.close()
+        return
+    finally:
+        observe_handshake(transport)
+    if not transport.is_active():
+        logging.error('SSH negotiation failed: %s', transport.get_exception(), extra={'sample': 'negotiation_failure'})
+        transport.close()
+        return
+
+    #nothing is spawned until the client is authenticated and asks for a shell
+    if not await async_server.wait_shell_request(transport, server.event, transport.auth_timeout + 20):
+        logging.error('No channel.')
+        transport.close()
+        return
+    chan = transport.accept(0)
+    if chan is None:
+        logging.error('No channel.')
+        transport.close()
+        return
+
+    logging.info('Authenticated connection from %s as %s (%s)', ip, transport.get_username(), transport.remote_version)
+    username = server.shell_user  #root is redirected to froot, sensor sessions run as the policy's user
+    AUTHENTICATED.inc()
+
+    start_time = time.time()
+    ACTIVE_SESSIONS.inc()  #until close_session
+    connection_id = None
+    shell_process = None
+    master_fd = None
+    recorder = None
+    end_reason = 'error'
 
-def update_ip_geolocation(ip):
-    connection = get_db_connection()
     try:
-        with connection.cursor() as cursor:
-            #check if we already have recent data for this IP
-            sql = "SELECT * FROM ip_geolocations WHERE ip = %s ORDER BY fetched_at DESC LIMIT 1"
-            cursor.execute(sql, (ip,))
-            result = cursor.fetchone()
-            
-            fetch_new = False
-            if result:
-                #only update geolocations older than 1 day to avoid API rate limits
-                record_time = result.get('fetched_at')
-                if record_time is None or record_time < datetime.now() - timedelta(days=1):
-                    fetch_new = True
-                else:
-                    logging.info(f"Geolocation for {ip} is recent; not updating.")
-            else:
-                fetch_new = True
-
-            if fetch_new:
-                logging.info(f"Fetching geolocation for {ip}.")
-                geo = fetch_geolocation(ip)
-                if geo:
-                    if result: #update existing record
-                        update_sql = """
-                            UPDATE ip_geolocations 
-                            SET country = %s,
-                                country_code = %s,
-                                region = %s,
-                                city = %s,
-                                lat = %s,
-                                lon = %s,
-                                fetched_at = NOW()
-                            WHERE ip = %s
-                        """
-                        cursor.execute(update_sql, (
-                            geo.get('country'),
-                            geo.get('country_code'),
-                            geo.get('region'),
-                            geo.get('city'),
-                            geo.get('lat'),
-                            geo.get('lon'),
-                            ip
-                        ))
-                    else: #create new record
-                        insert_sql = """
-                            INSERT INTO ip_geolocations (ip, country, country_code, region, city, lat, lon)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        """
-                        cursor.execute(insert_sql, (
-                            ip,
-                            geo.get('country'),
-                            geo.get('country_code'),
-                            geo.get('region'),
-                            geo.get('city'),
-                            geo.get('lat'),
-                            geo.get('lon')
-                        ))
-                    connection.commit()
-                    return geo
-                else:
-                    logging.error(f"Failed to fetch geolocation for {ip}.")
-                    return None
-            else:
-                return result
+        connection_id = await run_blocking(loop, open_session, ip, server.port, server.client_fingerprint())
+        log_setup.CONNECTION_ID.set(connection_id)
+        shell_process, master_fd = await run_blocking(loop, spawn_shell, ip, username)
+        if SHELL_POOL is not None:
+            loop.run_in_executor(None, SHELL_POOL.fill, username)  #replace the shell taken from the pool
+
+        recorder = await run_blocking(loop, open_recorder, ip, connection_id, server.term_size)
+        on_input = command_logger(connection_id, recorder) if connection_id is not None else None
+        async for direction, data in async_server.relay(loop, master_fd, chan, limits=session_limits()):
+            if shutdown_requested:
+                end_reason = 'shutdown'
+                break
+            if direction == 'in' and on_input is not None:
+                on_input(data)
+            elif direction == 'out' and recorder is not None:
+                recorder.output(data)
+            elif direction == 'end':
+                end_reason = data
+                if end_reason in relay.LIMIT_REASONS:
+                    await reap_session_async(chan, ip, end_reason)
+    except asyncio.CancelledError:
+        end_reason = 'shutdown'  #server shutting down
+    except Exception as e:
+        logging.error('Connection error: %s', e)
     finally:
-        connection.close()
+        await run_blocking(loop, close_recorder, recorder)
+        await run_blocking(loop, close_session, ip, connection_id, start_time, shell_process, master_fd, end_reason)
+        chan.close()
+        transport.close()
+        if connection_id is not None:
+            notify_status(ip, False)
 
 def signal_handler(signum, frame):
     global shutdown_requested
     logging.info("Shutdown requested...")
     shutdown_requested = True
 
+def reload_handler(signum, frame):
+    global reload_requested
+    logging.info("Reload requested...")
+    reload_requested = True
+
+def create_server_sockets(reuse_port=False):
+    #one listening socket per LISTEN_ADDRESSES entry, in the same order
+    if INHERITED_SOCKETS:
+        return INHERITED_SOCKETS  #already bound and listening
+    return listeners.open_sockets(LISTEN_ADDRESSES, reuse_port, int(os.getenv('LISTEN_BACKLOG', 100)))
+
+def shared_counter_metrics():
+    #exposition lines for the counters kept in stats.SharedCounters (per listener, reaped sessions)
+    lines = ["# HELP honeypot_connections_accepted_total Connections accepted and admitted, per listener",
+             "# TYPE honeypot_connections_accepted_total counter"]
+    lines += [f'honeypot_connections_accepted_total{{listener="{listeners.name(address)}"}} '
+              f"{LISTENER_STATS.get('accepted', listener)}" for listener, address in enumerate(LISTEN_ADDRESSES)]
+    lines += ["# HELP honeypot_connections_active Connections open (handshake or session), per listener",
+              "# TYPE honeypot_connections_active gauge"]
+    lines += [f'honeypot_connections_active{{listener="{listeners.name(address)}"}} '
+              f"{LISTENER_STATS.get('active', listener)}" for listener, address in enumerate(LISTEN_ADDRESSES)]
+    lines += ["# HELP honeypot_sessions_reaped_total Sessions ended by the server, per limit reached",
+              "# TYPE honeypot_sessions_reaped_total counter"]
+    lines += [f'honeypot_sessions_reaped_total{{reason="{reason}"}} {REAPED_SESSIONS.get(reason)}'
+              for reason in REAPED_SESSIONS.names]
+    return lines
+
+def stop_metrics():
+    #a draining server leaves the metrics port to the new process
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.stop()
+
+def log_shared_stats():
+    #counters kept by every server process together, logged by the main one
+    REAPED_SESSIONS.log('Reaped sessions')
+    if SENSOR_POLICY is not None:
+        SENSOR_POLICY.log_stats()
+
+def log_listener_stats():
+    for listener, address in enumerate(LISTEN_ADDRESSES):
+        logging.info(f"Listener {listeners.name(address)}: {LISTENER_STATS.snapshot(listener)}")
+
+def reap_children(children):
+    #collects every connection child that exited since the last call
+    while children:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            children.clear()
+            return
+        if pid == 0:
+            return
+        child = children.pop(pid, None)
+        if child is not None:
+            ip, listener = child
+            ADMISSION.release(ip)
+            LISTENER_STATS.add('active', -1, listener)
+
+def start_successor(listen_sockets):
+    global reload_requested
+    reload_requested = False
+    LOG_PIPELINE.set_rotating(False)  #the new process rotates server.log, this one follows
+    try:
+        return handoff.Successor(listen_sockets)
+    except Exception as e:
+        logging.error(f"Reload: could not start the new server process: {e}")
+        LOG_PIPELINE.set_rotating(True)
+        return None
+
+def poll_successor(successor):
+    #Successor.poll, log rotation back to this process if the new one didn't make it
+    ready = successor.poll()
+    if ready is False:
+        LOG_PIPELINE.set_rotating(True)
+    return ready
+
+def fork_connection(client, addr, listener, server_sockets, children):
+    #checks a new connection and forks a child to handle it
+    accepted_at = time.monotonic()
+    verdict = ACCESS_LISTS.check(addr[0])
+    if verdict == iplists.DENY:
+        REJECTED.inc('denied')
+        client.close()
+        return
+    if verdict is None and TARPIT is not None and TARPIT.wants(addr[0]):
+        REJECTED.inc('tarpit')
+        TARPIT.hold_threadsafe(client, addr)  #the tarpit thread owns the socket now
+        return
+    if verdict is None and not ADMISSION.admit(addr[0]):
+        REJECTED.inc('admission')
+        client.close()
+        return
+    logging.info('Connection from %s', addr)
+    if verdict is None:
+        GEO_WORKER.submit(addr[0])  #resolved by this (parent) process, off the session path
+    LISTENER_STATS.add('accepted', 1, listener)
+    pid = os.fork()
+    if pid == 0:
+         #child process handles the connection
+        for server_socket in server_sockets:
+            server_socket.close()
+        try:
+            handle_connection(client, addr, accepted_at)
+        finally:
+            client.close()
+            EVENT_WRITER.close()  #flush pending events before the child exits
+            EVENT_WRITER.log_stats()
+            DB_POOL.log_stats()
+            FINGERPRINTS.log_stats()
+            DB_POOL.close()
+            os._exit(0)
+    else:
+        #parent process continues accepting connections
+        client.close()
+        children[pid] = (addr[0], listener)
+        LISTENER_STATS.add('active', 1, listener)
+
 def start_ssh_server():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, lambda signum, frame: ACCESS_LISTS.reload())
+    signal.signal(signal.SIGUSR2, reload_handler)
     
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    # For example, bind to port 22 if you need a privileged port solution before forking.
-    server_socket.bind(('0.0.0.0', 22))
-    server_socket.listen(100)
+    server_sockets = create_server_sockets()
+    for server_socket in server_sockets:
+        server_socket.setblocking(False)  #accepted when select() reports them readable
     logging.info('Server started')
-    
+    NOTIFIER.start()
+    if TARPIT is not None:
+        TARPIT.start_thread()
+    handoff.notify_ready()
+    children = {}  #pid -> (client ip, listener), to release the admission slot when the child exits
+    successor = None
+
     while not shutdown_requested:
+        reap_children(children)
+        if reload_requested and successor is None:
+            successor = start_successor(server_sockets)
+        if successor is not None:
+            ready = poll_successor(successor)
+            if ready:
+                break  #the new process accepts from the same sockets now
+            if ready is False:
+                successor = None
         try:
-            server_socket.settimeout(1.25) #check shutdown flag periodically
-            client, addr = server_socket.accept()
-            logging.info(f'Connection from {addr}')
-            pid = os.fork()
-            if pid == 0:
-                 #child process handles the connection
-                server_socket.close() 
+            readable, _, _ = select.select(server_sockets, [], [], 1.25) #check shutdown flag periodically
+            for server_socket in readable:
                 try:
-                    handle_connection(client, addr)
-                finally:
-                    client.close()
-                    os._exit(0)
-            else:
-                #parent process continues accepting connections
-                client.close()
-                os.waitpid(-1, os.WNOHANG)
-        except socket.timeout:
-            continue
+                    client, addr = server_socket.accept()
+                except BlockingIOError:
+                    continue  #taken by the new process during a reload
+                fork_connection(client, addr, server_sockets.index(server_socket), server_sockets, children)
         except Exception as e:
             logging.error(f'Error: {e}')
             break
     
+    for server_socket in server_sockets:
+        server_socket.close()
+    if successor is not None:
+        #each session runs in its own child: wait for them to end, the new process serves the rest
+        stop_metrics()
+        logging.info(f"Draining {len(children)} open sessions")
+        while children and not shutdown_requested:
+            time.sleep(0.5)
+            reap_children(children)
     logging.info("Shutting down server...")
-    server_socket.close()
+    GEO_WORKER.close()
+    GEO_WORKER.log_stats()
+    EVENT_WRITER.close()
+    NOTIFIER.close()
+    ADMISSION.log_stats()
+    ACCESS_LISTS.log_stats()
+    if TARPIT is not None:
+        TARPIT.log_stats()
+    log_shared_stats()
+    log_listener_stats()
     logging.info("Done!")
+    LOG_PIPELINE.stop()
+    sys.exit(0)
+
+def serve_async(server_sockets, on_accept=None, on_close=None, drain_only=False):
+    #drain_only: SIGUSR2 only drains this process (prefork workers, their master starts the new server)
+    threading.stack_size(int(os.getenv('ASYNC_THREAD_STACK_KB', 512)) * 1024)  #one paramiko thread per connection
+
+    def accepted(addr, listener):
+        if addr[0] not in ACCESS_LISTS.exclude:
+            GEO_WORKER.submit(addr[0])
+        LISTENER_STATS.add('accepted', 1, listener)
+        LISTENER_STATS.add('active', 1, listener)
+        if on_accept is not None:
+            on_accept(addr)
+
+    def closed(addr, listener):
+        ADMISSION.release(addr[0])
+        LISTENER_STATS.add('active', -1, listener)
+        if on_close is not None:
+            on_close(addr)
+
+    def diverted(client, addr):
+        #denied sources are closed, tarpitted ones handed to the tarpit
+        verdict = ACCESS_LISTS.check(addr[0])
+        if verdict == iplists.DENY:
+            REJECTED.inc('denied')
+            client.close()
+            return True
+        if verdict is None and TARPIT is not None and TARPIT.wants(addr[0]):
+            REJECTED.inc('tarpit')
+            TARPIT.hold(client, addr)
+            return True
+        return False
+
+    def admitted(addr):
+        if addr[0] in ACCESS_LISTS.exclude or ADMISSION.admit(addr[0]):
+            return True
+        REJECTED.inc('admission')
+        return False
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        NOTIFIER.start()  #no-op in prefork workers, the master runs it
+        if SHELL_POOL is not None:
+            for username in SHELL_POOL_USERS:
+                loop.run_in_executor(None, SHELL_POOL.fill, username)
+        if TARPIT is not None:
+            TARPIT.start(loop)
+        draining = False
+        serve_task = asyncio.ensure_future(async_server.serve(
+            server_sockets, handle_connection_async, lambda: shutdown_requested,
+            max_connections=int(os.getenv('ASYNC_MAX_CONNECTIONS', 10000)),
+            on_accept=accepted, on_close=closed, admit=admitted, divert=diverted, is_draining=lambda: draining
+        ))
+
+        def on_signal():
+            signal_handler(None, None)
+            serve_task.cancel()
+
+        def drain():
+            #stop accepting, the open sessions run to their end
+            nonlocal draining
+            if not draining:
+                draining = True
+                stop_metrics()
+                serve_task.cancel()
+
+        successor = None
+
+        def on_successor():
+            nonlocal successor
+            ready_fd = successor.ready_fd
+            ready = poll_successor(successor)
+            if ready is None:
+                return
+            loop.remove_reader(ready_fd)
+            successor = None
+            if ready:
+                drain()
+
+        def on_reload():
+            nonlocal successor
+            if drain_only:
+                drain()
+            elif not draining and successor is None:
+                successor = start_successor(server_sockets)
+                if successor is not None:
+                    loop.add_reader(successor.ready_fd, on_successor)
+
+        loop.add_signal_handler(signal.SIGINT, on_signal)
+        loop.add_signal_handler(signal.SIGTERM, on_signal)
+        loop.add_signal_handler(signal.SIGHUP, ACCESS_LISTS.reload)
+        loop.add_signal_handler(signal.SIGUSR2, on_reload)
+        if not drain_only:
+            handoff.notify_ready()
+        await serve_task
+
+    try:
+        asyncio.run(main())
+    finally:
+        for server_socket in server_sockets:
+            server_socket.close()
+        GEO_WORKER.close()
+        GEO_WORKER.log_stats()
+        EVENT_WRITER.close()
+        EVENT_WRITER.log_stats()
+        DB_POOL.log_stats()
+        FINGERPRINTS.log_stats()
+        NOTIFIER.close()
+        if SHELL_POOL is not None:
+            SHELL_POOL.close()
+            SHELL_POOL.log_stats()
+        ADMISSION.log_stats()
+        ACCESS_LISTS.log_stats()
+        if TARPIT is not None:
+            TARPIT.log_stats()
+        SHELL_LIMITS.log_stats()
+
+def start_async_ssh_server():
+    #single process event loop: no fork per connection, fshell is only spawned for granted shells
+    server_sockets = create_server_sockets()
+    logging.info('Server started (async mode)')
+    try:
+        serve_async(server_sockets)
+    finally:
+        logging.info("Shutting down server...")
+        log_shared_stats()
+        log_listener_stats()
+        logging.info("Done!")
+    LOG_PIPELINE.stop()
+    sys.exit(0)
+
+def run_prefork_worker(slot, worker_stats, server_sockets):
+    #worker process: its own SO_REUSEPORT sockets (or the inherited ones) and event loop, serving many connections
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)  #handled by the event loop once it runs
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)  #same
+    worker_stats.set('active', 0, slot)
+
+    def on_accept(addr):
+        worker_stats.add('accepted', 1, slot)
+        worker_stats.add('active', 1, slot)
+
+    def on_close(addr):
+        worker_stats.add('active', -1, slot)
+
+    exit_code = 0
+    try:
+        logging.info(f'Worker {slot} started (pid {os.getpid()})')
+        serve_async(server_sockets, on_accept, on_close, drain_only=True)
+    except Exception as e:
+        logging.error(f'Worker {slot} error: {e}')
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+def start_prefork_ssh_server(workers):
+    #master process: keeps one long-lived worker per slot running, respawning the ones that die
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    worker_stats = stats.SharedCounters(['accepted', 'active', 'restarts'], slots=workers, lock=False)
+
+    def log_stats(signum, frame):
+        worker_stats.log('Worker stats')
+        log_shared_stats()
+        log_listener_stats()
+    signal.signal(signal.SIGUSR1, log_stats)
+
+    pids = {}  #pid -> slot
+    started = {}  #slot -> spawn time
+
+    def forward_sighup(signum, frame):
+        #every worker reloads its own copy of the access lists
+        for pid in list(pids):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGHUP, forward_sighup)
+
+    signal.signal(signal.SIGUSR2, reload_handler)
+
+    def spawn(slot, server_sockets=None):
+        #the sockets are bound here, the worker only accepts from them
+        if server_sockets is None:
+            server_sockets = create_server_sockets(reuse_port=True)
+        pid = os.fork()
+        if pid == 0:
+            run_prefork_worker(slot, worker_stats, server_sockets)
+        if server_sockets is not INHERITED_SOCKETS:
+            for server_socket in server_sockets:
+                server_socket.close()  #the worker's own
+        pids[pid] = slot
+        started[slot] = time.time()
+
+    NOTIFIER.start()  #workers send their presence updates to this process
+    server_sockets = [create_server_sockets(reuse_port=True) for slot in range(workers)]
+    handoff.notify_ready()  #listening already, before the workers inherit the pipe
+    for slot in range(workers):
+        spawn(slot, server_sockets[slot])
+    logging.info(f'Server started (prefork mode, {workers} workers)')
+    successor = None
+    draining = False
+
+    stats_interval = int(os.getenv('PREFORK_STATS_INTERVAL', 300))
+    next_stats = time.time() + stats_interval
+    while not shutdown_requested and not (draining and not pids):
+        time.sleep(1)
+        if reload_requested and successor is None and not draining:
+            #without an inherited socket the new workers bind their own SO_REUSEPORT sockets next to ours
+            successor = start_successor(INHERITED_SOCKETS)
+        if successor is not None:
+            ready = poll_successor(successor)
+            if ready:
+                draining = True
+                stop_metrics()
+                logging.info(f"Draining {len(pids)} workers")
+                for pid in pids:
+                    os.kill(pid, signal.SIGUSR2)
+            if ready is not None:
+                successor = None
+        while pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            slot = pids.pop(pid, None)
+            if slot is None:
+                continue
+            worker_stats.set('active', 0, slot)
+            if shutdown_requested or draining:
+                continue
+            logging.error(f'Worker {slot} (pid {pid}) exited with status {status}, respawning')
+            if time.time() - started[slot] < 5:
+                time.sleep(1)  #don't spin if the worker dies right away
+            worker_stats.add('restarts', 1, slot)
+            spawn(slot)
+        if time.time() >= next_stats:
+            log_stats(None, None)
+            next_stats = time.time() + stats_interval
+
+    logging.info("Shutting down server...")
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.time() + 30
+    while pids and time.time() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        pids.pop(pid, None)
+    for pid in pids:
+        logging.error(f'Worker pid {pid} did not stop, killing it')
+        os.kill(pid, signal.SIGKILL)
+    worker_stats.log('Worker stats')
+    log_shared_stats()
+    log_listener_stats()
+    NOTIFIER.close()
+    logging.info("Done!")
+    LOG_PIPELINE.stop()
     sys.exit(0)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="SSH Server for Honeypot")
     parser.add_argument("--allow-root", action="store_true",
                         help="If provided, accept all root connections automatically")
+    parser.add_argument("--mode", choices=["fork", "async", "prefork"], default="fork",
+                        help="fork: one process per connection (default), async: one event loop for all connections, "
+                             "prefork: several async workers sharing the port with SO_REUSEPORT")
+    parser.add_argument("--handshake", choices=sorted(handshake.PROFILES),
+                        help="Handshake profile, overrides SSH_HANDSHAKE_PROFILE (default: paramiko)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes in prefork mode (default: one per core)")
+    parser.add_argument("--log-format", choices=["text", "json"], default=os.getenv('LOG_FORMAT', 'text'),
+                        help="server.log lines as text (default) or JSON objects, overrides LOG_FORMAT")
+    parser.add_argument("--no-console", action="store_true",
+                        help="Only log to the log file, not to the console")
+    parser.add_argument("--listen", action="append", metavar="HOST:PORT",
+                        help="Address to listen on ([::]:22 for IPv6), can be repeated; overrides LISTEN_ADDRS "
+                             f"(default: {listeners.DEFAULT})")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv('METRICS_PORT', 0)),
+                        help="Serve Prometheus metrics on this port (METRICS_ADDR, 127.0.0.1 by default), 0: disabled")
+    parser.add_argument("--sensor", action="store_true",
+                        help="Answer password attempts from SENSOR_CREDENTIALS / SENSOR_ACCEPT_RATIO instead of PAM")
     args = parser.parse_args()
+    LOG_PIPELINE.configure(json_lines=args.log_format == 'json',
+                           console=not args.no_console and os.getenv('LOG_CONSOLE', '1') == '1')
 
     ALLOW_ROOT = args.allow_root
+    if INHERITED_SOCKETS:
+        LISTEN_ADDRESSES = [listeners.address_of(server_socket) for server_socket in INHERITED_SOCKETS]
+    elif args.listen:
+        try:
+            LISTEN_ADDRESSES = [listeners.parse_address(address) for address in args.listen]
+        except ValueError as e:
+            parser.error(str(e))
+    LISTENER_STATS = stats.SharedCounters(['accepted', 'active'], slots=len(LISTEN_ADDRESSES))
+    logging.info(f"Listening on {', '.join(listeners.name(address) for address in LISTEN_ADDRESSES)}")
+    METRICS.collector(shared_counter_metrics)
+    if args.metrics_port:
+        METRICS_SERVER = metrics.MetricsServer(METRICS, args.metrics_port, os.getenv('METRICS_ADDR', '127.0.0.1'))
+        METRICS_SERVER.start()
+    if args.handshake:
+        HANDSHAKE = handshake.HandshakeProfile(args.handshake, HOST_KEYS, os.getenv('SSH_BANNER'))
+    logging.info(f"Handshake profile: {HANDSHAKE.name}")
+
+    if args.sensor:
+        SENSOR_POLICY = auth_policy.SensorPolicy(
+            accept_ratio=float(os.getenv('SENSOR_ACCEPT_RATIO', 0)),
+            credentials=auth_policy.load_credentials(os.getenv('SENSOR_CREDENTIALS')) if os.getenv('SENSOR_CREDENTIALS') else (),
+            shell_user=os.getenv('SENSOR_SHELL_USER', 'froot'),
+            pam=os.getenv('SENSOR_PAM', '0') == '1'
+        )
+        logging.info(f"Sensor mode enabled: accepting {len(SENSOR_POLICY.credentials)} credential pairs "
+                     f"and {SENSOR_POLICY.accept_ratio:.1%} of other attempts, "
+                     f"{'then checked with PAM' if SENSOR_POLICY.pam else 'PAM is not used'}")
 
     if ALLOW_ROOT:
         logging.info("ALLOW_ROOT mode enabled: all root connections will be accepted.")
     else:
         logging.info("ALLOW_ROOT mode disabled: normal authentication applies.")
 
-    start_ssh_server()
\ No newline at end of file
+    if args.mode == "async":
+        start_async_ssh_server()
+    elif args.mode == "prefork":
+        start_prefork_ssh_server(max(1, args.workers))
+    else:
+        start_ssh_server()
\ No newline at end of file
@@ -0,0 +1,47 @@
+import logging
+import mmap
+import multiprocessing
+
+#Integer counters living in an anonymous shared mapping created before forking,
+#so the master process can read what its workers/children count.
+#One row of counters per slot (e.g. one slot per pre-forked worker).
+
+class SharedCounters:
+    def __init__(self, names, slots=1, lock=True):
+        self.names = list(names)
+        self.slots = slots
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._mem = mmap.mmap(-1, 8 * len(self.names) * slots)  #MAP_SHARED | MAP_ANONYMOUS
+        self._values = memoryview(self._mem).cast('q')
+        #slots written by a single process (pre-forked workers) don't need the lock,
+        #slots shared by many forked children do
+        self._lock = multiprocessing.Lock() if lock else None
+
+    def _pos(self, name, slot):
+        return slot * len(self.names) + self._index[name]
+
+    def add(self, name, value=1, slot=0):
+        pos = self._pos(name, slot)
+        if self._lock is None:
+            self._values[pos] += value
+        else:
+            with self._lock:
+                self._values[pos] += value
+
+    def set(self, name, value, slot=0):
+        self._values[self._pos(name, slot)] = value
+
+    def get(self, name, slot=None):
+        #value for one slot, or the sum over all slots
+        if slot is not None:
+            return self._values[self._pos(name, slot)]
+        return sum(self._values[self._pos(name, s)] for s in range(self.slots))
+
+    def snapshot(self, slot=None):
+        return {name: self.get(name, slot) for name in self.names}
+
+    def log(self, title):
+        for slot in range(self.slots):
+            logging.info(f"{title} [{slot}]: {self.snapshot(slot)}")
+        if self.slots > 1:
+            logging.info(f"{title} [total]: {self.snapshot()}")
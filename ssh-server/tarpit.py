@@ -0,0 +1,148 @@
+import asyncio
+import fnmatch
+import ipaddress
+import logging
+import os
+import random
+import socket
+import string
+import threading
+import time
+
+#Tarpit: connections from selected sources are held by one coroutine each, which sends one
+#random byte every `delay` seconds before the SSH version line (RFC 4253 lets a server send
+#other lines first, clients keep waiting for "SSH-"). Nothing is forked and no handshake is
+#done, so thousands of trapped bots cost a socket and a small task each.
+#
+#Sources are trapped if they are in one of the configured networks, or if they recently tried a
+#credential matching one of the patterns (username:password globs, as in a sensor credentials file).
+
+LINE_LENGTH = 32  #a line break every so many bytes, some clients limit the pre-banner line length
+
+class Tarpit:
+    def __init__(self, networks=(), credentials=(), delay=10, max_trapped=10000, mark_ttl=86400):
+        self.networks = [ipaddress.ip_network(n, strict=False) for n in networks]
+        self.credentials = list(credentials)  #(username glob, password glob) pairs
+        self.delay = delay
+        self.max_trapped = max_trapped
+        self.mark_ttl = mark_ttl    #seconds an IP stays trapped after a matching credential
+        self._marked = {}           #ip -> expiry (time.monotonic())
+        self._lock = threading.Lock()
+        self._loop = None
+        self._socks = {}            #trapped socket -> time.monotonic() it was trapped
+        self._trapped_seconds = 0.0  #time wasted by connections already released
+        self._open_mark_socket()
+        self.stats = {'trapped': 0, 'refused': 0, 'marked': 0, 'bytes_sent': 0}
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _open_mark_socket(self):
+        #forked children and paramiko threads report matching credentials through this socket
+        self._owner = os.getpid()
+        self._mark_r, self._mark_w = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._mark_r.setblocking(False)
+        self._mark_w.setblocking(False)
+
+    def _after_fork(self):
+        #a forked connection handler must not keep the trapped connections open
+        for sock in list(self._socks):
+            sock.close()
+        self._socks = {}
+
+    def wants(self, ip):
+        if ip.startswith('::ffff:'):
+            ip = ip[7:]
+        with self._lock:
+            expires = self._marked.get(ip)
+            if expires is not None:
+                if expires > time.monotonic():
+                    return True
+                del self._marked[ip]
+        if self.networks:
+            try:
+                address = ipaddress.ip_address(ip)
+            except ValueError:
+                return False
+            return any(address in network for network in self.networks)
+        return False
+
+    def check_credentials(self, ip, username, password):
+        #called for every password attempt: a match traps the IP's next connections
+        for user_glob, password_glob in self.credentials:
+            if fnmatch.fnmatchcase(username, user_glob) and fnmatch.fnmatchcase(password, password_glob):
+                try:
+                    self._mark_w.send(ip.encode())
+                except OSError:
+                    pass  #buffer full: the IP will be marked on its next match
+                return True
+        return False
+
+    def _read_marks(self):
+        while True:
+            try:
+                ip = self._mark_r.recv(64).decode()
+            except BlockingIOError:
+                return
+            with self._lock:
+                if ip not in self._marked:
+                    self.stats['marked'] += 1
+                    logging.info(f"Tarpit: trapping {ip} for {self.mark_ttl} seconds (credential pattern)")
+                self._marked[ip] = time.monotonic() + self.mark_ttl
+                if len(self._marked) > 100000:
+                    now = time.monotonic()
+                    self._marked = {k: v for k, v in self._marked.items() if v > now}
+
+    def start(self, loop):
+        #runs the tarpit on an existing event loop (async and prefork modes)
+        if os.getpid() != self._owner:
+            #prefork worker: its marks stay its own instead of going to whichever worker reads first
+            self._open_mark_socket()
+        self._loop = loop
+        loop.add_reader(self._mark_r.fileno(), self._read_marks)
+
+    def start_thread(self):
+        #fork mode: the tarpit gets its own event loop in a background thread of the parent
+        loop = asyncio.new_event_loop()
+        self.start(loop)
+        threading.Thread(target=loop.run_forever, name="tarpit", daemon=True).start()
+
+    def hold(self, client, addr):
+        #takes ownership of an accepted socket; call from the loop's thread, or use hold_threadsafe
+        if len(self._socks) >= self.max_trapped:
+            self.stats['refused'] += 1
+            client.close()
+            return
+        self._socks[client] = time.monotonic()
+        self.stats['trapped'] += 1
+        asyncio.ensure_future(self._drip(client, addr), loop=self._loop)
+
+    def hold_threadsafe(self, client, addr):
+        self._loop.call_soon_threadsafe(self.hold, client, addr)
+
+    async def _drip(self, client, addr):
+        client.setblocking(False)
+        sent = 0
+        try:
+            while True:
+                await asyncio.sleep(self.delay)
+                sent += 1
+                byte = b'\r\n' if sent % LINE_LENGTH == 0 else random.choice(string.ascii_lowercase).encode()
+                await self._loop.sock_sendall(client, byte)
+                self.stats['bytes_sent'] += len(byte)
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            held = time.monotonic() - self._socks.pop(client, time.monotonic())
+            self._trapped_seconds += held
+            client.close()
+            logging.info(f"Tarpit: released {addr[0]} after {held:.0f} seconds")
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        now = time.monotonic()
+        stats['trapped_now'] = len(self._socks)
+        stats['seconds_wasted'] = int(self._trapped_seconds + sum(now - start for start in list(self._socks.values())))
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Tarpit stats: {self.get_stats()}")
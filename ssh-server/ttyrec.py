@@ -0,0 +1,257 @@
+import bisect
+import codecs
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  #optional, recordings are gzip (zlib) compressed without it
+
+#Session recordings: both directions of the pty relay with their timestamps, in a compact binary
+#file. Frames are gathered in memory and compressed in independent chunks (zstd when the
+#zstandard module is installed, zlib otherwise), each written with a single write() once it
+#reaches CHUNK_SIZE bytes or gets FLUSH_INTERVAL seconds old, instead of one flush per line. A chunk
+#index written at the end lets a reader jump to any point in time; recordings cut short
+#(server killed) have no index and are read by walking the chunk headers instead.
+#
+#   header   MAGIC, codec, width, height, start time (epoch seconds)
+#   chunk    compressed size, uncompressed size, time of its first frame (ms), compressed frames
+#   frame    time since the start (ms), direction (b'i' client input, b'o' shell output), size, data
+#   index    (file offset, time of the first frame) per chunk, then chunk count, index offset and END_MAGIC
+#
+#Converting a recording for asciinema, and reading it from a point in time:
+#   python ttyrec.py asciicast session.hprec session.cast [--input]
+#   python ttyrec.py play session.hprec [--from SECONDS] [--speed N]
+#   python ttyrec.py info session.hprec
+
+MAGIC = b'HPTTY001'
+END_MAGIC = b'HPTTYEND'
+HEADER = struct.Struct('=8sBHHd')     #magic, codec, width, height, start time
+CHUNK = struct.Struct('=III')         #compressed size, uncompressed size, first frame time (ms)
+FRAME = struct.Struct('=IcI')         #time (ms), direction, size
+INDEX_ENTRY = struct.Struct('=QI')    #chunk offset, first frame time (ms)
+FOOTER = struct.Struct('=IQ8s')       #chunk count, index offset, END_MAGIC
+
+CODEC_ZLIB, CODEC_ZSTD = 1, 2
+CHUNK_SIZE = 64 * 1024   #uncompressed bytes per chunk
+FLUSH_INTERVAL = 5       #seconds after which the next frame also writes the chunk out
+
+def _compressor(codec, level=None):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level or 3).compress
+    return lambda data: zlib.compress(data, level or 6)
+
+def _decompressor(codec):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compressed recording: the zstandard module is needed to read it")
+        return zstandard.ZstdDecompressor().decompress
+    return zlib.decompress
+
+class Recorder:
+    def __init__(self, path, width=80, height=24, codec=None, level=None, chunk_size=CHUNK_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        if codec is None:
+            codec = CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+        self.path = path
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._compress = _compressor(codec, level)
+        self._file = open(path, 'wb', buffering=0)  #every write is a whole chunk already
+        self._file.write(HEADER.pack(MAGIC, codec, width, height, time.time()))
+        self._offset = HEADER.size
+        self._start = time.monotonic()
+        self._frames = []       #pending frame headers and data
+        self._pending = 0       #their size
+        self._chunk_time = 0    #time of the first pending frame (ms)
+        self._chunk_started = 0  #monotonic time of the first pending frame
+        self._index = []        #(offset, first frame time) per chunk written
+
+    def _add(self, direction, data):
+        now = time.monotonic()
+        ms = int((now - self._start) * 1000)
+        if not self._frames:
+            self._chunk_time = ms
+            self._chunk_started = now
+        self._frames.append(FRAME.pack(ms, direction, len(data)))
+        self._frames.append(data)
+        self._pending += FRAME.size + len(data)
+        if self._pending >= self.chunk_size or now - self._chunk_started >= self.flush_interval:
+            self.flush()
+
+    def input(self, data):
+        self.bytes_in += len(data)
+        self._add(b'i', data)
+
+    def output(self, data):
+        self.bytes_out += len(data)
+        self._add(b'o', data)
+
+    def flush(self):
+        #compresses the pending frames into one chunk and writes it
+        if not self._frames:
+            return
+        raw = b''.join(self._frames)
+        self._frames = []
+        self._pending = 0
+        if self._file is None:
+            return  #stopped after a write error
+        compressed = self._compress(raw)
+        try:
+            self._file.write(CHUNK.pack(len(compressed), len(raw), self._chunk_time) + compressed)
+        except OSError as e:
+            #never ends the session: the recording stops where it is, readable without its index
+            logging.error(f"Recording {self.path} stopped: {e}")
+            self._file.close()
+            self._file = None
+            return
+        self._index.append((self._offset, self._chunk_time))
+        self._offset += CHUNK.size + len(compressed)
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        if self._file is None:
+            return
+        index = b''.join(INDEX_ENTRY.pack(offset, ms) for offset, ms in self._index)
+        try:
+            self._file.write(index + FOOTER.pack(len(self._index), self._offset, END_MAGIC))
+        except OSError as e:
+            logging.error(f"Could not write the index of {self.path}: {e}")
+        self._file.close()
+        self._file = None
+
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        magic, self.codec, self.width, self.height, self.start_time = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a session recording")
+        self._decompress = _decompressor(self.codec)
+        self._offsets, self._times = self._read_index()
+
+    def _read_index(self):
+        size = self._file.seek(0, os.SEEK_END)
+        if size >= HEADER.size + FOOTER.size:
+            self._file.seek(size - FOOTER.size)
+            count, index_offset, end_magic = FOOTER.unpack(self._file.read(FOOTER.size))
+            if end_magic == END_MAGIC:
+                self._file.seek(index_offset)
+                raw = self._file.read(count * INDEX_ENTRY.size)
+                entries = [INDEX_ENTRY.unpack_from(raw, i * INDEX_ENTRY.size) for i in range(count)]
+                return [offset for offset, _ in entries], [ms for _, ms in entries]
+        #not closed properly: walk the chunk headers, stopping at a truncated chunk
+        offsets, times = [], []
+        offset = HEADER.size
+        while offset + CHUNK.size <= size:
+            self._file.seek(offset)
+            compressed_size, _, ms = CHUNK.unpack(self._file.read(CHUNK.size))
+            if offset + CHUNK.size + compressed_size > size:
+                break
+            offsets.append(offset)
+            times.append(ms)
+            offset += CHUNK.size + compressed_size
+        return offsets, times
+
+    def __len__(self):
+        return len(self._offsets)  #chunks
+
+    def _chunk(self, i):
+        self._file.seek(self._offsets[i])
+        compressed_size, _, _ = CHUNK.unpack(self._file.read(CHUNK.size))
+        return self._decompress(self._file.read(compressed_size))
+
+    def frames(self, start=0, end=None):
+        #yields (seconds since the start, direction, data) for the frames from start to end seconds,
+        #only decompressing the chunks from the one holding start
+        start_ms = int(start * 1000)
+        end_ms = None if end is None else int(end * 1000)
+        first = max(0, bisect.bisect_left(self._times, start_ms) - 1)  #last chunk starting before start
+        for i in range(first, len(self._offsets)):
+            if end_ms is not None and self._times[i] > end_ms:
+                return
+            raw = self._chunk(i)
+            pos = 0
+            while pos < len(raw):
+                ms, direction, size = FRAME.unpack_from(raw, pos)
+                pos += FRAME.size
+                if end_ms is not None and ms > end_ms:
+                    return
+                if ms >= start_ms:
+                    yield ms / 1000, direction, raw[pos:pos + size]
+                pos += size
+
+    def duration(self):
+        #time of the last frame, in seconds
+        if not self._offsets:
+            return 0
+        last = 0
+        for seconds, _, _ in self.frames(self._times[-1] / 1000):
+            last = seconds
+        return last
+
+    def to_asciicast(self, out, include_input=False):
+        #writes an asciicast v2 file (asciinema play / asciinema.org) to the text file out
+        out.write(json.dumps({'version': 2, 'width': self.width, 'height': self.height,
+                              'timestamp': int(self.start_time)}) + '\n')
+        decoders = {b'o': codecs.getincrementaldecoder('utf-8')('replace'),
+                    b'i': codecs.getincrementaldecoder('utf-8')('replace')}  #characters split across frames
+        for seconds, direction, data in self.frames():
+            if direction == b'i' and not include_input:
+                continue
+            text = decoders[direction].decode(data)
+            if text:
+                out.write(json.dumps([seconds, direction.decode(), text]) + '\n')
+
+    def close(self):
+        self._file.close()
+
+def _play(recording, start, speed):
+    last = start
+    for seconds, direction, data in recording.frames(start):
+        if direction != b'o':
+            continue
+        time.sleep(max(0, seconds - last) / speed)
+        last = seconds
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Session recordings written by the SSH server")
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help="Size, duration and compression of a recording")
+    info.add_argument('recording')
+    cast = commands.add_parser('asciicast', help="Convert a recording to asciicast v2")
+    cast.add_argument('recording')
+    cast.add_argument('output')
+    cast.add_argument('--input', action='store_true', help="Also export what the client typed ('i' events)")
+    play = commands.add_parser('play', help="Replay the shell output in this terminal")
+    play.add_argument('recording')
+    play.add_argument('--from', dest='start', type=float, default=0, help="Start at this many seconds")
+    play.add_argument('--speed', type=float, default=1, help="Playback speed factor")
+    args = parser.parse_args()
+
+    recording = Recording(args.recording)
+    if args.command == 'info':
+        raw = sum(len(data) for _, _, data in recording.frames())
+        print(f"{args.recording}: {recording.width}x{recording.height}, started "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(recording.start_time))}, "
+              f"{recording.duration():.1f} s, {len(recording)} chunks ({'zstd' if recording.codec == CODEC_ZSTD else 'zlib'}), "
+              f"{raw} bytes recorded in {os.path.getsize(args.recording)} bytes")
+    elif args.command == 'asciicast':
+        with open(args.output, 'w', encoding='utf-8') as out:
+            recording.to_asciicast(out, args.input)
+    else:
+        _play(recording, args.start, args.speed)
+    recording.close()